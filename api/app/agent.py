@@ -0,0 +1,178 @@
+import os
+import json
+import asyncio
+import inspect
+import logging
+import traceback
+
+from google.genai import types
+
+from concurrency import run_blocking
+from telemetry import span, record_usage, TOOL_CALLS
+
+# agent loop owned by us instead of the SDK automatic function calling: the function
+# calls of a turn run concurrently (a combination question takes the latency of the
+# slowest tool instead of the sum), each with a timeout, and the responses go back to
+# the model in one batched turn. Progress events are yielded in between for streaming.
+MAX_AGENT_TURNS = 10
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "60"))
+MAX_PARALLEL_TOOLS = int(os.environ.get("MAX_PARALLEL_TOOLS", "8"))
+
+
+def function_call_text(function_call) -> str:
+    return f"{function_call.name}({json.dumps(dict(function_call.args or {}), default=str)})"
+
+
+async def execute_tool(tool_map: dict, function_call, timeout: float = TOOL_TIMEOUT):
+    """Executes a single function call from the model, blocking tools run on the bounded executor.
+
+    Args:
+        tool_map (dict): function name -> python function
+        function_call: function call from the model
+        timeout (float): seconds before the call is cancelled and an error is returned
+
+    Returns:
+        A dictionary used as the function response, the error is returned to the model
+        so it can correct the call instead of failing the whole answer.
+    """
+    tool = tool_map.get(function_call.name)
+    if tool is None:
+        TOOL_CALLS.labels(function_call.name, "unknown").inc()
+        return {"error": f"Unknown function {function_call.name}"}
+    args = dict(function_call.args or {})
+    with span(f"tool.{function_call.name}", **{"tool.name": function_call.name}) as tool_span:
+        if inspect.iscoroutinefunction(tool):
+            call = tool(**args)
+        else:
+            call = run_blocking(tool, **args)
+        try:
+            response = {"result": await asyncio.wait_for(call, timeout)}
+            status = "ok"
+        except asyncio.TimeoutError:
+            # the executor thread of a blocking tool finishes on its own, its result is dropped
+            logging.warning(f"{function_call_text(function_call)} timed out after {timeout}s")
+            response = {"error": f"{function_call.name} did not finish within {timeout:g} seconds, try a simpler request"}
+            status = "timeout"
+        except Exception as e:
+            logging.exception(str(traceback.format_exc()))
+            response = {"error": f"{type(e).__name__}: {e}"}
+            status = "error"
+        tool_span.set_attribute("tool.status", status)
+    TOOL_CALLS.labels(function_call.name, status).inc()
+    return response
+
+
+async def execute_tools(tool_map: dict, function_calls: list, tool_timeouts: dict = None, max_parallel: int = MAX_PARALLEL_TOOLS):
+    """Executes the function calls of a turn concurrently.
+
+    Args:
+        tool_map (dict): function name -> python function
+        function_calls (list): function calls from one model turn
+        tool_timeouts (dict): function name -> timeout in seconds, TOOL_TIMEOUT otherwise
+        max_parallel (int): max number of calls running at the same time
+
+    Yields:
+        (index, response) as each call finishes, index is the position in function_calls.
+        The calls still running are cancelled when the caller stops iterating.
+    """
+    tool_timeouts = tool_timeouts or {}
+    semaphore = asyncio.Semaphore(max_parallel)
+
+    async def run(index, function_call):
+        async with semaphore:
+            timeout = tool_timeouts.get(function_call.name, TOOL_TIMEOUT)
+            return index, await execute_tool(tool_map, function_call, timeout)
+
+    tasks = [asyncio.create_task(run(index, function_call)) for index, function_call in enumerate(function_calls)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # client went away or the loop failed, nothing waits for the remaining calls
+        for task in tasks:
+            task.cancel()
+
+
+async def _model_turn(chat, message, stream: bool, turn: int = 1, usage: dict = None):
+    # yields the parts of one model turn, chunk by chunk when streaming. The span is not
+    # attached, the consumer of the parts runs between the yields. The token counts are
+    # added to usage, with the average log probability of the turn when the model gives it
+    with span("model.turn", attach=False, **{"gen_ai.turn": turn, "gen_ai.stream": stream}) as turn_span:
+        usage_metadata = None
+        avg_logprobs = None
+        if stream:
+            async for chunk in await chat.send_message_stream(message):
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                if chunk.candidates and chunk.candidates[0].avg_logprobs is not None:
+                    avg_logprobs = chunk.candidates[0].avg_logprobs
+                if chunk.candidates and chunk.candidates[0].content is not None:
+                    for part in chunk.candidates[0].content.parts or []:
+                        yield part
+        else:
+            response = await chat.send_message(message)
+            usage_metadata = response.usage_metadata
+            if response.candidates:
+                avg_logprobs = response.candidates[0].avg_logprobs
+            if response.candidates and response.candidates[0].content is not None:
+                for part in response.candidates[0].content.parts or []:
+                    yield part
+        counts = record_usage(usage_metadata, turn_span)
+        if usage is not None:
+            for kind, value in counts.items():
+                usage[kind] = usage.get(kind, 0) + value
+            usage["avg_logprobs"] = avg_logprobs
+
+
+async def stream_agent(chat, user_input: str, tools: list, max_turns: int = MAX_AGENT_TURNS, tool_timeouts: dict = None, stream: bool = True):
+    """Sends the user input and streams the agent loop as events.
+
+    Args:
+        chat: async chat session created with automatic function calling disabled
+        user_input (str): question from the user, or the function responses of a call
+            already in the history of the chat (a query of the plan cache)
+        tools (list): python functions available to the model
+        max_turns (int): max number of model turns
+        tool_timeouts (dict): function name -> timeout in seconds
+        stream (bool): stream the model output, otherwise each turn is one request
+
+    Yields:
+        (event, data) tuples, event is one of "tool", "token", "reset" or "done"
+        ("done" carries the answer, the number of model turns, the token counts summed
+        over the turns and the number of failed calls of the last tool round).
+        "reset" means the tokens streamed so far were a draft written next to function calls
+        and should be discarded by the client.
+    """
+    tool_map = {tool.__name__: tool for tool in tools}
+    message = user_input
+    answer = ""
+    usage = {}
+    tool_errors = 0
+    for turn in range(1, max_turns + 1):
+        function_calls = []
+        async for part in _model_turn(chat, message, stream, turn, usage):
+            if part.function_call is not None:
+                function_calls.append(part.function_call)
+            elif part.text and not part.thought:
+                answer += part.text
+                yield "token", {"text": part.text}
+        if not function_calls:
+            yield "done", {"ai_answer": answer, "turns": turn, "usage": usage, "tool_errors": tool_errors}
+            return
+        # the model answered with function calls, run them and send back the responses
+        if answer:
+            yield "reset", {}
+            answer = ""
+        for function_call in function_calls:
+            yield "tool", {"name": function_call.name, "status": "running", "call": function_call_text(function_call)}
+        responses = [None] * len(function_calls)
+        tool_errors = 0
+        async for index, response in execute_tools(tool_map, function_calls, tool_timeouts):
+            responses[index] = response
+            tool_errors += "error" in response
+            yield "tool", {"name": function_calls[index].name, "status": "error" if "error" in response else "done"}
+        # responses go back in the order of the calls, in a single turn
+        message = [
+            types.Part.from_function_response(name=function_call.name, response=response)
+            for function_call, response in zip(function_calls, responses)
+        ]
+    raise RuntimeError(f"Agent did not finish within {max_turns} turns")
@@ -0,0 +1,130 @@
+import re
+import json
+import hashlib
+import logging
+import threading
+import traceback
+import unicodedata
+
+import sqlalchemy
+
+from caches.lru import TTLCache
+
+
+def normalize_question(question: str) -> str:
+    """Normalizes a question so trivial variations share the same cache entry.
+
+    Lowercases, applies unicode NFKC, collapses whitespace and strips the trailing punctuation.
+    """
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.rstrip("?!. ")
+
+
+class CachedEmbeddings:
+    """Query embedding cache in front of a langchain embeddings object.
+
+    The first tier is an in-memory LRU with TTL, the optional second tier is a table in
+    the postgres instance so the cache survives restarts and is shared between instances.
+    Only embed_query is cached, embed_documents goes straight to the model.
+
+    Args:
+        embeddings: langchain embeddings, e.g. VertexAIEmbeddings
+        model_name (str): part of the cache key so a model change never returns old vectors
+        max_size (int): max number of entries of the in-memory tier
+        ttl (float): time to live in seconds of both tiers
+        engine: sqlalchemy engine for the persistent tier, None disables it
+        table_name (str): table of the persistent tier
+    """
+    def __init__(self, embeddings, model_name: str, max_size: int = 2048, ttl: float = 7 * 24 * 3600, engine=None, table_name: str = "query_embedding_cache"):
+        self._embeddings = embeddings
+        self._model_name = model_name
+        self._memory = TTLCache(max_size=max_size, ttl=ttl)
+        self._ttl = ttl
+        self._engine = engine
+        self._table_name = table_name
+        self._lock = threading.Lock()
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self.embed_calls = 0
+        if self._engine is not None:
+            self._create_table()
+
+    def _create_table(self):
+        create_table = sqlalchemy.text(f"""
+            CREATE TABLE IF NOT EXISTS {self._table_name} (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                question TEXT NOT NULL,
+                embedding JSONB NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""")
+        with self._engine.connect() as db_conn:
+            db_conn.execute(create_table)
+            db_conn.commit()
+
+    def cache_key(self, question: str) -> str:
+        return hashlib.sha256(f"{self._model_name}\n{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+    def _read_persistent(self, key: str):
+        select_embedding = sqlalchemy.text(f"""
+            SELECT embedding FROM {self._table_name}
+            WHERE cache_key = :cache_key AND created_at > now() - make_interval(secs => :ttl)""")
+        with self._engine.connect() as db_conn:
+            row = db_conn.execute(select_embedding, {"cache_key": key, "ttl": self._ttl}).fetchone()
+        if row is None:
+            return None
+        return row[0] if isinstance(row[0], list) else json.loads(row[0])
+
+    def _write_persistent(self, key: str, question: str, embedding: list):
+        upsert_embedding = sqlalchemy.text(f"""
+            INSERT INTO {self._table_name} (cache_key, model, question, embedding)
+            VALUES (:cache_key, :model, :question, CAST(:embedding AS JSONB))
+            ON CONFLICT (cache_key) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = now()""")
+        with self._engine.connect() as db_conn:
+            db_conn.execute(upsert_embedding, {
+                "cache_key": key,
+                "model": self._model_name,
+                "question": normalize_question(question),
+                "embedding": json.dumps(embedding),
+            })
+            db_conn.commit()
+
+    def embed_query(self, text: str) -> list:
+        key = self.cache_key(text)
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            return embedding
+        if self._engine is not None:
+            # the persistent tier is best effort, a failing table should never fail the question
+            try:
+                embedding = self._read_persistent(key)
+            except Exception:
+                logging.exception(str(traceback.format_exc()))
+            with self._lock:
+                if embedding is None:
+                    self.persistent_misses += 1
+                else:
+                    self.persistent_hits += 1
+            if embedding is not None:
+                self._memory.put(key, embedding)
+                return embedding
+        embedding = self._embeddings.embed_query(text)
+        with self._lock:
+            self.embed_calls += 1
+        self._memory.put(key, embedding)
+        if self._engine is not None:
+            try:
+                self._write_persistent(key, text, embedding)
+            except Exception:
+                logging.exception(str(traceback.format_exc()))
+        return embedding
+
+    def embed_documents(self, texts: list) -> list:
+        return self._embeddings.embed_documents(texts)
+
+    def stats(self) -> dict:
+        stats = {"memory": self._memory.stats(), "embed_calls": self.embed_calls}
+        if self._engine is not None:
+            stats["persistent"] = {"hits": self.persistent_hits, "misses": self.persistent_misses}
+        return stats
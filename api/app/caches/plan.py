@@ -0,0 +1,315 @@
+import re
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from caches.lru import TTLCache
+
+# plan cache of the generated SQL: a data question answered with a single successful
+# query is stored as a template, the literals of the query found in the question become
+# slots ("total fraud amount in the {str} category"). A later question of the same shape
+# gets the query filled with its own values and executed right away, the model only
+# writes the answer from the result instead of planning the query first. A template is
+# evicted when its query fails, when the answer built on it is unreliable or when the
+# user gives negative feedback on it. Only the first question of a conversation is
+# learned or served, a follow-up depends on the previous turns. Every literal of the
+# query must come from the question and a string slot is only filled with a value of the
+# column it is compared to (DISTINCT values from the mirror or the rollups), so "in the
+# {str} state" never sends 'gas_transport' or '2020' as a state.
+# sqlglot is only imported when a template is used.
+
+# string slots are short values (a category, a merchant, a state), not a list of them
+_SLOT_PATTERNS = {
+    "str": r"([\w\-\.&' ]{1,60}?)",
+    "num": r"(\d+(?:\.\d+)?)",
+}
+_CONJUNCTIONS = {"and", "or", "dan", "atau", "serta", "with", "dengan", "vs", "versus"}
+_SLOT_MARKER = re.compile(r"__slot(\d+)__")
+# stands for a column whose values are not known in the domain cache
+_UNKNOWN = object()
+
+
+def _normalize(question: str) -> str:
+    return re.sub(r"\s+", " ", question.strip().rstrip("?.! ")).strip()
+
+
+def _compared_column(literal):
+    """(column name, like) of the column the literal is compared to, (None, False) otherwise."""
+    from sqlglot import exp
+    parent = literal.parent
+    if isinstance(parent, exp.In):
+        other = parent.this
+    elif isinstance(parent, (exp.EQ, exp.NEQ, exp.Like, exp.ILike, exp.GT, exp.GTE, exp.LT, exp.LTE)):
+        other = parent.expression if parent.this is literal else parent.this
+    else:
+        return None, False
+    # LOWER(category) = 'travel' compares the values of category
+    while isinstance(other, (exp.Lower, exp.Upper, exp.Trim)):
+        other = other.this
+    if not isinstance(other, exp.Column):
+        return None, False
+    return other.name, isinstance(parent, (exp.Like, exp.ILike))
+
+
+def planned_query(contents: list, tool_name: str = "retrieving_data_db", sql_arg: str = "query_syntax"):
+    """SQL of the only function call in the contents of one answer when it returned rows, None otherwise."""
+    calls = [part.function_call for content in contents for part in content.parts or [] if part.function_call is not None]
+    responses = [part.function_response for content in contents for part in content.parts or [] if part.function_response is not None]
+    if len(calls) != 1 or len(responses) != 1 or calls[0].name != tool_name:
+        return None
+    result = (responses[0].response or {}).get("result")
+    # the cost guard rejections are returned as text, only results with the row header count
+    if not isinstance(result, str) or not (result.startswith("# total_rows=") or result.startswith('{"total_rows"')):
+        return None
+    return dict(calls[0].args or {}).get(sql_arg)
+
+
+class PlanTemplate:
+    """Parameterized query of a question shape.
+
+    Args:
+        signature (str): normalized question with the slots replaced by {str} or {num}
+        pattern: compiled regex matching the questions of the shape, one group per slot
+        sql (str): BigQuery SQL with __slotN__ markers in place of the slot literals
+        slots (list): per slot, {"kind": "str" | "num", "case": "keep" | "lower" | "upper", "column": compared
+            column or None, "like": the slot is a LIKE pattern}
+    """
+    def __init__(self, signature: str, pattern, sql: str, slots: list):
+        self.signature = signature
+        self.pattern = pattern
+        self.sql = sql
+        self.slots = slots
+        self.hits = 0
+
+
+class PlanCache:
+    """Question templates of the generated queries, in memory and least recently used first out.
+
+    Args:
+        max_size (int): max number of templates
+        ttl (float): seconds a template is served after it was learned
+        session_ttl (float): seconds the template of the latest answer of a session is remembered for the feedback
+        column_values: callable returning the distinct values of a column of the table, None when they are
+            unknown. String slots are only learned and filled for columns with known values.
+        domain_ttl (float): seconds the values of a column are cached
+    """
+    def __init__(self, max_size: int = 512, ttl: float = 24 * 3600, session_ttl: float = 3600, column_values=None,
+                 domain_ttl: float = 3600):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._templates = OrderedDict()
+        self._sessions = TTLCache(max_size=10000, ttl=session_ttl)
+        self._column_values = column_values
+        self._domains = TTLCache(max_size=256, ttl=domain_ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+        self.evictions = {}
+
+    def learn(self, question: str, sql: str):
+        """Stores the query of a question as a template.
+
+        Args:
+            question (str): question from the user
+            sql (str): query that answered it
+
+        Returns:
+            The signature of the template, None when the query can not be parsed, one of
+            its literals is not in the question, maps ambiguously to it or is a string
+            compared to a column with unknown values
+        """
+        import sqlglot
+        from sqlglot import exp
+        try:
+            tree = sqlglot.parse_one(sql, read="bigquery")
+        except sqlglot.errors.SqlglotError:
+            return None
+        text = _normalize(question)
+        slots = []
+        spans = []
+        keys = {}
+        for literal in list(tree.find_all(exp.Literal)):
+            value = literal.this
+            column, like = _compared_column(literal)
+            if literal.is_string:
+                core = value.strip("%")
+                # a one letter code (gender = 'F') can not be located in the question
+                if len(core) < 2:
+                    return None
+                match = re.search(rf"(?<!\w){re.escape(core)}(?!\w)", text, re.IGNORECASE)
+                kind = "str"
+            else:
+                # 0 and 1 compared to a column are flags (is_fraud = 1), fixed by the shape of the question
+                if value in ("0", "1") and column is not None:
+                    continue
+                core = value
+                match = re.search(rf"(?<![\w.]){re.escape(value)}(?![\w.])", text)
+                kind = "num"
+            # a literal that is not in the question comes from somewhere else (the previous
+            # turns, the model's own choice), the query can not be reused for other values
+            if match is None:
+                return None
+            if kind == "str" and (column is None or not self._in_domain(core, column, like)):
+                return None
+            key = (kind, match.group(0).lower())
+            if key not in keys:
+                if any(match.start() < end and start < match.end() for start, end in spans):
+                    return None
+                keys[key] = len(slots)
+                spans.append((match.start(), match.end()))
+                found = match.group(0)
+                case = "lower" if core == core.lower() != found else "upper" if core == core.upper() != found else "keep"
+                slots.append({"kind": kind, "case": case, "column": column, "like": like})
+            elif slots[keys[key]]["column"] != column:
+                # the same value of the question compared to two columns
+                return None
+            prefix, _, suffix = value.partition(core)
+            literal.replace(exp.Literal.string(f"{prefix}__slot{keys[key]}__{suffix}"))
+
+        # question pattern and signature, the slots in the order of the question
+        order = sorted(range(len(slots)), key=lambda index: spans[index][0])
+        pattern, signature, position = "", "", 0
+        for group, index in enumerate(order):
+            start, end = spans[index]
+            pattern += re.escape(text[position:start]).replace(r"\ ", r"\s+") + _SLOT_PATTERNS[slots[index]["kind"]]
+            signature += text[position:start].lower() + "{" + slots[index]["kind"] + "}"
+            position = end
+        pattern += re.escape(text[position:]).replace(r"\ ", r"\s+")
+        signature += text[position:].lower()
+        # the groups of the pattern follow the question order, the slots are renumbered to match
+        renumber = {index: group for group, index in enumerate(order)}
+        template_sql = _SLOT_MARKER.sub(lambda marker: f"__slot{renumber[int(marker.group(1))]}__", tree.sql(dialect="bigquery"))
+        template = PlanTemplate(signature, re.compile(pattern, re.IGNORECASE), template_sql, [slots[index] for index in order])
+        with self._lock:
+            self._templates[signature] = (template, time.monotonic() + self._ttl)
+            self._templates.move_to_end(signature)
+            while len(self._templates) > self._max_size:
+                self._templates.popitem(last=False)
+                self.evictions["size"] = self.evictions.get("size", 0) + 1
+            self.learned += 1
+        logging.info(json.dumps({"event": "plan_cache_learn", "signature": signature, "slots": len(slots)}))
+        return signature
+
+    def lookup(self, question: str):
+        """Query of the template matching the question, filled with its values.
+
+        Returns:
+            (signature, sql), None without a matching template
+        """
+        text = _normalize(question)
+        now = time.monotonic()
+        with self._lock:
+            for signature in [signature for signature, (_, expires_at) in self._templates.items() if expires_at <= now]:
+                del self._templates[signature]
+                self.evictions["expired"] = self.evictions.get("expired", 0) + 1
+            # the most recently used templates first
+            templates = [template for template, _ in reversed(self._templates.values())]
+        for template in templates:
+            match = template.pattern.fullmatch(text)
+            if match is None:
+                continue
+            values = match.groups()
+            if not all(self._valid(value, slot) and self._known(value, slot) for value, slot in zip(values, template.slots)):
+                continue
+            sql = self._fill(template, values)
+            if sql is None:
+                continue
+            with self._lock:
+                if template.signature in self._templates:
+                    self._templates.move_to_end(template.signature)
+                template.hits += 1
+                self.hits += 1
+            return template.signature, sql
+        with self._lock:
+            self.misses += 1
+        return None
+
+    @staticmethod
+    def _valid(value: str, slot: dict) -> bool:
+        if slot["kind"] == "num":
+            return True
+        words = value.lower().split()
+        return 0 < len(words) <= 4 and not (set(words) & _CONJUNCTIONS)
+
+    def _known(self, value: str, slot: dict) -> bool:
+        return slot["kind"] == "num" or self._in_domain(value, slot["column"], slot["like"])
+
+    def _domain(self, column: str):
+        """Lowercased distinct values of the column, None when they are unknown."""
+        domain = self._domains.get(column, _UNKNOWN)
+        if domain is _UNKNOWN:
+            values = None
+            if self._column_values is not None:
+                try:
+                    values = self._column_values(column)
+                except Exception:
+                    logging.exception(f"values of {column} could not be loaded")
+            domain = frozenset(str(value).lower() for value in values) if values is not None else None
+            self._domains.put(column, domain)
+        return domain
+
+    def _in_domain(self, value: str, column: str, like: bool) -> bool:
+        domain = self._domain(column)
+        if domain is None:
+            return False
+        value = value.lower()
+        # a LIKE pattern only has to match one of the values
+        return any(value in known for known in domain) if like else value in domain
+
+    @staticmethod
+    def _fill(template: PlanTemplate, values: tuple):
+        import sqlglot
+        from sqlglot import exp
+        try:
+            tree = sqlglot.parse_one(template.sql, read="bigquery")
+        except sqlglot.errors.SqlglotError:
+            return None
+        for literal in list(tree.find_all(exp.Literal)):
+            marker = _SLOT_MARKER.search(literal.this) if literal.is_string else None
+            if marker is None:
+                continue
+            index = int(marker.group(1))
+            slot = template.slots[index]
+            value = values[index]
+            if slot["kind"] == "num":
+                literal.replace(exp.Literal.number(value))
+                continue
+            value = value.lower() if slot["case"] == "lower" else value.upper() if slot["case"] == "upper" else value
+            literal.replace(exp.Literal.string(literal.this[:marker.start()] + value + literal.this[marker.end():]))
+        return tree.sql(dialect="bigquery")
+
+    def evict(self, signature: str, reason: str) -> bool:
+        """Removes a template, returns False when it was already gone."""
+        with self._lock:
+            removed = self._templates.pop(signature, None) is not None
+            if removed:
+                self.evictions[reason] = self.evictions.get(reason, 0) + 1
+        if removed:
+            logging.info(json.dumps({"event": "plan_cache_evict", "signature": signature, "reason": reason}))
+        return removed
+
+    def remember(self, session_id: str, signature: str = None):
+        """Template behind the latest answer of a session (None when no template was involved)."""
+        if session_id:
+            self._sessions.put(session_id, signature or "")
+
+    def evict_session(self, session_id: str, reason: str = "negative feedback") -> bool:
+        """Removes the template behind the latest answer of the session, e.g. on negative feedback."""
+        signature = self._sessions.pop(session_id) if session_id else None
+        return bool(signature) and self.evict(signature, reason)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        with self._lock:
+            return {
+                "size": len(self._templates),
+                "max_size": self._max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "learned": self.learned,
+                "evictions": dict(self.evictions),
+            }
@@ -0,0 +1,255 @@
+import re
+import logging
+import threading
+import traceback
+
+import sqlalchemy
+
+from caches.lru import TTLCache
+
+# semantic cache of final answers: the question is embedded and the closest cached
+# question in the same language is reused when it is similar enough and was answered
+# on the same version of the data and documents.
+MAX_VECTOR_INDEX_DIM = 2000
+
+_INDONESIAN_WORDS = {
+    "yang", "dan", "di", "ke", "dari", "berapa", "apa", "apakah", "bagaimana", "siapa", "kapan", "mengapa",
+    "kenapa", "total", "jumlah", "transaksi", "kerugian", "penipuan", "untuk", "dengan", "pada", "adalah",
+    "ini", "itu", "tersebut", "bulan", "tahun", "tertinggi", "terbanyak", "rata", "paling", "sebutkan",
+    "jelaskan", "tampilkan", "berikan", "saya", "kami", "tidak", "ada", "dalam", "menurut", "laporan",
+}
+_ENGLISH_WORDS = {
+    "the", "and", "of", "in", "to", "what", "how", "which", "who", "when", "why", "is", "are", "was", "were",
+    "total", "amount", "transactions", "loss", "losses", "fraud", "for", "with", "on", "by", "most", "common",
+    "highest", "average", "show", "list", "give", "explain", "according", "report", "month", "year", "me",
+}
+
+
+def detect_language(text: str) -> str:
+    """Returns "id" for Bahasa Indonesia and "en" otherwise, based on common words."""
+    words = re.findall(r"[a-zA-Z]+", text.lower())
+    indonesian = sum(word in _INDONESIAN_WORDS for word in words)
+    english = sum(word in _ENGLISH_WORDS for word in words)
+    return "id" if indonesian > english else "en"
+
+
+def is_context_free(question: str, history_length: int) -> bool:
+    """True when the answer to the question does not depend on the previous turns.
+
+    Only the first question of a conversation qualifies: elliptical follow-ups ("and in
+    2019?", "what about shopping_net?", "bagaimana dengan kategori travel?") carry no
+    reference word and can not be told apart from a new question by their wording.
+    """
+    return history_length == 0
+
+
+def question_terms(question: str, known_terms=()) -> frozenset:
+    """Values a cached answer depends on: numbers and years, quoted text, snake_case
+    identifiers (shopping_net) and the known terms (categories, states) found in the question.
+
+    Two questions with different terms are never answered from each other, however close
+    their embeddings are ("total fraud in 2019" and "total fraud in 2020").
+    """
+    terms = {number.replace(",", "") for number in re.findall(r"(?<![\w.])\d+(?:[.,]\d+)*", question)}
+    terms.update(quoted.strip().lower() for quoted in re.findall(r"[\"'`]([^\"'`]+)[\"'`]", question))
+    terms.update(word.lower() for word in re.findall(r"\b[A-Za-z0-9]+(?:_[A-Za-z0-9]+)+\b", question))
+    for term in known_terms:
+        # short upper case codes (CA, IN) are matched as written, "in" is not Indiana
+        flags = 0 if term.isupper() and len(term) <= 3 else re.IGNORECASE
+        if re.search(rf"(?<!\w){re.escape(term)}(?!\w)", question, flags):
+            terms.add(term.lower())
+    return frozenset(terms)
+
+
+class SemanticAnswerCache:
+    """pgvector table of answered questions, looked up by cosine similarity.
+
+    Args:
+        engine: sqlalchemy engine of the postgres instance with pgvector
+        embeddings: embeddings used for the questions (the cached query embeddings)
+        data_version: callable returning the current version of the data and documents,
+            entries written on another version are never served
+        threshold (float): minimum cosine similarity for a hit
+        embedding_dim (int): dimension of the embeddings
+        ttl (float): max age in seconds of a served entry
+        table_name (str): name of the cache table
+        known_terms: callable returning the values (categories, states) a question may name, they
+            must be the same in the question and the cached question. Cached for an hour.
+        candidates (int): number of nearest questions checked for matching terms
+    """
+    def __init__(self, engine, embeddings, data_version, threshold: float = 0.95, embedding_dim: int = 3072, ttl: float = 7 * 24 * 3600, table_name: str = "semantic_answer_cache",
+                 known_terms=None, candidates: int = 5):
+        self._engine = engine
+        self._embeddings = embeddings
+        self._data_version = data_version
+        self._threshold = threshold
+        self._embedding_dim = embedding_dim
+        self._ttl = ttl
+        self._table_name = table_name
+        self._known_terms = known_terms
+        self._known_terms_cache = TTLCache(max_size=1, ttl=3600)
+        self._candidates = candidates
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.term_mismatches = 0
+        self.stores = 0
+        self._served_age_total = 0.0
+        self._served_age_max = 0.0
+        self._create_table()
+
+    @property
+    def vector_type(self) -> str:
+        if self._embedding_dim <= MAX_VECTOR_INDEX_DIM:
+            return f"vector({self._embedding_dim})"
+        return f"halfvec({self._embedding_dim})"
+
+    def _create_table(self):
+        ops = "halfvec_cosine_ops" if self.vector_type.startswith("halfvec") else "vector_cosine_ops"
+        with self._engine.connect() as db_conn:
+            db_conn.execute(sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS vector"))
+            db_conn.execute(sqlalchemy.text(f"""
+                CREATE TABLE IF NOT EXISTS {self._table_name} (
+                    id BIGSERIAL PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    language TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    data_version TEXT NOT NULL,
+                    embedding {self.vector_type} NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )"""))
+            db_conn.execute(sqlalchemy.text(f"""
+                CREATE INDEX IF NOT EXISTS ix_{self._table_name}_embedding
+                ON {self._table_name} USING hnsw (embedding {ops})"""))
+            db_conn.commit()
+
+    def lookup(self, question: str):
+        """Returns the cached answer of a similar question with the same terms or None.
+
+        Returns:
+            None on a miss, otherwise a dictionary with answer, question, similarity and age (seconds).
+        """
+        language = detect_language(question)
+        embedding = _vector_literal(self._embeddings.embed_query(question))
+        # expired entries are filtered in the query, they never shadow a newer duplicate
+        select_answers = sqlalchemy.text(f"""
+            SELECT id, question, answer, data_version, 1 - (embedding <=> CAST(:embedding AS {self.vector_type})) AS similarity,
+                EXTRACT(EPOCH FROM now() - created_at) AS age
+            FROM {self._table_name}
+            WHERE language = :language AND created_at > now() - make_interval(secs => :ttl)
+            ORDER BY embedding <=> CAST(:embedding AS {self.vector_type})
+            LIMIT :candidates""")
+        with self._engine.connect() as db_conn:
+            rows = db_conn.execute(select_answers, {
+                "embedding": embedding,
+                "language": language,
+                "ttl": self._ttl,
+                "candidates": self._candidates,
+            }).fetchall()
+            rows = [row for row in rows if row[4] >= self._threshold]
+            if not rows:
+                self._count("misses")
+                return None
+            data_version = self._data_version()
+            if any(row[3] != data_version for row in rows):
+                # similar questions answered on older data or documents, the old entries are dropped
+                self._count("stale")
+                db_conn.execute(
+                    sqlalchemy.text(f"DELETE FROM {self._table_name} WHERE data_version <> :data_version"),
+                    {"data_version": data_version}
+                )
+                db_conn.commit()
+                rows = [row for row in rows if row[3] == data_version]
+            known_terms = self._terms()
+            terms = question_terms(question, known_terms)
+            row = next((row for row in rows if question_terms(row[1], known_terms) == terms), None)
+            if row is None:
+                if rows:
+                    # same shape of question about another year, number or category
+                    self._count("term_mismatches")
+                self._count("misses")
+                return None
+            db_conn.execute(sqlalchemy.text(f"UPDATE {self._table_name} SET hits = hits + 1 WHERE id = :id"), {"id": row[0]})
+            db_conn.commit()
+        age = float(row[5])
+        with self._lock:
+            self.hits += 1
+            self._served_age_total += age
+            self._served_age_max = max(self._served_age_max, age)
+        return {"answer": row[2], "question": row[1], "similarity": float(row[4]), "age": age}
+
+    def _terms(self) -> list:
+        terms = self._known_terms_cache.get("terms")
+        if terms is None:
+            terms = []
+            if self._known_terms is not None:
+                try:
+                    terms = [str(term) for term in self._known_terms() or []]
+                except Exception:
+                    logging.exception(str(traceback.format_exc()))
+            # nothing known yet (the mirror is still loading), asked again on the next lookup
+            if terms or self._known_terms is None:
+                self._known_terms_cache.put("terms", terms)
+        return terms
+
+    def store(self, question: str, answer: str):
+        insert_answer = sqlalchemy.text(f"""
+            INSERT INTO {self._table_name} (question, language, answer, data_version, embedding)
+            VALUES (:question, :language, :answer, :data_version, CAST(:embedding AS {self.vector_type}))""")
+        with self._engine.connect() as db_conn:
+            db_conn.execute(insert_answer, {
+                "question": question,
+                "language": detect_language(question),
+                "answer": answer,
+                "data_version": self._data_version(),
+                "embedding": _vector_literal(self._embeddings.embed_query(question)),
+            })
+            db_conn.commit()
+        self._count("stores")
+
+    def invalidate(self) -> int:
+        """Deletes the entries written on another data version or expired, returns the number of deleted entries."""
+        with self._engine.connect() as db_conn:
+            result = db_conn.execute(
+                sqlalchemy.text(f"DELETE FROM {self._table_name} WHERE data_version <> :data_version OR created_at <= now() - make_interval(secs => :ttl)"),
+                {"data_version": self._data_version(), "ttl": self._ttl}
+            )
+            db_conn.commit()
+        return result.rowcount
+
+    def safe_lookup(self, question: str):
+        # the cache is best effort, a failure never fails the question
+        try:
+            return self.lookup(question)
+        except Exception:
+            logging.exception(str(traceback.format_exc()))
+            return None
+
+    def safe_store(self, question: str, answer: str):
+        try:
+            self.store(question, answer)
+        except Exception:
+            logging.exception(str(traceback.format_exc()))
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "term_mismatches": self.term_mismatches,
+            "stores": self.stores,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "served_age_avg_seconds": self._served_age_total / self.hits if self.hits else 0.0,
+            "served_age_max_seconds": self._served_age_max,
+        }
+
+
+def _vector_literal(embedding: list) -> str:
+    return "[" + ",".join(str(float(value)) for value in embedding) + "]"
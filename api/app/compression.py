@@ -0,0 +1,176 @@
+import re
+import threading
+
+from memory import estimate_tokens
+
+# post-retrieval stage between the retriever and the model: near-duplicate chunks are
+# dropped, chunks of adjacent pages of the same document are merged, only the sentences
+# relevant to the question are kept and the result is trimmed to a token budget. The
+# document_name / document_page citations are kept on every passage.
+_STOP_WORDS = {
+    "a", "an", "the", "and", "or", "of", "in", "on", "to", "for", "by", "with", "is", "are", "was", "were", "be",
+    "what", "which", "who", "how", "why", "when", "does", "do", "did", "according", "based", "report", "document",
+    "yang", "dan", "di", "ke", "dari", "apa", "apakah", "bagaimana", "berapa", "siapa", "menurut", "pada", "untuk",
+    "dengan", "adalah", "ini", "itu", "dalam", "laporan", "dokumen",
+}
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def _words(text: str) -> list:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def _stem(word: str) -> str:
+    # crude suffix stripping, enough to match "fraudulent"/"fraud" or "cards"/"card"
+    for suffix in ("ulent", "ing", "ion", "ed", "es", "s"):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+
+def _split_sentences(text: str) -> list:
+    return [sentence.strip() for sentence in _SENTENCE_SPLIT.split(text) if sentence.strip()]
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = _words(text)
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _page_number(page):
+    try:
+        return int(page)
+    except (TypeError, ValueError):
+        return None
+
+
+class ContextCompressor:
+    """Compresses the passages returned by the retriever.
+
+    Args:
+        token_budget (int): max estimated tokens of all passages together
+        duplicate_threshold (float): word 3-gram Jaccard similarity above which a passage is a duplicate
+        max_sentences (int): max sentences kept per passage
+    """
+    def __init__(self, token_budget: int = 800, duplicate_threshold: float = 0.8, max_sentences: int = 6):
+        self._token_budget = token_budget
+        self._duplicate_threshold = duplicate_threshold
+        self._max_sentences = max_sentences
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.duplicates = 0
+        self.merged = 0
+
+    def deduplicate(self, results: list) -> list:
+        """Drops passages too similar to a better ranked one."""
+        kept = []
+        kept_shingles = []
+        for result in results:
+            shingles = _shingles(result["page_content"])
+            if any(_jaccard(shingles, other) >= self._duplicate_threshold for other in kept_shingles):
+                self._count("duplicates")
+                continue
+            kept.append(result)
+            kept_shingles.append(shingles)
+        return kept
+
+    def merge_adjacent(self, results: list) -> list:
+        """Merges passages of the same or adjacent pages of a document into the best ranked one."""
+        merged = []
+        for result in results:
+            page = _page_number(result["document_page"])
+            target = None
+            for passage in merged:
+                if passage["document_name"] == result["document_name"] and page is not None and any(
+                    abs(page - other) <= 1 for other in passage["pages"]
+                ):
+                    target = passage
+                    break
+            if target is None:
+                merged.append({**result, "pages": [page] if page is not None else []})
+                continue
+            self._count("merged")
+            # sentences already in the passage (overlap of adjacent chunks) are not repeated
+            existing = set(_split_sentences(target["page_content"]))
+            extra = [sentence for sentence in _split_sentences(result["page_content"]) if sentence not in existing]
+            if page < min(target["pages"]):
+                target["page_content"] = " ".join(extra + [target["page_content"]])
+            else:
+                target["page_content"] = " ".join([target["page_content"]] + extra)
+            target["pages"].append(page)
+        for passage in merged:
+            pages = sorted(set(passage.pop("pages")))
+            if len(pages) > 1:
+                passage["document_page"] = f"{pages[0]}-{pages[-1]}"
+        return merged
+
+    def extract(self, question: str, text: str) -> str:
+        """Keeps the sentences sharing terms with the question, in their original order.
+
+        When no sentence matches (e.g. the question is in another language than the
+        document) the first sentences are kept.
+        """
+        terms = {_stem(word) for word in _words(question) if word not in _STOP_WORDS}
+        sentences = _split_sentences(text)
+        scored = [(len(terms & {_stem(word) for word in _words(sentence)}), index) for index, sentence in enumerate(sentences)]
+        relevant = sorted(index for score, index in sorted(scored, key=lambda item: (-item[0], item[1]))[:self._max_sentences] if score > 0)
+        if not relevant:
+            relevant = list(range(min(len(sentences), self._max_sentences)))
+        return " ".join(sentences[index] for index in relevant)
+
+    def trim(self, passages: list) -> list:
+        """Keeps the passages in rank order until the token budget is used, the last one is cut."""
+        trimmed = []
+        remaining = self._token_budget
+        for passage in passages:
+            tokens = estimate_tokens(passage["page_content"])
+            if tokens <= remaining:
+                trimmed.append(passage)
+                remaining -= tokens
+                continue
+            if remaining > 50:
+                # about 4 characters per token, cut on a word boundary
+                content = passage["page_content"][:remaining * 4].rsplit(" ", 1)[0]
+                trimmed.append({**passage, "page_content": content + " ..."})
+            break
+        return trimmed
+
+    def compress(self, question: str, results: list) -> list:
+        """Runs deduplication, merging, sentence extraction and trimming.
+
+        Args:
+            question (str): question given to the retriever
+            results (list): dictionaries with page_content, document_name and document_page, best first
+
+        Returns:
+            The compressed passages in the same format.
+        """
+        tokens_in = sum(estimate_tokens(result["page_content"]) for result in results)
+        passages = self.merge_adjacent(self.deduplicate(results))
+        passages = [{**passage, "page_content": self.extract(question, passage["page_content"])} for passage in passages]
+        passages = self.trim(passages)
+        with self._lock:
+            self.calls += 1
+            self.tokens_in += tokens_in
+            self.tokens_out += sum(estimate_tokens(passage["page_content"]) for passage in passages)
+        return passages
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "reduction": 1 - self.tokens_out / self.tokens_in if self.tokens_in else 0.0,
+            "duplicates": self.duplicates,
+            "merged": self.merged,
+        }
@@ -0,0 +1,37 @@
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# bounded pool for blocking I/O (GCS, BigQuery, pgvector, embeddings) so the event loop
+# never blocks and the number of threads stays fixed however many requests are in flight
+BLOCKING_WORKERS = int(os.environ.get("BLOCKING_WORKERS", "64"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking function on the bounded executor and awaits the result.
+
+    The context variables of the caller (e.g. the session id) are visible inside func.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def offload(func):
+    """Wraps a blocking function into a coroutine function running on the bounded executor.
+
+    The wrapper keeps the name, signature and docstring of the function so it can be
+    passed to the model as a tool.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -1,18 +1,91 @@
 import os
+import time
+import asyncio
+import logging
+import datetime
 import threading
 import sqlalchemy
 from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 
 import google.auth
 from google.auth.transport.requests import Request
 from google.cloud.sql.connector import Connector
 
+# IAM tokens are refreshed in the background this long before they expire, so connect never waits on it
+IAM_REFRESH_MARGIN = 300
+# async driver used with the Cloud SQL connector, psycopg uses its own async mode over the unix socket
+ASYNC_CONNECTOR_DRIVER = "asyncpg"
+
+class PoolMetrics:
+  """Checkout waits of a connection pool, the pool itself only knows its current size."""
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.waiting = 0
+    self.checkouts = 0
+    self.timeouts = 0
+    self.wait_seconds_total = 0.0
+    self.wait_seconds_max = 0.0
+
+  def start_wait(self):
+    with self._lock:
+      self.waiting += 1
+
+  def cancel_wait(self):
+    with self._lock:
+      self.waiting -= 1
+
+  def end_wait(self, seconds: float, timed_out: bool = False):
+    with self._lock:
+      self.waiting -= 1
+      if timed_out:
+        self.timeouts += 1
+        return
+      self.checkouts += 1
+      self.wait_seconds_total += seconds
+      self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+  def stats(self) -> dict:
+    return {
+      "waiting": self.waiting,
+      "checkouts": self.checkouts,
+      "timeouts": self.timeouts,
+      "checkout_wait_avg_seconds": self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+      "checkout_wait_max_seconds": self.wait_seconds_max,
+    }
+
+sync_pool_metrics = PoolMetrics()
+async_pool_metrics = PoolMetrics()
+
+def _timed_checkout(metrics: PoolMetrics, do_get):
+  start = time.perf_counter()
+  metrics.start_wait()
+  try:
+    connection = do_get()
+  except sqlalchemy.exc.TimeoutError:
+    metrics.end_wait(time.perf_counter() - start, timed_out=True)
+    raise
+  except BaseException:
+    metrics.cancel_wait()
+    raise
+  metrics.end_wait(time.perf_counter() - start)
+  return connection
+
+# the metrics live outside the pool because sqlalchemy recreates pools on dispose
+class InstrumentedQueuePool(QueuePool):
+  def _do_get(self):
+    return _timed_checkout(sync_pool_metrics, super()._do_get)
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+  def _do_get(self):
+    return _timed_checkout(async_pool_metrics, super()._do_get)
+
 class CloudSQLPostgresConnector:
   _instance: "CloudSQLPostgresConnector" = None
   _iam_creds = None
   _lock = threading.Lock()
 
-  def __new__(cls, instance_name, user, password, database="postgres", driver="pg8000") -> "CloudSQLPostgresConnector":
+  def __new__(cls, instance_name, user, password, database="postgres", driver="pg8000", pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800) -> "CloudSQLPostgresConnector":
     with cls._lock:
       if cls._instance is None:
         cls._instance = super().__new__(cls)
@@ -24,13 +97,25 @@ class CloudSQLPostgresConnector:
         cls._instance._password = password
         cls._instance._database = database
         cls._instance._driver = driver
+        cls._instance._pool_options = {
+          "pool_size": pool_size,
+          "max_overflow": max_overflow,
+          "pool_timeout": pool_timeout,
+          "pool_recycle": pool_recycle,
+        }
         cls._instance._connector = None
+        cls._instance._async_connector = None
+        cls._instance._async_engine = None
+        cls._instance._async_lock = None
+        cls._instance._refresh_stop = threading.Event()
         if driver != "psycopg":
           cls._instance._connector = Connector()
+        else:
+          cls._start_iam_refresh()
         cls._instance._engine = cls.__create_engine(driver)
 
     return cls._instance
-  
+
   def get_driver(self):
     return self._instance._driver
 
@@ -38,8 +123,31 @@ class CloudSQLPostgresConnector:
     if self._instance._engine is None:
       raise RuntimeError("The engine has been disposed. Please recreate it.")
     return self._instance._engine
-  
+
+  async def get_async_engine(self):
+    """Returns the async engine of the same instance, created on first use.
+
+    The engine is bound to the running event loop, asyncpg through the Cloud SQL connector
+    or psycopg async over the unix socket.
+    """
+    instance = self._instance
+    if instance._async_engine is None:
+      if instance._async_lock is None:
+        instance._async_lock = asyncio.Lock()
+      async with instance._async_lock:
+        if instance._async_engine is None:
+          instance._async_engine = await self.__create_async_engine(instance._driver)
+    return instance._async_engine
+
+  def pool_stats(self) -> dict:
+    """Size of the pools and their checkout waits."""
+    stats = {"sync": self.__pool_status(self._instance._engine, sync_pool_metrics)}
+    if self._instance._async_engine is not None:
+      stats["async"] = self.__pool_status(self._instance._async_engine.sync_engine, async_pool_metrics)
+    return stats
+
   def close(self):
+    self._instance._refresh_stop.set()
     if self._instance._engine:
       self._instance._engine.dispose()
       self._instance._engine = None
@@ -47,19 +155,67 @@ class CloudSQLPostgresConnector:
     if self._instance._connector:
       self._instance._connector.close()
       self._instance._connector = None
-  
+
+  async def close_async(self):
+    if self._instance._async_engine:
+      await self._instance._async_engine.dispose()
+      self._instance._async_engine = None
+
+    if self._instance._async_connector:
+      await self._instance._async_connector.close_async()
+      self._instance._async_connector = None
+
   def connect(self):
     with self._lock:
       driver = self._instance._driver
       if driver != "psycopg":
         self._instance._connector = Connector()
+      else:
+        self._instance._refresh_stop = threading.Event()
+        self._start_iam_refresh()
       self._instance._engine = self.__create_engine(driver)
 
+  @staticmethod
+  def __pool_status(engine, metrics: PoolMetrics) -> dict:
+    pool = engine.pool
+    return {
+      "size": pool.size(),
+      "checked_out": pool.checkedout(),
+      "checked_in": pool.checkedin(),
+      "overflow": pool.overflow(),
+      **metrics.stats(),
+    }
+
+  @classmethod
+  def _refresh_iam_token(cls):
+    request = Request()
+    cls._iam_creds.refresh(request)
+
+  @classmethod
+  def _start_iam_refresh(cls):
+    # refreshes the IAM token before it expires so connect only reads it
+    stop = cls._instance._refresh_stop
+    def refresh():
+      while True:
+        try:
+          expiry = cls._iam_creds.expiry
+          remaining = (expiry - datetime.datetime.utcnow()).total_seconds() if expiry else 0
+          if not cls._iam_creds.valid or remaining < IAM_REFRESH_MARGIN:
+            cls._refresh_iam_token()
+            expiry = cls._iam_creds.expiry
+            remaining = (expiry - datetime.datetime.utcnow()).total_seconds() if expiry else 0
+        except Exception:
+          logging.exception("IAM token refresh failed")
+          remaining = IAM_REFRESH_MARGIN + 60
+        if stop.wait(max(remaining - IAM_REFRESH_MARGIN, 30)):
+          return
+    threading.Thread(target=refresh, name="cloudsql-iam-refresh", daemon=True).start()
+
   @classmethod
   def __auto_iam_authn(cls, **kwargs):
+    # the refresh thread keeps the token valid, this is only the fallback
     if not cls._iam_creds.valid:
-      request = Request()
-      cls._iam_creds.refresh(request)
+      cls._refresh_iam_token()
 
     kwargs["cparams"]["password"] = str(cls._iam_creds.token)
 
@@ -74,11 +230,11 @@ class CloudSQLPostgresConnector:
       password=cls._instance._password,
       db=cls._instance._database
     )
-  
+
   @classmethod
-  def __create_engine(cls, driver) -> sqlalchemy.engine.base.Engine:
-    conn_uri = sqlalchemy.engine.url.URL(
-      drivername=f"postgresql+{driver}",
+  def __conn_uri(cls, drivername: str):
+    return sqlalchemy.engine.url.URL(
+      drivername=drivername,
       username=cls._instance._user,
       password=cls._instance._password,
       host=None,
@@ -88,12 +244,49 @@ class CloudSQLPostgresConnector:
         "host": f"{os.getenv('CLOUD_SQL_UNIX_SOCKET_ROOT', '/cloudsql')}/{cls._instance._instance_name}"
       },
     )
+
+  @classmethod
+  def __create_engine(cls, driver) -> sqlalchemy.engine.base.Engine:
     engine = sqlalchemy.create_engine(
-      url=conn_uri,
-      pool_pre_ping=True
+      url=cls.__conn_uri(f"postgresql+{driver}"),
+      pool_pre_ping=True,
+      poolclass=InstrumentedQueuePool,
+      **cls._instance._pool_options
     )
     if driver == "psycopg":
       event.listen(engine, "do_connect", cls.__auto_iam_authn, named=True)
     else:
       event.listen(engine, "do_connect", cls.__getconn, named=True)
-    return engine
\ No newline at end of file
+    return engine
+
+  @classmethod
+  async def __create_async_engine(cls, driver):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    if driver == "psycopg":
+      engine = create_async_engine(
+        cls.__conn_uri("postgresql+psycopg"),
+        pool_pre_ping=True,
+        poolclass=InstrumentedAsyncQueuePool,
+        **cls._instance._pool_options
+      )
+      event.listen(engine.sync_engine, "do_connect", cls.__auto_iam_authn, named=True)
+      return engine
+
+    from google.cloud.sql.connector import create_async_connector
+    cls._instance._async_connector = await create_async_connector()
+
+    async def getconn():
+      return await cls._instance._async_connector.connect_async(
+        cls._instance._instance_name,
+        ASYNC_CONNECTOR_DRIVER,
+        user=cls._instance._user,
+        password=cls._instance._password,
+        db=cls._instance._database
+      )
+    return create_async_engine(
+      f"postgresql+{ASYNC_CONNECTOR_DRIVER}://",
+      async_creator=getconn,
+      pool_pre_ping=True,
+      poolclass=InstrumentedAsyncQueuePool,
+      **cls._instance._pool_options
+    )
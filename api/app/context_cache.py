@@ -0,0 +1,108 @@
+import time
+import logging
+import threading
+import traceback
+
+from google.genai import types
+
+# static prompt content (system instruction, schema, document summaries and the tool
+# declarations) pinned once in a Gemini context cache so it is not sent and billed in
+# full on every turn. When the cache can not be created (e.g. the content is below the
+# minimum cached size of the model) the same content is sent inline instead.
+
+
+class StaticContextCache:
+    """Explicit Gemini context cache of the static part of the prompt.
+
+    Args:
+        client: google-genai client
+        model_name (str): model the cache is created for, a cache only works with its model
+        system_instruction (str): static system instruction including the pinned context
+        tools (list): python functions declared to the model
+        ttl (int): lifetime of the cache in seconds, it is extended before it expires
+        display_name (str): name of the cache in the console
+    """
+    def __init__(self, client, model_name: str, system_instruction: str, tools: list, ttl: int = 3600, display_name: str = "fraud-agent-static-context"):
+        self._client = client
+        self._model_name = model_name
+        self._system_instruction = system_instruction
+        self._tools = tools
+        self._ttl = ttl
+        self._display_name = display_name
+        self._cache_name = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @property
+    def cache_name(self):
+        # a cache close to expiry is not handed out anymore, the refresh thread extends it
+        if self._cache_name is not None and time.time() < self._expires_at - 60:
+            return self._cache_name
+        return None
+
+    def _tool_declarations(self) -> list:
+        return [types.Tool(function_declarations=[
+            types.FunctionDeclaration.from_callable(client=self._client, callable=tool) for tool in self._tools
+        ])]
+
+    def create(self):
+        """Creates the context cache, or extends the existing one."""
+        with self._lock:
+            if self._cache_name is None:
+                cache = self._client.caches.create(
+                    model=self._model_name,
+                    config=types.CreateCachedContentConfig(
+                        display_name=self._display_name,
+                        system_instruction=self._system_instruction,
+                        tools=self._tool_declarations(),
+                        ttl=f"{self._ttl}s"
+                    )
+                )
+                self._cache_name = cache.name
+                logging.info(f"context cache {cache.name} created for {self._model_name}")
+            else:
+                self._client.caches.update(
+                    name=self._cache_name,
+                    config=types.UpdateCachedContentConfig(ttl=f"{self._ttl}s")
+                )
+            self._expires_at = time.time() + self._ttl
+
+    def safe_create(self) -> bool:
+        try:
+            self.create()
+            return True
+        except Exception:
+            # the cache might be gone (deleted or expired), start over on the next attempt
+            logging.warning(f"context cache not available, the static context is sent inline: {traceback.format_exc()}")
+            self._cache_name = None
+            return False
+
+    def start_refresh(self):
+        """Starts a daemon thread extending the cache before it expires."""
+        def refresh():
+            while not self._stop.wait(max(self._ttl / 2, 60)):
+                self.safe_create()
+        threading.Thread(target=refresh, name="context-cache-refresh", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def generate_config(self, **kwargs) -> types.GenerateContentConfig:
+        """Config of a request using the cache, or carrying the static context inline.
+
+        Function calls are always executed by our agent loop.
+        """
+        afc = types.AutomaticFunctionCallingConfig(disable=True)
+        cache_name = self.cache_name
+        if cache_name is not None:
+            return types.GenerateContentConfig(cached_content=cache_name, automatic_function_calling=afc, **kwargs)
+        return types.GenerateContentConfig(
+            system_instruction=self._system_instruction,
+            tools=self._tools,
+            automatic_function_calling=afc,
+            **kwargs
+        )
+
+    def stats(self) -> dict:
+        return {"cache_name": self.cache_name, "expires_at": self._expires_at or None}
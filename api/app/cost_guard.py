@@ -0,0 +1,159 @@
+import json
+import logging
+import threading
+
+from caches.lru import TTLCache
+
+# pre-execution guard for the SQL written by the model: every query going to BigQuery
+# is estimated first (dry run) and rejected back to the model when it is over the
+# per-query or per-session byte budget, so the model can rewrite it.
+
+
+class QueryBudgetExceeded(Exception):
+    """The query is over budget, the message is meant to be returned to the model."""
+
+
+class CostEstimate:
+    def __init__(self, bytes_processed: int, tables: list):
+        self.bytes_processed = bytes_processed
+        self.tables = tables
+
+
+class BigQueryEstimator:
+    """Estimates a query with a BigQuery dry run, free and does not run the query."""
+    def __init__(self, bigquery_client=None):
+        self._client = bigquery_client
+
+    def estimate(self, sql: str) -> CostEstimate:
+        from google.cloud import bigquery
+        if self._client is None:
+            from warehouse import get_bigquery_client
+            self._client = get_bigquery_client()
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        query_job = self._client.query(sql, job_config=job_config)
+        tables = [f"{table.project}.{table.dataset_id}.{table.table_id}" for table in query_job.referenced_tables or []]
+        return CostEstimate(query_job.total_bytes_processed or 0, tables)
+
+
+class LocalEstimator:
+    """Offline stand-in for the dry run, used for tests and local runs.
+
+    BigQuery bills the full size of every referenced column, so the estimate is the sum
+    of the sizes of the columns used by the query (all columns for SELECT *).
+
+    Args:
+        column_bytes (dict): fully qualified table -> {column: size in bytes}
+    """
+    def __init__(self, column_bytes: dict):
+        self._column_bytes = column_bytes
+
+    @classmethod
+    def from_parquet(cls, parquet_path: str, table_id: str) -> "LocalEstimator":
+        """Builds the column sizes from the uncompressed sizes in a parquet file metadata."""
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(parquet_path).metadata
+        column_bytes = {}
+        for row_group in range(metadata.num_row_groups):
+            for column in range(metadata.num_columns):
+                chunk = metadata.row_group(row_group).column(column)
+                name = chunk.path_in_schema.split(".")[0]
+                column_bytes[name] = column_bytes.get(name, 0) + chunk.total_uncompressed_size
+        return cls({table_id: column_bytes})
+
+    def estimate(self, sql: str) -> CostEstimate:
+        import sqlglot
+        from sqlglot import exp
+        tree = sqlglot.parse_one(sql, read="bigquery")
+        tables = []
+        for table in tree.find_all(exp.Table):
+            table_id = ".".join(part for part in (table.catalog, table.db, table.name) if part)
+            if table_id in self._column_bytes and table_id not in tables:
+                tables.append(table_id)
+        select_star = tree.find(exp.Star) is not None and not any(isinstance(star.parent, exp.Count) for star in tree.find_all(exp.Star))
+        columns = {column.name for column in tree.find_all(exp.Column)}
+        bytes_processed = 0
+        for table_id in tables:
+            for column, size in self._column_bytes[table_id].items():
+                if select_star or column in columns:
+                    bytes_processed += size
+        return CostEstimate(bytes_processed, tables)
+
+
+class CostGuard:
+    """Enforces per-query and per-session byte budgets on generated SQL.
+
+    Args:
+        estimator: BigQueryEstimator or LocalEstimator
+        max_bytes_per_query (int): largest scan allowed for a single query
+        max_bytes_per_session (int): total scan allowed for a chat session
+        session_ttl (float): seconds after which the usage of an idle session is forgotten
+    """
+    def __init__(self, estimator, max_bytes_per_query: int, max_bytes_per_session: int, session_ttl: float = 24 * 3600):
+        self._estimator = estimator
+        self._max_bytes_per_query = max_bytes_per_query
+        self._max_bytes_per_session = max_bytes_per_session
+        self._session_usage = TTLCache(max_size=10000, ttl=session_ttl)
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+
+    def session_usage(self, session_id: str) -> int:
+        return self._session_usage.get(session_id, 0) if session_id else 0
+
+    def check(self, sql: str, session_id: str = None) -> CostEstimate:
+        """Estimates the query and raises QueryBudgetExceeded when it is over budget.
+
+        The estimate is charged to the session budget when the query is accepted.
+        """
+        estimate = self._estimator.estimate(sql)
+        with self._lock:
+            used = self.session_usage(session_id)
+            decision = "accepted"
+            message = None
+            if estimate.bytes_processed > self._max_bytes_per_query:
+                decision = "rejected_query_budget"
+                message = (
+                    f"Query rejected: it would scan {format_bytes(estimate.bytes_processed)}, above the per-query limit of "
+                    f"{format_bytes(self._max_bytes_per_query)}. Rewrite it to scan less data: select only the columns you need "
+                    f"instead of SELECT *, add WHERE filters, aggregate in SQL (SUM, COUNT, GROUP BY) and avoid cross joins."
+                )
+            elif session_id and used + estimate.bytes_processed > self._max_bytes_per_session:
+                decision = "rejected_session_budget"
+                message = (
+                    f"Query rejected: this conversation already scanned {format_bytes(used)} and this query would scan "
+                    f"{format_bytes(estimate.bytes_processed)}, above the session limit of {format_bytes(self._max_bytes_per_session)}. "
+                    f"Answer with the data already retrieved or use a much narrower query (fewer columns, stronger filters, aggregates)."
+                )
+            if message is not None:
+                self.rejected += 1
+            else:
+                self.accepted += 1
+                if session_id:
+                    self._session_usage.put(session_id, used + estimate.bytes_processed)
+        # one log line per decision so the limits can be tuned from the logs
+        logging.info(json.dumps({
+            "event": "query_cost_guard",
+            "decision": decision,
+            "session_id": session_id,
+            "bytes_processed": estimate.bytes_processed,
+            "session_bytes": used,
+            "tables": estimate.tables,
+        }))
+        if message is not None:
+            raise QueryBudgetExceeded(message)
+        return estimate
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "max_bytes_per_query": self._max_bytes_per_query,
+            "max_bytes_per_session": self._max_bytes_per_session,
+        }
+
+
+def format_bytes(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1024 or unit == "TB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
@@ -0,0 +1,227 @@
+import time
+import uuid
+import queue
+import logging
+import argparse
+import threading
+import traceback
+from datetime import datetime, timezone
+
+# append-only event pipeline of the chat turns and feedback: the history store hands
+# every written segment to EventLog, the events go through an in-memory queue and a
+# flusher thread writes them in batches as parquet files partitioned by source and day
+#   <target>/source=live/dt=YYYY-MM-DD/part-<time>-<uuid>.parquet
+# so months of feedback can be analyzed with one columnar scan instead of crawling the
+# per-session files. The target is a local path (tests) or any pyarrow filesystem uri
+# such as gs://bucket/prefix. pyarrow is only imported by the sink.
+
+
+def record_events(session_id: str, seq: int, records: list, source: str = "live") -> list:
+    """Converts the records of a history segment into event rows, summaries are skipped."""
+    events = []
+    for record in records:
+        record_type = record.get("type", "turn")
+        if record_type not in ("turn", "feedback"):
+            continue
+        events.append({
+            "event_id": str(uuid.uuid4()),
+            "event_type": record_type,
+            "source": source,
+            "session_id": session_id,
+            "seq": seq,
+            "role": record.get("role"),
+            "chat": record.get("chat"),
+            # legacy snapshots keep the feedback inline in the turn
+            "feedback_good_or_not": record.get("feedback_good_or_not"),
+            "feedback_text": record.get("feedback_text"),
+            "ts": record.get("ts"),
+        })
+    return events
+
+
+class ParquetEventSink:
+    """Writes batches of events as partitioned parquet files.
+
+    Args:
+        target (str): local directory or filesystem uri (e.g. gs://bucket/gen-ai-memory/events)
+    """
+    def __init__(self, target: str):
+        import pyarrow.fs
+        self._filesystem, self._root = pyarrow.fs.FileSystem.from_uri(target) if "://" in target else (pyarrow.fs.LocalFileSystem(), target)
+
+    def _schema(self):
+        import pyarrow as pa
+        return pa.schema([
+            ("event_id", pa.string()),
+            ("event_type", pa.string()),
+            ("session_id", pa.string()),
+            ("seq", pa.int64()),
+            ("role", pa.string()),
+            ("chat", pa.string()),
+            ("feedback_good_or_not", pa.int64()),
+            ("feedback_text", pa.string()),
+            ("ts", pa.timestamp("us", tz="UTC")),
+        ])
+
+    def write(self, events: list) -> list:
+        """Writes the events, one file per (source, day) partition.
+
+        Returns:
+            The paths of the written files.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        partitions = {}
+        for event in events:
+            day = datetime.fromtimestamp(event["ts"], tz=timezone.utc).strftime("%Y-%m-%d") if event["ts"] else "unknown"
+            partitions.setdefault((event["source"], day), []).append(event)
+        schema = self._schema()
+        paths = []
+        for (source, day), rows in partitions.items():
+            columns = {name: [row[name] for row in rows] for name in schema.names}
+            columns["ts"] = [datetime.fromtimestamp(ts, tz=timezone.utc) if ts else None for ts in columns["ts"]]
+            table = pa.table(columns, schema=schema)
+            directory = f"{self._root}/source={source}/dt={day}"
+            self._filesystem.create_dir(directory, recursive=True)
+            path = f"{directory}/part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+            pq.write_table(table, path, filesystem=self._filesystem)
+            paths.append(path)
+        return paths
+
+
+class EventLog:
+    """Bounded queue of events flushed in batches by a background thread.
+
+    Recording an event never blocks the request, when the queue is full the event is
+    dropped and counted.
+
+    Args:
+        sink: ParquetEventSink
+        batch_size (int): number of events triggering a flush
+        flush_interval (float): max seconds an event waits in the queue
+        max_queue (int): max number of events waiting to be flushed
+    """
+    def __init__(self, sink, batch_size: int = 500, flush_interval: float = 30, max_queue: int = 100000):
+        self._sink = sink
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._flush_lock = threading.Lock()
+        # the listeners run on the request threads, the flush on the flusher thread
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.files = 0
+        self.flush_failures = 0
+
+    def record(self, session_id: str, seq: int, records: list):
+        """History store listener, queues the events of a written segment."""
+        for event in record_events(session_id, seq, records):
+            try:
+                self._queue.put_nowait(event)
+                self._count("recorded")
+            except queue.Full:
+                self._count("dropped")
+
+    def flush(self) -> int:
+        """Writes every queued event, returns the number of events written."""
+        with self._flush_lock:
+            events = []
+            while True:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not events:
+                return 0
+            try:
+                files = len(self._sink.write(events))
+                self._count("files", files)
+                self._count("flushed", len(events))
+            except Exception:
+                logging.exception(str(traceback.format_exc()))
+                self._count("flush_failures")
+                # put the batch back for the next flush, what does not fit is dropped
+                for event in events:
+                    try:
+                        self._queue.put_nowait(event)
+                    except queue.Full:
+                        self._count("dropped")
+                return 0
+            return len(events)
+
+    def start(self):
+        """Starts the flusher thread."""
+        def run():
+            last_flush = time.monotonic()
+            while not self._stop.wait(1):
+                if self._queue.qsize() >= self._batch_size or time.monotonic() - last_flush >= self._flush_interval:
+                    self.flush()
+                    last_flush = time.monotonic()
+        self._thread = threading.Thread(target=run, name="event-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the flusher thread and writes the remaining events."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "recorded": self.recorded,
+                "dropped": self.dropped,
+                "flushed": self.flushed,
+                "queued": self._queue.qsize(),
+                "files": self.files,
+                "flush_failures": self.flush_failures,
+            }
+
+
+def compact(history_store, sink, include_timestamped: bool = False, batch_size: int = 5000) -> int:
+    """Exports the per-session history files into the event dataset (source=backfill).
+
+    Records written before the event pipeline have no timestamp and land in dt=unknown.
+    Records with a timestamp were already recorded live, they are only exported with
+    include_timestamped (e.g. to rebuild the dataset into a new target).
+
+    Returns:
+        The number of exported events.
+    """
+    exported = 0
+    events = []
+    for session_id in history_store.list_sessions():
+        for seq, records in history_store.read_segments(session_id):
+            if not include_timestamped:
+                records = [record for record in records if not record.get("ts")]
+            events.extend(record_events(session_id, seq, records, source="backfill"))
+        if len(events) >= batch_size:
+            sink.write(events)
+            exported += len(events)
+            events = []
+    if events:
+        sink.write(events)
+        exported += len(events)
+    return exported
+
+
+if __name__ == "__main__":
+    # python events.py compact [--all]
+    # writes the stored sessions into EVENTS_TARGET with the chat history settings of main
+    parser = argparse.ArgumentParser(description="Chat event dataset maintenance")
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("--all", action="store_true", help="also export the records already recorded live")
+    args = parser.parse_args()
+    from main import history_store, EVENTS_TARGET
+    start = time.perf_counter()
+    count = compact(history_store, ParquetEventSink(EVENTS_TARGET), include_timestamped=args.all)
+    print(f"{count} events exported to {EVENTS_TARGET} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,59 @@
+import re
+import json
+
+# chunkers turn a page into a list of text chunks. GeminiChunker is the production one
+# (the model decides the split from the page layout and rewrites it as clean text),
+# FakeChunker splits on paragraphs so the pipeline runs offline.
+CHUNK_PROMPT = """Split this document page into self-contained chunks for retrieval.
+Follow the structure of the page (sections, paragraphs, tables, lists), keep every fact
+and number, convert tables into sentences and drop headers, footers and page numbers.
+Return a JSON list of strings, one string per chunk."""
+
+
+class GeminiChunker:
+    """Chunks a page with Gemini from the pdf of the page.
+
+    Args:
+        client: google-genai client
+        model_name (str): model used for the chunking
+    """
+    def __init__(self, client, model_name: str = "gemini-2.5-pro"):
+        self._client = client
+        self._model_name = model_name
+
+    async def chunk(self, page) -> list:
+        from google.genai import types
+        if page.pdf_bytes is not None:
+            content = types.Part.from_bytes(data=page.pdf_bytes, mime_type="application/pdf")
+        else:
+            content = types.Part.from_text(text=page.text)
+        response = await self._client.aio.models.generate_content(
+            model=self._model_name,
+            contents=[content, CHUNK_PROMPT],
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=list[str]
+            )
+        )
+        return [chunk.strip() for chunk in json.loads(response.text) if chunk.strip()]
+
+
+class FakeChunker:
+    """Splits the page text on blank lines, merging paragraphs up to max_chars."""
+    def __init__(self, max_chars: int = 1000):
+        self._max_chars = max_chars
+
+    async def chunk(self, page) -> list:
+        chunks = []
+        current = ""
+        for paragraph in re.split(r"\n\s*\n", page.text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if current and len(current) + len(paragraph) + 1 > self._max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n{paragraph}" if current else paragraph
+        if current:
+            chunks.append(current)
+        return chunks
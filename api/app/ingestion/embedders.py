@@ -0,0 +1,30 @@
+import math
+import hashlib
+
+# embedders take a batch of chunks and return one vector per chunk
+
+
+class LangchainEmbedder:
+    """Batches through the embed_documents of langchain embeddings (e.g. VertexAIEmbeddings)."""
+    def __init__(self, embeddings):
+        self._embeddings = embeddings
+
+    def embed(self, texts: list) -> list:
+        return self._embeddings.embed_documents(texts)
+
+
+class FakeEmbedder:
+    """Deterministic unit vectors from the hash of the text, for offline runs."""
+    def __init__(self, dim: int = 3072):
+        self._dim = dim
+        self.calls = 0
+
+    def embed(self, texts: list) -> list:
+        self.calls += 1
+        vectors = []
+        for text in texts:
+            seed = hashlib.sha256(text.encode("utf-8")).digest()
+            values = [((seed[i % len(seed)] + i * 31) % 255) / 127.0 - 1.0 for i in range(self._dim)]
+            norm = math.sqrt(sum(value * value for value in values)) or 1.0
+            vectors.append([value / norm for value in values])
+        return vectors
@@ -0,0 +1,149 @@
+import glob
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+
+from concurrency import run_blocking
+from ingestion.sources import read_document
+
+# incremental ingestion of documents into the RAG collection: the pages of a document are
+# chunked concurrently (bounded), the chunks are embedded in batches and the rows of the
+# changed pages are replaced with a bulk COPY. Pages whose content hash is already stored
+# are skipped, so re-running the ingestion on the whole corpus only pays for new pages.
+
+
+class IngestionPipeline:
+    """Chunks, embeds and stores documents.
+
+    Args:
+        store: PGVectorStore or MemoryVectorStore
+        chunker: GeminiChunker or FakeChunker
+        embedder: LangchainEmbedder or FakeEmbedder
+        page_concurrency (int): max pages being chunked at the same time, over all documents
+        embed_batch_size (int): chunks per embedding request
+        embed_concurrency (int): max embedding requests at the same time
+    """
+    def __init__(self, store, chunker, embedder, page_concurrency: int = 8, embed_batch_size: int = 100, embed_concurrency: int = 4):
+        self._store = store
+        self._chunker = chunker
+        self._embedder = embedder
+        self._page_concurrency = page_concurrency
+        self._embed_batch_size = embed_batch_size
+        self._embed_concurrency = embed_concurrency
+        self._page_semaphore = None
+        self._embed_semaphore = None
+
+    def _semaphores(self):
+        if self._page_semaphore is None:
+            self._page_semaphore = asyncio.Semaphore(self._page_concurrency)
+            self._embed_semaphore = asyncio.Semaphore(self._embed_concurrency)
+        return self._page_semaphore, self._embed_semaphore
+
+    async def _chunk(self, page) -> list:
+        page_semaphore, _ = self._semaphores()
+        async with page_semaphore:
+            return await self._chunker.chunk(page)
+
+    async def _embed(self, texts: list) -> list:
+        _, embed_semaphore = self._semaphores()
+        batches = [texts[i:i + self._embed_batch_size] for i in range(0, len(texts), self._embed_batch_size)]
+
+        async def embed_batch(batch):
+            async with embed_semaphore:
+                return await run_blocking(self._embedder.embed, batch)
+
+        vectors = []
+        for batch_vectors in await asyncio.gather(*(embed_batch(batch) for batch in batches)):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    async def ingest_pages(self, pages: list) -> dict:
+        """Ingests the pages of one document, only the pages that changed are processed.
+
+        Returns:
+            A dictionary with the document name and the number of pages, skipped pages and chunks.
+        """
+        start = time.perf_counter()
+        document_name = pages[0].document_name
+        stored = await run_blocking(self._store.page_hashes, document_name)
+        changed = [page for page in pages if stored.get(str(page.page_number)) != page.content_hash]
+        removed = any(int(page) > len(pages) for page in stored)
+        rows = []
+        if changed:
+            page_chunks = await asyncio.gather(*(self._chunk(page) for page in changed))
+            texts = [chunk for chunks in page_chunks for chunk in chunks]
+            vectors = await self._embed(texts)
+            vector_iter = iter(vectors)
+            for page, chunks in zip(changed, page_chunks):
+                for index, chunk in enumerate(chunks):
+                    metadata = {"doc": document_name, "page": page.page_number, "chunk": index, "page_hash": page.content_hash}
+                    rows.append((str(uuid.uuid4()), next(vector_iter), chunk, metadata))
+        if changed or removed:
+            await run_blocking(self._store.replace_pages, document_name, [page.page_number for page in changed], rows, len(pages))
+        result = {
+            "document": document_name,
+            "pages": len(pages),
+            "skipped_pages": len(pages) - len(changed),
+            "chunks": len(rows),
+            "seconds": time.perf_counter() - start,
+        }
+        logging.info(f"ingested {result}")
+        return result
+
+    async def ingest(self, paths: list, document_concurrency: int = 4) -> list:
+        """Ingests documents from files, several documents are processed at the same time."""
+        # semaphores belong to the running event loop
+        self._page_semaphore = None
+        semaphore = asyncio.Semaphore(document_concurrency)
+
+        async def ingest_path(path):
+            async with semaphore:
+                pages = await run_blocking(read_document, path)
+                if not pages:
+                    return {"document": path, "pages": 0, "skipped_pages": 0, "chunks": 0, "seconds": 0.0}
+                return await self.ingest_pages(pages)
+
+        return await asyncio.gather(*(ingest_path(path) for path in paths))
+
+
+def create_pipeline(offline: bool = False, **kwargs) -> IngestionPipeline:
+    """Builds the pipeline on the production backends, or on fakes with offline."""
+    from ingestion.chunkers import GeminiChunker, FakeChunker
+    from ingestion.embedders import LangchainEmbedder, FakeEmbedder
+    from ingestion.stores import PGVectorStore, MemoryVectorStore
+    if offline:
+        return IngestionPipeline(MemoryVectorStore(), FakeChunker(), FakeEmbedder(), **kwargs)
+    from main import client, embeddings, postgres_engine, RAG_EMBEDDING_DIM
+    return IngestionPipeline(
+        PGVectorStore(postgres_engine, collection_name="rag_data", embedding_dim=RAG_EMBEDDING_DIM),
+        GeminiChunker(client),
+        LangchainEmbedder(embeddings),
+        **kwargs
+    )
+
+
+if __name__ == "__main__":
+    # python -m ingestion.pipeline ingest "docs/*.pdf" [--offline]
+    parser = argparse.ArgumentParser(description="Ingest documents into the RAG collection")
+    parser.add_argument("command", choices=["ingest"])
+    parser.add_argument("paths", nargs="+", help="files or glob patterns, pdf or text (pages separated by form feeds)")
+    parser.add_argument("--offline", action="store_true", help="fake chunker, embedder and store")
+    parser.add_argument("--page-concurrency", type=int, default=8)
+    parser.add_argument("--document-concurrency", type=int, default=4)
+    parser.add_argument("--embed-batch-size", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    paths = sorted({path for pattern in args.paths for path in glob.glob(pattern)})
+    pipeline = create_pipeline(
+        offline=args.offline,
+        page_concurrency=args.page_concurrency,
+        embed_batch_size=args.embed_batch_size
+    )
+    start = time.perf_counter()
+    results = asyncio.run(pipeline.ingest(paths, document_concurrency=args.document_concurrency))
+    print(f"{len(results)} documents, {sum(r['pages'] for r in results)} pages "
+          f"({sum(r['skipped_pages'] for r in results)} unchanged), {sum(r['chunks'] for r in results)} chunks "
+          f"in {time.perf_counter() - start:.1f}s")
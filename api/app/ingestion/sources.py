@@ -0,0 +1,52 @@
+import os
+import hashlib
+
+
+class Page:
+    """Single page of a source document.
+
+    Attributes:
+        document_name (str): name stored as "doc" in the chunk metadata
+        page_number (int): 1-based page number stored as "page"
+        text (str): extracted text of the page, used by the fake chunker and for the hash
+        pdf_bytes (bytes): the page as a standalone pdf, sent to the Gemini chunker
+        content_hash (str): sha256 of the page, unchanged pages are not ingested again
+    """
+    def __init__(self, document_name: str, page_number: int, text: str, pdf_bytes: bytes = None):
+        self.document_name = document_name
+        self.page_number = page_number
+        self.text = text
+        self.pdf_bytes = pdf_bytes
+        # the text is stable across pdf exports, scanned pages without text fall back to the bytes
+        content = text.encode("utf-8") if text.strip() else (pdf_bytes or b"")
+        self.content_hash = hashlib.sha256(content).hexdigest()
+
+
+def read_pdf(path: str, document_name: str = None) -> list:
+    """Splits a pdf into pages, pypdf is only needed when pdf files are ingested."""
+    import io
+    from pypdf import PdfReader, PdfWriter
+    document_name = document_name or os.path.splitext(os.path.basename(path))[0]
+    reader = PdfReader(path)
+    pages = []
+    for index, pdf_page in enumerate(reader.pages):
+        writer = PdfWriter()
+        writer.add_page(pdf_page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        pages.append(Page(document_name, index + 1, pdf_page.extract_text() or "", buffer.getvalue()))
+    return pages
+
+
+def read_text(path: str, document_name: str = None, page_separator: str = "\f") -> list:
+    """Reads a text file as a document, pages are separated by form feeds (offline runs and tests)."""
+    document_name = document_name or os.path.splitext(os.path.basename(path))[0]
+    with open(path, encoding="utf-8") as f:
+        contents = f.read().split(page_separator)
+    return [Page(document_name, index + 1, text) for index, text in enumerate(contents)]
+
+
+def read_document(path: str) -> list:
+    if path.lower().endswith(".pdf"):
+        return read_pdf(path)
+    return read_text(path)
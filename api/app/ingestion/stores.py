@@ -0,0 +1,161 @@
+import io
+import csv
+import json
+import uuid
+import threading
+
+import sqlalchemy
+
+# vector stores the pipeline writes to. PGVectorStore writes the langchain_postgres tables
+# read by retriever.py with COPY, MemoryVectorStore keeps the rows in memory for offline runs.
+COLLECTION_TABLE = "langchain_pg_collection"
+EMBEDDING_TABLE = "langchain_pg_embedding"
+COPY_COLUMNS = "id, collection_id, embedding, document, cmetadata"
+
+
+class PGVectorStore:
+    """Chunk rows of one PGVector collection.
+
+    Args:
+        engine: sqlalchemy engine of the vector database
+        collection_name (str): name of the PGVector collection, created when missing
+        embedding_dim (int): dimension of the embeddings
+    """
+    def __init__(self, engine, collection_name: str = "rag_data", embedding_dim: int = 3072):
+        self._engine = engine
+        self._collection_name = collection_name
+        self._embedding_dim = embedding_dim
+        self._collection_id = None
+
+    def collection_id(self) -> str:
+        if self._collection_id is None:
+            with self._engine.connect() as db_conn:
+                # same tables as langchain_postgres, so both can write the collection
+                db_conn.execute(sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS vector"))
+                db_conn.execute(sqlalchemy.text(f"""
+                    CREATE TABLE IF NOT EXISTS {COLLECTION_TABLE} (
+                        uuid UUID PRIMARY KEY,
+                        name VARCHAR NOT NULL UNIQUE,
+                        cmetadata JSON
+                    )"""))
+                db_conn.execute(sqlalchemy.text(f"""
+                    CREATE TABLE IF NOT EXISTS {EMBEDDING_TABLE} (
+                        id VARCHAR PRIMARY KEY,
+                        collection_id UUID REFERENCES {COLLECTION_TABLE} (uuid) ON DELETE CASCADE,
+                        embedding VECTOR({self._embedding_dim}),
+                        document VARCHAR,
+                        cmetadata JSONB
+                    )"""))
+                db_conn.execute(
+                    sqlalchemy.text(f"INSERT INTO {COLLECTION_TABLE} (uuid, name) VALUES (:uuid, :name) ON CONFLICT (name) DO NOTHING"),
+                    {"uuid": str(uuid.uuid4()), "name": self._collection_name}
+                )
+                row = db_conn.execute(
+                    sqlalchemy.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name"),
+                    {"name": self._collection_name}
+                ).fetchone()
+                db_conn.commit()
+            self._collection_id = str(row[0])
+        return self._collection_id
+
+    def page_hashes(self, document_name: str) -> dict:
+        """Returns {page number (str): content hash} of the stored pages of the document."""
+        select_hashes = sqlalchemy.text(f"""
+            SELECT cmetadata->>'page', MIN(cmetadata->>'page_hash')
+            FROM {EMBEDDING_TABLE}
+            WHERE collection_id = :collection_id AND cmetadata->>'doc' = :doc
+            GROUP BY cmetadata->>'page'""")
+        with self._engine.connect() as db_conn:
+            rows = db_conn.execute(select_hashes, {"collection_id": self.collection_id(), "doc": document_name}).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def replace_pages(self, document_name: str, page_numbers: list, rows: list, page_count: int):
+        """Replaces the chunks of the given pages and drops the pages after page_count, in one transaction.
+
+        The version in the cmetadata of the collection is bumped in the same transaction,
+        the retriever and the answer cache read it to know the documents changed.
+
+        Args:
+            document_name (str): document of the pages
+            page_numbers (list): pages whose chunks are replaced
+            rows (list): (id, embedding, document, metadata) of the new chunks
+            page_count (int): number of pages of the document
+        """
+        collection_id = self.collection_id()
+        delete_pages = sqlalchemy.text(f"""
+            DELETE FROM {EMBEDDING_TABLE}
+            WHERE collection_id = :collection_id AND cmetadata->>'doc' = :doc
+                AND (cmetadata->>'page' = ANY(:pages) OR (cmetadata->>'page')::int > :page_count)""")
+        bump_version = sqlalchemy.text(f"""
+            UPDATE {COLLECTION_TABLE}
+            SET cmetadata = (COALESCE(cmetadata::jsonb, '{{}}'::jsonb) || jsonb_build_object('version', COALESCE((cmetadata->>'version')::bigint, 0) + 1))::json
+            WHERE uuid = :collection_id""")
+        with self._engine.begin() as db_conn:
+            db_conn.execute(delete_pages, {
+                "collection_id": collection_id,
+                "doc": document_name,
+                "pages": [str(page) for page in page_numbers],
+                "page_count": page_count,
+            })
+            if rows:
+                self._copy(db_conn, collection_id, rows)
+            db_conn.execute(bump_version, {"collection_id": collection_id})
+
+    def _copy(self, db_conn, collection_id: str, rows: list):
+        dbapi_conn = db_conn.connection.dbapi_connection
+        driver = type(dbapi_conn).__module__.split(".")[0]
+        copy_rows = [(row_id, _vector_literal(embedding), document, json.dumps(metadata)) for row_id, embedding, document, metadata in rows]
+        if driver == "psycopg":
+            with dbapi_conn.cursor() as cursor:
+                with cursor.copy(f"COPY {EMBEDDING_TABLE} ({COPY_COLUMNS}) FROM STDIN") as copy:
+                    for row_id, embedding, document, metadata in copy_rows:
+                        copy.write_row((row_id, collection_id, embedding, document, metadata))
+        elif driver == "pg8000":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row_id, embedding, document, metadata in copy_rows:
+                writer.writerow((row_id, collection_id, embedding, document, metadata))
+            buffer.seek(0)
+            cursor = dbapi_conn.cursor()
+            cursor.execute(f"COPY {EMBEDDING_TABLE} ({COPY_COLUMNS}) FROM STDIN WITH (FORMAT csv)", stream=buffer)
+        else:
+            # drivers without COPY support, one multi-row statement
+            db_conn.execute(
+                sqlalchemy.text(f"""
+                    INSERT INTO {EMBEDDING_TABLE} ({COPY_COLUMNS})
+                    VALUES (:id, :collection_id, CAST(:embedding AS VECTOR), :document, CAST(:cmetadata AS JSONB))"""),
+                [
+                    {"id": row_id, "collection_id": collection_id, "embedding": embedding, "document": document, "cmetadata": metadata}
+                    for row_id, embedding, document, metadata in copy_rows
+                ]
+            )
+
+
+class MemoryVectorStore:
+    """In-memory store with the same interface as PGVectorStore, for offline runs."""
+    def __init__(self):
+        self.rows = {}
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def page_hashes(self, document_name: str) -> dict:
+        with self._lock:
+            return {
+                str(metadata["page"]): metadata.get("page_hash")
+                for _, _, metadata in self.rows.values() if metadata["doc"] == document_name
+            }
+
+    def replace_pages(self, document_name: str, page_numbers: list, rows: list, page_count: int):
+        pages = set(page_numbers)
+        with self._lock:
+            self.rows = {
+                row_id: row for row_id, row in self.rows.items()
+                if row[2]["doc"] != document_name or (row[2]["page"] not in pages and row[2]["page"] <= page_count)
+            }
+            for row_id, embedding, document, metadata in rows:
+                self.rows[row_id] = (embedding, document, metadata)
+            self.writes += 1
+
+
+def _vector_literal(embedding: list) -> str:
+    return "[" + ",".join(str(float(value)) for value in embedding) + "]"
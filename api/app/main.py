@@ -1,28 +1,56 @@
+import time
+_import_start = time.perf_counter()
+
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from pydantic import BaseModel, Field
-
-import re
-import random
-from google.cloud import storage
-
 from google import genai
 from google.genai import types
-from google.cloud import bigquery
 import json
 import traceback
 import logging
-import datetime
 import os
+import asyncio
+import contextvars
+from typing import Optional
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from google.cloud import secretmanager
-from connectors.postgres import CloudSQLPostgresConnector
-from langchain_postgres.vectorstores import PGVector
-import sqlalchemy
-from langchain_google_vertexai import VertexAIEmbeddings
-
-app = FastAPI()
+from fastapi.responses import JSONResponse, Response
+from stores.chat_history import create_history_store
+from agent import stream_agent, execute_tool, function_call_text
+from context_cache import StaticContextCache
+from events import EventLog, ParquetEventSink
+from memory import ConversationMemory, collect_references
+from concurrency import run_blocking, offload, shutdown as shutdown_executor
+from resources import ResourceRegistry
+from retriever import VectorRetriever
+from caches.embedding import CachedEmbeddings
+from warehouse import QueryResultCache, execute_query, shape_result
+from mirror import LocalMirror, MirrorUnavailable, FRAUD_TABLE as mirror_table_id
+from rollups import RollupRewriter, RollupManager
+from caches.semantic import SemanticAnswerCache, is_context_free
+from caches.plan import PlanCache, planned_query
+from compression import ContextCompressor
+from routing import ModelRouter
+from cost_guard import CostGuard, BigQueryEstimator, LocalEstimator, QueryBudgetExceeded
+from telemetry import span, annotate, record_query, setup_tracing, shutdown_tracing, stats_collector, render_metrics, REQUEST_SECONDS, FIRST_TOKEN_SECONDS, RAG_PASSAGES
+
+# time spent importing the modules of the app, part of the startup report
+_imports_seconds = time.perf_counter() - _import_start
+
+@asynccontextmanager
+async def lifespan(app):
+    # background: the port opens right away and /readyz reports 503 until every client is warm,
+    # use it as the Cloud Run startup probe. eager: the port only opens once startup is done.
+    startup_task = asyncio.create_task(startup())
+    if STARTUP_MODE == "eager":
+        await startup_task
+    yield
+    startup_task.cancel()
+    await shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "*"
@@ -38,10 +66,74 @@ app.add_middleware(
 PROJECT_ID = os.environ.get("PROJECT_ID")
 BUCKET_NAME = os.environ.get("BUCKET_NAME")
 SECRET_ID_DB = os.environ.get('SECRET_ID_DB')
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "background") # background or eager
 driver = os.environ.get("DRIVER", "pg8000")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+DB_ASYNC = os.environ.get("DB_ASYNC", "false").lower() == "true" # vector search on the async engine
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "gcs") # gcs, local or postgres
+HISTORY_LOCAL_ROOT = os.environ.get("HISTORY_LOCAL_ROOT", "/tmp/chat-history")
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "256"))
+RAG_EMBEDDING_DIM = int(os.environ.get("RAG_EMBEDDING_DIM", "3072")) # gemini-embedding-001 default dimension
+RAG_EF_SEARCH = int(os.environ.get("RAG_EF_SEARCH", "40"))
+RAG_HYBRID = os.environ.get("RAG_HYBRID", "true").lower() == "true" # vector + full-text search fused with RRF
+RAG_WARM_UP = os.environ.get("RAG_WARM_UP", "true").lower() == "true"
+RAG_COMPRESSION = os.environ.get("RAG_COMPRESSION", "true").lower() == "true" # dedup, merge and trim the passages given to the model
+RAG_CANDIDATES = int(os.environ.get("RAG_CANDIDATES", "8")) # passages retrieved before compression
+RAG_CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKEN_BUDGET", "800"))
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL = float(os.environ.get("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+EMBEDDING_CACHE_PERSISTENT = os.environ.get("EMBEDDING_CACHE_PERSISTENT", "false").lower() == "true"
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "512"))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_FRESHNESS_INTERVAL = float(os.environ.get("QUERY_CACHE_FRESHNESS_INTERVAL", "60"))
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", "200"))
+QUERY_PAGE_SIZE = int(os.environ.get("QUERY_PAGE_SIZE", "1000"))
+QUERY_RESULT_FORMAT = os.environ.get("QUERY_RESULT_FORMAT", "csv") # csv or columnar
+MIRROR_ENABLED = os.environ.get("MIRROR_ENABLED", "false").lower() == "true"
+MIRROR_PARQUET_PATH = os.environ.get("MIRROR_PARQUET_PATH", "/tmp/mirror/fraud_data.parquet")
+MIRROR_REFRESH_INTERVAL = float(os.environ.get("MIRROR_REFRESH_INTERVAL", "3600"))
+ROLLUPS_ENABLED = os.environ.get("ROLLUPS_ENABLED", "false").lower() == "true"
+ROLLUP_REFRESH_INTERVAL = float(os.environ.get("ROLLUP_REFRESH_INTERVAL", "0")) # 0 disables the refresh thread
+COST_GUARD_ENABLED = os.environ.get("COST_GUARD_ENABLED", "true").lower() == "true"
+COST_GUARD_ESTIMATOR = os.environ.get("COST_GUARD_ESTIMATOR", "bigquery") # bigquery (dry run) or local (mirror parquet)
+MAX_BYTES_PER_QUERY = int(os.environ.get("MAX_BYTES_PER_QUERY", str(2 * 1024 ** 3)))
+MAX_BYTES_PER_SESSION = int(os.environ.get("MAX_BYTES_PER_SESSION", str(20 * 1024 ** 3)))
+# lean: schema and document summaries pinned in a context cache, only the I/O tools are declared
+# classic: the original protocol with the context and translation tools
+AGENT_MODE = os.environ.get("AGENT_MODE", "lean")
+CONTEXT_CACHE_TTL = int(os.environ.get("CONTEXT_CACHE_TTL", "3600"))
+EVENTS_ENABLED = os.environ.get("EVENTS_ENABLED", "false").lower() == "true"
+EVENTS_TARGET = os.environ.get("EVENTS_TARGET", f"gs://{BUCKET_NAME}/gen-ai-memory/events" if BUCKET_NAME else "/tmp/chat-events")
+EVENTS_BATCH_SIZE = int(os.environ.get("EVENTS_BATCH_SIZE", "500"))
+EVENTS_FLUSH_INTERVAL = float(os.environ.get("EVENTS_FLUSH_INTERVAL", "30"))
+MEMORY_TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", "4000"))
+MEMORY_KEEP_TURNS = int(os.environ.get("MEMORY_KEEP_TURNS", "10"))
+MEMORY_SUMMARY_MODEL = os.environ.get("MEMORY_SUMMARY_MODEL", "gemini-2.5-flash-lite")
+DB_TOOL_TIMEOUT = float(os.environ.get("DB_TOOL_TIMEOUT", "120"))
+# each question goes to a model tier picked from its complexity, model_name is used for every question otherwise
+ROUTER_ENABLED = os.environ.get("ROUTER_ENABLED", "true").lower() == "true"
+ROUTER_TIERS = os.environ.get("ROUTER_TIERS", "gemini-2.5-flash-lite,gemini-2.5-flash,gemini-2.5-pro").split(",") # fastest to strongest
+ROUTER_MAX_ESCALATIONS = int(os.environ.get("ROUTER_MAX_ESCALATIONS", "1"))
+ROUTER_LATENCY_BUDGET = float(os.environ.get("ROUTER_LATENCY_BUDGET", "0")) # seconds per answer without a budget in the request, 0 for no limit
+ROUTER_MIN_AVG_LOGPROBS = os.environ.get("ROUTER_MIN_AVG_LOGPROBS") # answers below are escalated, unset disables the check
+PLAN_CACHE_ENABLED = os.environ.get("PLAN_CACHE_ENABLED", "false").lower() == "true" # generated SQL reused as templates for questions of the same shape
+PLAN_CACHE_SIZE = int(os.environ.get("PLAN_CACHE_SIZE", "512"))
+PLAN_CACHE_TTL = float(os.environ.get("PLAN_CACHE_TTL", str(24 * 3600)))
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", str(7 * 24 * 3600)))
+# spans are exported to this OTLP/HTTP collector (e.g. http://localhost:4318), /metrics is always served
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "fraud-agent-api")
+
+setup_tracing(OTEL_SERVICE_NAME, OTEL_EXPORTER_OTLP_ENDPOINT)
 
 def access_secret():
     # secret manager
+    from google.cloud import secretmanager
     client = secretmanager.SecretManagerServiceClient()
     # Build the resource name of the secret version.
     name = f"projects/{PROJECT_ID}/secrets/{SECRET_ID_DB}/versions/latest"
@@ -52,21 +144,124 @@ def access_secret():
     db_secret = json.loads(payload)
     return db_secret
 
-client = genai.Client(
+def create_connector():
+    from connectors.postgres import CloudSQLPostgresConnector
+    return CloudSQLPostgresConnector(
+        instance_name=db_secret["INSTANCE_CONNECTION_NAME"],
+        user=db_secret["DB_USER"],
+        password=db_secret["DB_PASS"],
+        database=db_secret["DB_NAME"],
+        driver=driver,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE
+    )
+
+def create_store():
+    store = create_history_store(
+        HISTORY_BACKEND,
+        bucket_name=BUCKET_NAME,
+        local_root=HISTORY_LOCAL_ROOT,
+        engine=postgres_engine if HISTORY_BACKEND == "postgres" else None,
+        cache_size=HISTORY_CACHE_SIZE
+    )
+    if event_log is not None:
+        store.add_listener(event_log.record)
+    return store
+
+def create_embeddings():
+    # question embeddings are cached, repeated questions skip the remote embedding call
+    from langchain_google_vertexai import VertexAIEmbeddings
+    return CachedEmbeddings(
+        VertexAIEmbeddings(model="gemini-embedding-001"),
+        model_name="gemini-embedding-001",
+        max_size=EMBEDDING_CACHE_SIZE,
+        ttl=EMBEDDING_CACHE_TTL,
+        engine=postgres_engine if EMBEDDING_CACHE_PERSISTENT else None
+    )
+
+# clients and connections are built on first use or concurrently by the startup hook,
+# see resources.py. The module level names are proxies to the real objects.
+resources = ResourceRegistry()
+client = resources.lazy("genai_client", lambda: genai.Client(
     vertexai=True,
     project=PROJECT_ID,
     location="us-central1",
+))
+db_secret = resources.lazy("db_secret", access_secret)
+connector = resources.lazy("cloudsql_connector", create_connector)
+postgres_engine = resources.lazy("postgres_engine", lambda: connector.get_engine())
+# turns and feedback are also recorded as events and exported to parquet in batches
+event_log = EventLog(
+    ParquetEventSink(EVENTS_TARGET),
+    batch_size=EVENTS_BATCH_SIZE,
+    flush_interval=EVENTS_FLUSH_INTERVAL
+) if EVENTS_ENABLED else None
+history_store = resources.lazy("history_store", create_store)
+embeddings = resources.lazy("embeddings", create_embeddings)
+# results of the generated queries, invalidated when the referenced table is modified
+query_cache = QueryResultCache(
+    max_size=QUERY_CACHE_SIZE,
+    ttl=QUERY_CACHE_TTL,
+    freshness_interval=QUERY_CACHE_FRESHNESS_INTERVAL
 )
-embeddings = VertexAIEmbeddings(model="gemini-embedding-001")
-db_secret  = access_secret()
-connector = CloudSQLPostgresConnector(
-    instance_name=db_secret["INSTANCE_CONNECTION_NAME"],
-    user=db_secret["DB_USER"],
-    password=db_secret["DB_PASS"],
-    database=db_secret["DB_NAME"],
-    driver=driver
+# optional local DuckDB copy of fraud_data, queries it can serve skip the BigQuery job
+mirror = LocalMirror(
+    parquet_path=MIRROR_PARQUET_PATH,
+    refresh_interval=MIRROR_REFRESH_INTERVAL
+) if MIRROR_ENABLED else None
+# aggregate queries on the cube dimensions are rewritten onto the rollups, see rollups.py
+rollups = RollupManager(RollupRewriter(), query_cache.table_modified) if ROLLUPS_ENABLED else None
+# dry run of every query sent to BigQuery, over budget queries go back to the model
+if COST_GUARD_ENABLED:
+    cost_guard = CostGuard(
+        LocalEstimator.from_parquet(MIRROR_PARQUET_PATH, mirror_table_id) if COST_GUARD_ESTIMATOR == "local" else BigQueryEstimator(),
+        max_bytes_per_query=MAX_BYTES_PER_QUERY,
+        max_bytes_per_session=MAX_BYTES_PER_SESSION
+    )
+else:
+    cost_guard = None
+# session of the request being served, read by the tools
+current_session_id = contextvars.ContextVar("current_session_id", default=None)
+# built once and reused by every request, see retriever.py for the index management command
+vector_retriever = VectorRetriever(
+    engine=postgres_engine,
+    embeddings=embeddings,
+    collection_name="rag_data",
+    embedding_dim=RAG_EMBEDDING_DIM,
+    ef_search=RAG_EF_SEARCH,
+    hybrid=RAG_HYBRID,
+    async_engine=(lambda: connector.get_async_engine()) if DB_ASYNC else None
 )
 
+context_compressor = ContextCompressor(token_budget=RAG_CONTEXT_TOKEN_BUDGET) if RAG_COMPRESSION else None
+
+def data_version() -> str:
+    # answers are only reused while the transaction table and the documents are unchanged
+    return f"{query_cache.table_modified(mirror_table_id)}|{vector_retriever.collection_version()}"
+
+def column_values(column: str):
+    # known values of a fraud_data column, the plan cache only fills string slots with them
+    # and the semantic cache only serves an answer about the same ones
+    if mirror is not None and mirror.ready:
+        return mirror.distinct_values(column)
+    if rollups is not None:
+        return rollups.distinct_values(column)
+    return None
+
+semantic_cache = resources.lazy("semantic_cache", lambda: SemanticAnswerCache(
+    engine=postgres_engine,
+    embeddings=embeddings,
+    data_version=data_version,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    embedding_dim=RAG_EMBEDDING_DIM,
+    ttl=SEMANTIC_CACHE_TTL,
+    known_terms=lambda: (column_values("category") or []) + (column_values("state") or [])
+)) if SEMANTIC_CACHE_ENABLED else None
+
+plan_cache = PlanCache(max_size=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL, column_values=column_values) if PLAN_CACHE_ENABLED else None
+
 system_instruction = """
     ### **System Instruction Prompt for Bank ABC Fraud Detection Agent**
 
@@ -92,7 +287,7 @@ system_instruction = """
 
         * **Description**: Executes an SQL query on the credit card transaction database and returns the result.
         * **Input (`query_syntax`)**: A string containing a complete and valid SQL query for Google BigQuery.
-        * **Output**: Returns a list of JSON objects, where each object represents a single row from the query result. If no data is found, the function will return an empty list `[]`.
+        * **Output**: Returns the rows of the query result as CSV with a header line `# total_rows=... returned_rows=... truncated=...`. Only the first rows are returned for big results (`truncated=true`), so aggregate in SQL (`SUM`, `COUNT`, `GROUP BY`, `LIMIT`) instead of selecting raw rows. If no data is found, `total_rows` is `0`.
 
     * **`retrieving_rag_info()`**
 
@@ -100,10 +295,11 @@ system_instruction = """
         * **Input**: None.
         * **Output**: A string containing a summary of the papers "Understanding Credit Card Frauds" and "2024 Report on Payment Fraud".
 
-    * **`retrieving_data_rag(question: str)`**
+    * **`retrieving_data_rag(question: str, document_name: str = None, page_from: int = None, page_to: int = None)`**
 
         * **Description**: Searches for and retrieves relevant information from the available PDF documents based on the user's question.
-        * **Input (`question`)**: A question string that will be used to search for information within the documents.
+        * **Input (`question`)**: A question string that will be used to search for information within the documents, exact keywords (e.g. "SCA") are matched too.
+        * **Input (`document_name`, `page_from`, `page_to`)**: Optional filters, use them when the question is about one document or section.
         * **Output**: Returns a list containing content snippets (`page_content`) and their sources (`document_name`, `document_page`).
 
     * **`translate_output(language: str, translated_output: str)`**
@@ -143,7 +339,7 @@ system_instruction = """
     5.  **Synthesis and Final Answer**:
 
         * After obtaining data from the relevant functions, summarize the results into a clear, concise, and easy-to-read answer.
-        * If a function returns empty data (`[]`), inform the user that "No data was found for the specified criteria."
+        * If a function returns empty data (`[]` or `total_rows=0`), inform the user that "No data was found for the specified criteria."
         * **Final Step**: Determine the user's input language, then call `translate_output()` to translate your final answer into that language before displaying it to the user.
 
     -----
@@ -162,24 +358,13 @@ system_instruction = """
             ```
         6.  **Function Results (Example)**:
             * RAG: `[{'page_content': 'The most common type of fraud is the use of a lost or stolen card, accounting for 48% of cases.', ...}]`
-            * Database: `[{'total_loss': 15720.50}]`
+            * Database: `# total_rows=1 returned_rows=1 truncated=false\ntotal_loss\n15720.5`
         7.  **Answer Synthesis (Draft)**: "Based on the 'Understanding Credit Card Frauds' document, the most common fraud method is the use of a lost or stolen card. For our transaction data, the total loss from fraud in the 'gas\_transport' category is $15,720.50."
         8.  **Finalization**: The user asked in English. I will call:
             ```python
             translate_output(language="English", translated_output="Based on the 'Understanding Credit Card Frauds' document, the most common fraud method is the use of a lost or stolen card. For our transaction data, the total loss from fraud in the 'gas_transport' category is $15,720.50.")
             ```
     * **Final Answer to the User**: "Based on the 'Understanding Credit Card Frauds' document, the most common fraud method is the use of a lost or stolen card. For our transaction data, the total loss from fraud in the 'gas\_transport' category is $15,720.50."""
-# function for converting datetime from BQ
-def date_converter(o):
-    """
-    A custom JSON serializer function to handle date and datetime objects.
-    If the object is a date or datetime, it converts it to an ISO 8601 string.
-    Otherwise, it raises a TypeError.
-    """
-    if isinstance(o, (datetime.date, datetime.datetime)):
-        return o.isoformat()
-    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
-
 # function call to retrieve table information for query
 def retrieving_table_information() -> str:
     """Retrieves table information that can be queried, please refer to this function before you create sql syntax to understand the table.
@@ -375,29 +560,57 @@ def retrieving_rag_info() -> str:
     return FILE_INFO
 
 # function call to retrieve data from BQ
-def retrieving_data_db(query_syntax: str) -> dict:
+def retrieving_data_db(query_syntax: str) -> str:
     """Retrieves data from the database by executing a SQL query. please consider the historical chat when creating query.
 
     Args:
         query_syntax (str): A valid Bigquery SQL query syntax string to execute against the database.
 
     Returns:
-        A list of dictionaries, where each dictionary represents a row from the query results.
+        The query result as CSV with a first line "# total_rows=... returned_rows=... truncated=...".
+        When truncated is true only the first rows are returned, aggregate in SQL instead of reading all rows.
     """
-    print(query_syntax)
-    client = bigquery.Client()
-    query_job = client.query(query_syntax)
-    results_list = [dict(row) for row in query_job]
-    json_output = json.dumps(results_list, indent=4, default=date_converter)
-
-    return json_output
+    logging.info(f"retrieving_data_db: {query_syntax}")
+    annotate(**{"db.statement": query_syntax})
+    try:
+        return query_cache.get_or_run(query_syntax, run_query)
+    except QueryBudgetExceeded as e:
+        return str(e)
+
+def run_query(query_syntax: str) -> str:
+    # the result is cached for the current version of the table, an older snapshot can not answer
+    if mirror is not None and mirror.ready and not mirror.is_current(query_cache.table_modified(mirror_table_id)):
+        logging.info("query sent to BigQuery: the mirror snapshot is older than the table")
+    elif mirror is not None and mirror.ready:
+        try:
+            with span("warehouse.mirror"):
+                columns, rows, total_rows = mirror.execute(query_syntax, max_rows=QUERY_MAX_ROWS)
+                record_query("mirror", total_rows)
+            return shape_result(columns, rows, total_rows, result_format=QUERY_RESULT_FORMAT)
+        except MirrorUnavailable as e:
+            logging.info(f"query sent to BigQuery: {e}")
+    if rollups is not None:
+        query_syntax = rollups.try_rewrite(query_syntax) or query_syntax
+    if cost_guard is not None:
+        with span("warehouse.dry_run"):
+            cost_guard.check(query_syntax, session_id=current_session_id.get())
+    with span("warehouse.bigquery"):
+        return execute_query(
+            query_syntax,
+            max_rows=QUERY_MAX_ROWS,
+            page_size=QUERY_PAGE_SIZE,
+            result_format=QUERY_RESULT_FORMAT
+        )
 
 # function call to retrieve data from BQ
-def retrieving_data_rag(question: str) -> list:
-    """Retrieves data from the database by executing a SQL query. please consider the historical chat when creating query.
+async def retrieving_data_rag(question: str, document_name: Optional[str] = None, page_from: Optional[int] = None, page_to: Optional[int] = None) -> list:
+    """Retrieves the most relevant passages of the documents, by meaning and by exact keywords (e.g. "SCA", "skimming").
 
     Args:
-        query_syntax (str): A valid Bigquery SQL query syntax string to execute against the database.
+        question (str): The question or keywords to search for in the documents.
+        document_name (str): Optional, only search this document, e.g. "2024 Report on Payment Fraud".
+        page_from (int): Optional, only search from this page of the document.
+        page_to (int): Optional, only search up to this page of the document.
 
     Returns:
         A list of dictionary of retrieval result based on question
@@ -405,27 +618,20 @@ def retrieving_data_rag(question: str) -> list:
         result = [{
         "page_content" : information data,
         "document_name": source document on information data,
-        "document_page": source page of document on information data,
+        "document_page": source page of document on information data, e.g. 12 or "12-13",
         }
         ]
     """
-    engine = connector.get_engine()
-    vector_store = PGVector(
-        embeddings=embeddings,
-        collection_name="rag_data",
-        connection=engine,
-        use_jsonb=True
-    )
-    results = vector_store.similarity_search(query=question, k=4)
-    final_res = []
-    for result in results:
-        result_temp = {
-            "page_content" : result.page_content,
-            "document_name": result.metadata['doc'],
-            "document_page": result.metadata['page'],
-        }
-        final_res.append(result_temp)
-    return final_res
+    annotate(**{"rag.document_name": document_name, "rag.page_from": page_from, "rag.page_to": page_to})
+    if context_compressor is None:
+        results = await vector_retriever.asearch(question, k=4, document_name=document_name, page_from=page_from, page_to=page_to)
+    else:
+        # more candidates than before, duplicates and irrelevant sentences are dropped before the model sees them
+        results = await vector_retriever.asearch(question, k=RAG_CANDIDATES, document_name=document_name, page_from=page_from, page_to=page_to)
+        with span("rag.compress", candidates=len(results)):
+            results = context_compressor.compress(question, results)
+    RAG_PASSAGES.observe(len(results))
+    return results
 
 # function call to translate output to user language
 def translate_output(language: str,translated_output: str) -> list:
@@ -444,116 +650,458 @@ def translate_output(language: str,translated_output: str) -> list:
 class Chat_Data(BaseModel):
     session_id: str
     user_input: str
+    latency_budget: Optional[float] = None # seconds for the answer, limits the model tier and the escalations
+    token_budget: Optional[int] = None # max output tokens of a model turn
 
 class Feedback_Data(BaseModel):
     session_id: str
     feedback_good_or_not: int # 0 means bad and 1 means good
     feedback_text: str    
      
+async def warm_up_retriever():
+    # prime the pgvector pool and index pages before the first RAG question
+    if RAG_WARM_UP:
+        await run_blocking(vector_retriever.warm_up)
+
+async def start_mirror():
+    # load the existing snapshot if there is one, otherwise take a new one
+    if mirror is not None:
+        try:
+            if os.path.exists(MIRROR_PARQUET_PATH):
+                await run_blocking(mirror.load)
+            # a snapshot without its source version is never used, it is replaced right away
+            if mirror.source_modified is None:
+                await run_blocking(mirror.snapshot)
+        finally:
+            mirror.start_refresh()
+
+async def start_rollups():
+    if rollups is not None and ROLLUP_REFRESH_INTERVAL > 0:
+        rollups.start_refresh(ROLLUP_REFRESH_INTERVAL)
+
+async def create_context_cache():
+    # a context cache only works with its model, one per routed model
+    async def create(context):
+        if await run_blocking(context.safe_create):
+            context.start_refresh()
+    if AGENT_MODE == "lean":
+        await asyncio.gather(*(create(context) for context in static_contexts.values()))
+
+async def start_event_log():
+    if event_log is not None:
+        event_log.start()
+
+async def startup():
+    # every client is built concurrently, then the warm ups run concurrently
+    resources.record("imports", _imports_seconds)
+    await resources.step("resources", resources.initialize())
+    await asyncio.gather(
+        resources.step("warm_up_retriever", warm_up_retriever()),
+        resources.step("start_mirror", start_mirror()),
+        resources.step("start_rollups", start_rollups()),
+        resources.step("create_context_cache", create_context_cache()),
+        resources.step("start_event_log", start_event_log()),
+    )
+    resources.started = True
+    resources.log_report()
+
+async def shutdown():
+    # the queued events are written before the instance goes away
+    if event_log is not None:
+        await run_blocking(event_log.stop)
+    # the refresh threads would keep calling BigQuery and Vertex AI after the executor is gone
+    if mirror is not None:
+        mirror.stop()
+    if rollups is not None:
+        rollups.stop()
+    for context in static_contexts.values():
+        context.stop()
+    if DB_ASYNC and connector.ready:
+        await connector.close_async()
+    shutdown_executor()
+    shutdown_tracing()
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
-@app.post("/chatbot/ai-assistant")
-def conversation(data_input:Chat_Data):
-    # load metadata post from gcs
-    storage_client = storage.Client()
-    blob_name = f"gen-ai-memory/chat_history/{data_input.session_id}/history_{data_input.session_id}.json"
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.get_blob(blob_name)
-    if blob == None:
-        history = []
+@app.get("/healthz")
+async def liveness():
+    # the process is up and serving, no dependency is touched
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readiness():
+    # ready once every client is built and the startup warm ups are done
+    report = resources.report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+# blocking tools are wrapped into coroutines running on the bounded executor
+tools_query = [
+    offload(retrieving_data_db),
+    retrieving_table_information,
+    retrieving_rag_info,
+    retrieving_data_rag,
+    translate_output
+]
+# model of every question when the router is disabled
+model_name = "gemini-2.5-flash"  # @param ["gemini-2.5-flash-lite","gemini-2.5-flash","gemini-2.5-pro"] {"allow-input":true}
+# lean protocol: the static context is part of the prompt and the answer is written directly
+# in the language of the user, so a data question needs one tool round trip instead of three
+tools_lean = [
+    offload(retrieving_data_db),
+    retrieving_data_rag
+]
+lean_system_instruction = f"""
+    ### **System Instruction Prompt for Bank ABC Fraud Detection Agent**
+
+    You are an AI analytics assistant for Bank ABC. Your primary task is to assist the internal team by answering any questions related to credit card transaction data and general knowledge about fraud.
+
+    **IMPORTANT**: Always write the final answer in the language of the user's question (e.g., Bahasa Indonesia or English).
+
+    -----
+
+    ### **Transaction Table**
+    {retrieving_table_information()}
+
+    ### **Available Documents**
+    {retrieving_rag_info()}
+
+    -----
+
+    ### **Available Tools**
+
+    * **`retrieving_data_db(query_syntax: str)`**: Executes a Google BigQuery SQL query on the transaction table above. Returns CSV with a header line `# total_rows=... returned_rows=... truncated=...`. Only the first rows of big results are returned, so aggregate in SQL (`SUM`, `COUNT`, `GROUP BY`, `LIMIT`) instead of selecting raw rows.
+    * **`retrieving_data_rag(question: str, document_name: str = None, page_from: int = None, page_to: int = None)`**: Searches the documents above by meaning and exact keywords and returns snippets (`page_content`) with their sources (`document_name`, `document_page`). Set `document_name` (and a page range) when the question is about one document.
+
+    ### **Rules**
+
+    1.  Transactional questions: write the SQL directly from the table description and call `retrieving_data_db()`. Use `ILIKE '%value%'` for `merchant` and `job`, `is_fraud = 1` for fraudulent transactions and BigQuery date functions (`TIMESTAMP_TRUNC`, `DATE_SUB`) for periods.
+    2.  General knowledge questions: call `retrieving_data_rag()` when the document summaries above suggest the answer is in the documents. Answer from the summaries alone when they already contain it.
+    3.  Combination questions: call both tools in the same turn, they run in parallel.
+    4.  If a tool returns no data (`[]` or `total_rows=0`), say that no data was found for the specified criteria.
+    5.  Summarize the results into a clear, concise answer and cite the document name and page for document facts."""
+routed_models = [model.strip() for model in ROUTER_TIERS] if ROUTER_ENABLED else [model_name]
+static_contexts = {
+    model: StaticContextCache(
+        client=client,
+        model_name=model,
+        system_instruction=lean_system_instruction,
+        tools=tools_lean,
+        ttl=CONTEXT_CACHE_TTL,
+        display_name=f"fraud-agent-static-context-{model}"
+    )
+    for model in dict.fromkeys(routed_models + [model_name])
+}
+static_context = static_contexts[model_name]
+model_router = ModelRouter(
+    tiers=routed_models,
+    max_escalations=ROUTER_MAX_ESCALATIONS,
+    default_latency_budget=ROUTER_LATENCY_BUDGET or None,
+    min_avg_logprobs=float(ROUTER_MIN_AVG_LOGPROBS) if ROUTER_MIN_AVG_LOGPROBS else None
+)
+agent_tools = {"lean": tools_lean, "classic": tools_query}
+# the warehouse tool may wait on a large BigQuery job, the others use the default TOOL_TIMEOUT
+tool_timeouts = {"retrieving_data_db": DB_TOOL_TIMEOUT}
+error_answer = "Terdapat kesalahan pada AI, mohon tunggu beberapa saat"
+
+# the prompt gets the rolling summary and the latest turns within the token budget
+memory = ConversationMemory(
+    history_store=history_store,
+    client=client,
+    model_name=MEMORY_SUMMARY_MODEL,
+    token_budget=MEMORY_TOKEN_BUDGET,
+    keep_turns=MEMORY_KEEP_TURNS
+)
+
+async def load_history(session_id: str) -> list:
+    # load chat history from the history store
+    with span("history.load", backend=HISTORY_BACKEND):
+        return await run_blocking(memory.build, session_id)
+
+def create_chat(history: list, mode: str = AGENT_MODE, model: str = None, max_output_tokens: int = None):
+    # function calls are executed by our agent loop (concurrently), not by the SDK
+    model = model or model_name
+    if mode == "lean":
+        config = static_contexts[model].generate_config(max_output_tokens=max_output_tokens)
     else:
-        output = blob.download_as_text()
-        chat_history_json = json.loads(output)
-        # manage memory
-        history = []
-        for history_temp in chat_history_json['chat_history']:
-            history.append(
-                types.Content(
-                    role=history_temp['role'],
-                    parts=[
-                    types.Part.from_text(text=history_temp['chat'])
-                    ]
-                )
-            )
-    tools_query = [
-        retrieving_data_db,
-        retrieving_table_information,
-        retrieving_rag_info,
-        retrieving_data_rag,
-        translate_output
-    ]
-    model_name = "gemini-2.5-flash"  # @param ["gemini-2.5-flash-lite","gemini-2.5-flash","gemini-2.5-pro"] {"allow-input":true}
-
-    chat = client.chats.create(
-        model=model_name,
-        config=types.GenerateContentConfig(
+        config = types.GenerateContentConfig(
             tools=tools_query,
-            system_instruction=system_instruction
-        ),
+            system_instruction=system_instruction,
+            max_output_tokens=max_output_tokens,
+            automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True)
+        )
+    return client.aio.chats.create(
+        model=model,
+        config=config,
         history=history
     )
-    try:
-        response = chat.send_message(data_input.user_input)
-        # managing chat history into json for dump into gcs
-        chat_history_list = []
-        for i in range(len(chat.get_history())):
-            if chat.get_history()[i].parts[0].text != None:
-                # check if there's any historical feedback or not
-                # using try because it's a local variable
-                try:
-                    if 'feedback_good_or_not' in chat_history_json['chat_history'][i]:
-                        feedback_good_or_not = chat_history_json['chat_history'][i]['feedback_good_or_not']
-                        feedback_text = chat_history_json['chat_history'][i]['feedback_text']
-                    else:
-                        feedback_good_or_not = 2 # default feedback
-                        feedback_text = "" # default feedback
-                # set to default
-                except:
-                        feedback_good_or_not = 2 # default feedback
-                        feedback_text = "" # default feedback                    
-                chat_history_temp ={"chat":chat.get_history()[i].parts[0].text,
-                                    "role":chat.get_history()[i].role,
-                                    "feedback_good_or_not": feedback_good_or_not,
-                                    "feedback_text": feedback_text
-                                    }
-                chat_history_list.append(chat_history_temp)
+
+async def answer_question(data_input: Chat_Data, history: list, stream: bool, result: dict):
+    """Runs the agent on the model tier of the question, an unreliable answer is retried on the next tier.
+
+    Args:
+        data_input (Chat_Data): question and budgets of the request
+        history (list): prompt history from load_history
+        stream (bool): stream the model output
+        result (dict): gets the chat of the returned answer under "chat", for save_new_turns
+
+    Yields:
+        the events of stream_agent, a "reset" is sent before a retry so the client drops
+        the draft of the weaker tier. "done" also carries the model of the answer.
+    """
+    route = model_router.route(data_input.user_input, len(history), data_input.latency_budget, data_input.token_budget)
+    annotate(**{"route.tier": route.tier, "route.reasons": ", ".join(route.reasons)})
+    plan = await lookup_plan(data_input, history)
+    start = time.perf_counter()
+    output_tokens = 0
+    while True:
+        model = route.model
+        chat_history, message = history, data_input.user_input
+        if plan is not None:
+            # the query of the template runs right away, the model only writes the answer from its result
+            signature, sql = plan
+            function_call = types.FunctionCall(name="retrieving_data_db", args={"query_syntax": sql})
+            yield "tool", {"name": function_call.name, "status": "running", "call": function_call_text(function_call)}
+            response = await execute_tool({tool.__name__: tool for tool in agent_tools[AGENT_MODE]}, function_call, DB_TOOL_TIMEOUT)
+            yield "tool", {"name": function_call.name, "status": "error" if "error" in response else "done"}
+            if "error" in response:
+                plan_cache.evict(signature, "query failed")
+                plan = None
             else:
-                continue
-        chat_history_json = {
-            "session_id": data_input.session_id,
-            "chat_history": chat_history_list
-        }                        
-        # dumping chat history into gcs
-        chat_history_gcs_path = f"gen-ai-memory/chat_history/{data_input.session_id}/history_{data_input.session_id}.json"
-        blob = bucket.blob(chat_history_gcs_path)
-        blob.upload_from_string(json.dumps(chat_history_json), content_type="application/json")
-        return {"ai_answer":response.text}
-    except:
-        logging.exception(str(traceback.format_exc()))
-        return {"ai_answer":"Terdapat kesalahan pada AI, mohon tunggu beberapa saat"}
+                chat_history = history + [
+                    types.Content(role="user", parts=[types.Part.from_text(text=data_input.user_input)]),
+                    types.Content(role="model", parts=[types.Part(function_call=function_call)])
+                ]
+                message = [types.Part.from_function_response(name=function_call.name, response=response)]
+        chat = create_chat(chat_history, model=model, max_output_tokens=route.token_budget)
+        attempt_start = time.perf_counter()
+        done, error = None, None
+        try:
+            async for event, data in stream_agent(chat, message, agent_tools[AGENT_MODE], tool_timeouts=tool_timeouts, stream=stream):
+                if event == "done":
+                    done = data
+                else:
+                    yield event, data
+        except Exception as e:
+            logging.warning(f"{model} failed: {type(e).__name__}: {e}")
+            error = e
+        usage = done["usage"] if done is not None else {}
+        output_tokens += usage.get("output", 0) + usage.get("thoughts", 0)
+        reason = model_router.assess(done and done["ai_answer"], error, done and done["tool_errors"], usage.get("avg_logprobs"))
+        next_model = model_router.escalate(route, reason, time.perf_counter() - start, output_tokens) if reason else None
+        model_router.record(data_input.session_id, model, usage, time.perf_counter() - attempt_start, failed=next_model is not None or error is not None)
+        if plan is not None and reason:
+            # the answer built on the template was not good enough, the retry plans the query again
+            plan_cache.evict(plan[0], reason)
+            plan = None
+        if next_model is None:
+            if done is None:
+                raise error
+            signature = plan[0] if plan is not None else None
+            if signature is None and reason is None:
+                signature = await learn_plan(data_input, history, chat)
+            if plan_cache is not None:
+                plan_cache.remember(data_input.session_id, signature)
+            annotate(**{"gen_ai.request.model": model, "route.escalations": route.escalations, "plan.signature": signature})
+            result["chat"] = chat
+            yield "done", {**done, "model": model}
+            return
+        yield "reset", {}
+
+async def lookup_plan(data_input: Chat_Data, history: list):
+    """(signature, filled query) of the plan cache template matching the first question of a session, or None."""
+    # a follow-up ("and in 2019?") depends on the previous turns, only first questions use templates
+    if plan_cache is None or history:
+        return None
+    with span("plan_cache.lookup") as lookup_span:
+        plan = await run_blocking(plan_cache.lookup, data_input.user_input)
+        lookup_span.set_attribute("cache.hit", plan is not None)
+    return plan
+
+async def learn_plan(data_input: Chat_Data, history: list, chat):
+    """Stores the query of an answer written with a single successful query as a template, returns its signature."""
+    if plan_cache is None or history:
+        return None
+    sql = planned_query(chat.get_history()[len(history):])
+    if sql is None:
+        return None
+    return await run_blocking(plan_cache.learn, data_input.user_input, sql)
+
+async def save_new_turns(session_id: str, chat, history_length: int):
+    # only the turns of this message are appended to the history store, the tool results
+    # are kept as compact references on the answer instead of the full results
+    new_contents = chat.get_history()[history_length:]
+    new_turns = []
+    for content in new_contents:
+        if content.parts and content.parts[0].text != None:
+            new_turns.append([content.parts[0].text, content.role, []])
+    if new_turns and new_turns[-1][1] == "model":
+        new_turns[-1][2] = collect_references(new_contents)
+    with span("history.save", backend=HISTORY_BACKEND, turns=len(new_turns)):
+        await run_blocking(history_store.append_turns, session_id, new_turns)
+    memory.schedule_fold(session_id)
+
+async def lookup_cached_answer(data_input: Chat_Data, history: list):
+    """Returns the semantic cache answer of a context-free question, the turns are still stored in the history."""
+    if semantic_cache is None or not is_context_free(data_input.user_input, len(history)):
+        return None
+    with span("semantic_cache.lookup") as lookup_span:
+        cached = await run_blocking(semantic_cache.safe_lookup, data_input.user_input)
+        lookup_span.set_attribute("cache.hit", cached is not None)
+    if cached is None:
+        return None
+    logging.info(f"semantic cache hit, similarity {cached['similarity']:.3f} with: {cached['question']}")
+    with span("history.save", backend=HISTORY_BACKEND, turns=2):
+        await run_blocking(history_store.append_turns, data_input.session_id, [(data_input.user_input, "user"), (cached["answer"], "model")])
+    return cached["answer"]
+
+async def store_cached_answer(data_input: Chat_Data, history: list, answer: str):
+    if semantic_cache is not None and answer and is_context_free(data_input.user_input, len(history)):
+        with span("semantic_cache.store"):
+            await run_blocking(semantic_cache.safe_store, data_input.user_input, answer)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def cache_report() -> dict:
+    # the lazy clients are not built by a stats read
+    return {
+        "embedding": embeddings.stats() if embeddings.ready else None,
+        "query": query_cache.stats(),
+        "mirror": mirror.stats() if mirror is not None else None,
+        "rollups": rollups.stats() if rollups is not None else None,
+        "cost_guard": cost_guard.stats() if cost_guard is not None else None,
+        "semantic": semantic_cache.stats() if semantic_cache is not None and semantic_cache.ready else None,
+        "plan": plan_cache.stats() if plan_cache is not None else None,
+        "context": {model: context.stats() for model, context in static_contexts.items()} if AGENT_MODE == "lean" else None,
+        "memory": memory.stats(),
+        "compression": context_compressor.stats() if context_compressor is not None else None,
+        "events": event_log.stats() if event_log is not None else None
+    }
+
+def pool_report() -> dict:
+    # checked out connections and checkout waits of the postgres pools
+    if not connector.ready:
+        return {}
+    return connector.pool_stats()
+
+# the same numbers are exposed as gauges on /metrics
+stats_collector.add("cache", cache_report)
+stats_collector.add("pool", pool_report)
+stats_collector.add("routing", model_router.stats)
+
+@app.get("/stats/cache")
+async def cache_stats():
+    return cache_report()
+
+@app.get("/stats/pool")
+async def pool_stats():
+    return pool_report()
+
+@app.get("/stats/routing")
+async def routing_stats():
+    # questions per tier, escalations and tokens and cost per model
+    return model_router.stats()
+
+@app.get("/stats/usage/{session_id}")
+async def session_usage(session_id: str):
+    # tokens and cost of a session by model
+    return model_router.session_usage(session_id)
+
+@app.get("/metrics")
+async def metrics():
+    # prometheus scrape endpoint: request and stage latencies, tool calls, tokens, bytes scanned and the stats above
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.post("/chatbot/ai-assistant")
+async def conversation(data_input:Chat_Data):
+    current_session_id.set(data_input.session_id)
+    start = time.perf_counter()
+    outcome = "error"
+    with span("chat.request", endpoint="chat", session_id=data_input.session_id) as request_span:
+        try:
+            history = await load_history(data_input.session_id)
+            cached = await lookup_cached_answer(data_input, history)
+            if cached is not None:
+                outcome = "cached"
+                return {"ai_answer":cached}
+            try:
+                result = {}
+                async for event, data in answer_question(data_input, history, False, result):
+                    if event == "done":
+                        answer = data["ai_answer"]
+                await save_new_turns(data_input.session_id, result["chat"], len(history))
+                await store_cached_answer(data_input, history, answer)
+                outcome = "ok"
+                return {"ai_answer":answer}
+            except:
+                logging.exception(str(traceback.format_exc()))
+                return {"ai_answer":error_answer}
+        finally:
+            request_span.set_attribute("chat.outcome", outcome)
+            REQUEST_SECONDS.labels("chat", outcome).observe(time.perf_counter() - start)
+
+@app.post("/chatbot/ai-assistant/stream")
+async def conversation_stream(data_input:Chat_Data):
+    """Same as /chatbot/ai-assistant but streams the answer as Server-Sent Events.
+
+    Events:
+        tool: progress of a function call, {"name": ..., "status": "running" | "done" | "error"}
+        token: a chunk of the answer, {"text": ...}
+        reset: the tokens sent so far were a draft and must be discarded, {}
+        done: the full answer, {"ai_answer": ..., "model": ..., "usage": {...}}
+        error: {"ai_answer": ...}
+    """
+    async def event_stream():
+        current_session_id.set(data_input.session_id)
+        start = time.perf_counter()
+        outcome = "error"
+        first_token = True
+        with span("chat.request", endpoint="stream", session_id=data_input.session_id) as request_span:
+            try:
+                history = await load_history(data_input.session_id)
+                cached = await lookup_cached_answer(data_input, history)
+                if cached is not None:
+                    outcome = "cached"
+                    yield sse_event("token", {"text": cached})
+                    yield sse_event("done", {"ai_answer": cached})
+                    return
+                result = {}
+                async for event, data in answer_question(data_input, history, True, result):
+                    if event == "token" and first_token:
+                        first_token = False
+                        FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                    if event == "done":
+                        await save_new_turns(data_input.session_id, result["chat"], len(history))
+                        await store_cached_answer(data_input, history, data["ai_answer"])
+                        outcome = "ok"
+                    yield sse_event(event, data)
+            except:
+                logging.exception(str(traceback.format_exc()))
+                yield sse_event("error", {"ai_answer":error_answer})
+            finally:
+                request_span.set_attribute("chat.outcome", outcome)
+                REQUEST_SECONDS.labels("stream", outcome).observe(time.perf_counter() - start)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/chatbot/feedback-user")
-def feedback(data_input:Feedback_Data):
-    # load metadata post from gcs
-    storage_client = storage.Client()
-    blob_name = f"gen-ai-memory/chat_history/{data_input.session_id}/history_{data_input.session_id}.json"
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.get_blob(blob_name)
-    if blob == None:
+async def feedback(data_input:Feedback_Data):
+    # add feedback on the latest answer, stored as a new record instead of rewriting the history
+    with span("history.feedback", backend=HISTORY_BACKEND, session_id=data_input.session_id):
+        stored = await run_blocking(history_store.set_feedback, data_input.session_id, data_input.feedback_good_or_not, data_input.feedback_text)
+    if not stored:
         return "There is no historical data"
-    else:
-        output = blob.download_as_text()
-        chat_history_json = json.loads(output)
-        # add feedback on the latest answer
-        chat_history_json['chat_history'][-1]['feedback_good_or_not'] = data_input.feedback_good_or_not
-        chat_history_json['chat_history'][-1]['feedback_text'] = data_input.feedback_text                       
-        # replacing the history json with the one that have feedback
-        chat_history_gcs_path = f"gen-ai-memory/chat_history/{data_input.session_id}/history_{data_input.session_id}.json"
-        blob = bucket.blob(chat_history_gcs_path)
-        blob.upload_from_string(json.dumps(chat_history_json), content_type="application/json")
-        return "feedback is stored"
+    if plan_cache is not None and data_input.feedback_good_or_not == 0:
+        # the query template behind a bad answer is not reused
+        plan_cache.evict_session(data_input.session_id)
+    return "feedback is stored"
    
 
 # @app.post("/chatbot/upload_to_sql")
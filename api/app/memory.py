@@ -0,0 +1,173 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from google.genai import types
+
+from concurrency import run_blocking
+from telemetry import span, record_usage
+
+# conversation memory within a token budget: the prompt gets the rolling summary of the
+# older turns plus the latest turns verbatim. Turns falling out of the window are folded
+# into the summary in the background after the answer, so the prompt size (and the
+# latency of a turn) stays flat however long the session is. Tool results are never
+# replayed, the model turn keeps a compact reference (the SQL and a few result lines).
+SUMMARY_PROMPT = """You maintain the running summary of a conversation between a user and a fraud analytics assistant.
+Update the summary with the new turns. Keep the facts the user may refer to later: the questions asked, the numbers,
+categories, merchants and periods in the answers, the SQL filters used and the documents cited. Write in the language
+of the conversation, at most {max_words} words, without a preamble.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}"""
+REFERENCE_MAX_CHARS = 400
+
+
+def estimate_tokens(text: str) -> int:
+    # about 4 characters per token for Gemini on English and Indonesian text, no network call
+    return len(text) // 4 + 1
+
+
+def tool_reference(name: str, args: dict, response: dict) -> str:
+    """Compact reference of a tool result kept with the answer instead of the full result."""
+    if "error" in response:
+        result = f"error: {response['error']}"
+    else:
+        result = response.get("result")
+        if isinstance(result, list):
+            # rag snippets, only the sources are kept
+            result = "; ".join(f"{item.get('document_name')} p.{item.get('document_page')}" for item in result if isinstance(item, dict))
+        else:
+            result = " | ".join(str(result).splitlines()[:4])
+    call = args.get("query_syntax") or args.get("question") or json.dumps(args, default=str)
+    return f"{name}: {call} -> {result}"[:REFERENCE_MAX_CHARS]
+
+
+def collect_references(contents: list) -> list:
+    """References of the function calls and responses in the contents of one message."""
+    calls = []
+    references = []
+    for content in contents:
+        for part in content.parts or []:
+            if part.function_call is not None:
+                calls.append(part.function_call)
+            elif part.function_response is not None:
+                # responses come back in the order of the calls
+                function_call = calls.pop(0) if calls else None
+                args = dict(function_call.args or {}) if function_call is not None else {}
+                references.append(tool_reference(part.function_response.name, args, part.function_response.response or {}))
+    return references
+
+
+class ConversationMemory:
+    """Builds the prompt history of a session within a token budget and maintains the summary.
+
+    Args:
+        history_store: ChatHistoryStore of the sessions
+        client: google-genai client used for the summaries
+        model_name (str): model writing the summaries
+        token_budget (int): max estimated tokens of the summary and verbatim turns
+        keep_turns (int): max number of verbatim turns
+        fold_min_turns (int): turns out of the window needed before a new summary is written
+        summary_max_words (int): length limit of the summary
+    """
+    def __init__(self, history_store, client, model_name: str, token_budget: int = 4000, keep_turns: int = 10, fold_min_turns: int = 4, summary_max_words: int = 250):
+        self._history_store = history_store
+        self._client = client
+        self._model_name = model_name
+        self._token_budget = token_budget
+        self._keep_turns = keep_turns
+        self._fold_min_turns = fold_min_turns
+        self._summary_max_words = summary_max_words
+        self._folding = set()
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self.folds = 0
+        self.fold_failures = 0
+        self._fold_seconds = 0.0
+
+    @staticmethod
+    def render_turn(turn: dict) -> str:
+        if turn.get("references"):
+            return turn["chat"] + "\n\n[tool results used]\n" + "\n".join(turn["references"])
+        return turn["chat"]
+
+    def window_start(self, summary: str, turns: list) -> int:
+        """Index of the first turn kept verbatim, the window always starts on a user turn."""
+        budget = self._token_budget - (estimate_tokens(summary) if summary else 0)
+        start = len(turns)
+        used = 0
+        for index in range(len(turns) - 1, -1, -1):
+            used += estimate_tokens(self.render_turn(turns[index]))
+            # the latest exchange is kept even when it alone is over budget
+            if len(turns) - index > 2 and (used > budget or len(turns) - index > self._keep_turns):
+                break
+            start = index
+        while start < len(turns) and turns[start]["role"] != "user":
+            start += 1
+        return start
+
+    def build(self, session_id: str) -> list:
+        """Returns the history of the session as types.Content for the next message."""
+        summary, _, turns = self._history_store.load_memory(session_id)
+        start = self.window_start(summary, turns)
+        history = []
+        if summary:
+            history.append(types.Content(role="user", parts=[types.Part.from_text(text=f"Summary of the earlier conversation:\n{summary}")]))
+            history.append(types.Content(role="model", parts=[types.Part.from_text(text="Noted, I will use this summary as context.")]))
+        for turn in turns[start:]:
+            history.append(types.Content(role=turn["role"], parts=[types.Part.from_text(text=self.render_turn(turn))]))
+        return history
+
+    async def fold(self, session_id: str):
+        """Folds the turns before the window into the summary when there are enough of them."""
+        with self._lock:
+            if session_id in self._folding:
+                return
+            self._folding.add(session_id)
+        try:
+            summary, covered_turns, turns = await run_blocking(self._history_store.load_memory, session_id)
+            start = self.window_start(summary, turns)
+            if start < self._fold_min_turns:
+                return
+            begin = time.perf_counter()
+            prompt = SUMMARY_PROMPT.format(
+                max_words=self._summary_max_words,
+                summary=summary or "(empty)",
+                turns="\n".join(f"{turn['role']}: {self.render_turn(turn)}" for turn in turns[:start])
+            )
+            with span("memory.fold", session_id=session_id, turns=start):
+                response = await self._client.aio.models.generate_content(model=self._model_name, contents=prompt)
+                record_usage(response.usage_metadata)
+            await run_blocking(self._history_store.set_summary, session_id, response.text.strip(), covered_turns + start)
+            with self._lock:
+                self.folds += 1
+                self._fold_seconds += time.perf_counter() - begin
+        except Exception:
+            # the window still bounds the prompt, the fold is retried after the next message
+            logging.exception(str(traceback.format_exc()))
+            with self._lock:
+                self.fold_failures += 1
+        finally:
+            with self._lock:
+                self._folding.discard(session_id)
+
+    def schedule_fold(self, session_id: str):
+        """Runs fold in the background, the answer does not wait for the summary."""
+        task = asyncio.get_running_loop().create_task(self.fold(session_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> dict:
+        return {
+            "folds": self.folds,
+            "fold_failures": self.fold_failures,
+            "fold_avg_seconds": self._fold_seconds / self.folds if self.folds else 0.0,
+            "token_budget": self._token_budget,
+            "keep_turns": self._keep_turns,
+        }
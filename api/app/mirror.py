@@ -0,0 +1,202 @@
+import os
+import time
+import logging
+import threading
+import traceback
+from datetime import datetime
+
+# optional local mirror of the fraud_data table: a parquet snapshot of the BigQuery table
+# is loaded into an embedded DuckDB database and the BigQuery SQL written by the model is
+# transpiled to DuckDB with sqlglot. Queries the mirror can not serve go to BigQuery.
+# duckdb, sqlglot and pyarrow are only imported when the mirror is used.
+FRAUD_TABLE = "sandbox-project-471504.mekari_challenge_tabular_data.fraud_data"
+
+
+class MirrorUnavailable(Exception):
+    """The query can not be answered by the local mirror."""
+
+
+class LocalMirror:
+    """Embedded DuckDB copy of a BigQuery table.
+
+    Args:
+        parquet_path (str): location of the parquet snapshot
+        table_id (str): fully qualified BigQuery table that is mirrored
+        local_name (str): name of the table inside DuckDB
+        refresh_interval (float): seconds between two snapshots when the refresh thread runs
+    """
+    def __init__(self, parquet_path: str, table_id: str = FRAUD_TABLE, local_name: str = "fraud_data", refresh_interval: float = 3600):
+        self._parquet_path = parquet_path
+        self._table_id = table_id
+        self._local_name = local_name
+        self._refresh_interval = refresh_interval
+        self._connection = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.loaded_at = None
+        self.row_count = 0
+        # last modified time of the BigQuery table when the snapshot was taken
+        self.source_modified = None
+
+    @property
+    def ready(self) -> bool:
+        return self._connection is not None
+
+    def snapshot(self, bigquery_client=None):
+        """Exports the BigQuery table into the parquet snapshot and reloads the mirror."""
+        import pyarrow.parquet as pq
+        if bigquery_client is None:
+            from warehouse import get_bigquery_client
+            bigquery_client = get_bigquery_client()
+        start = time.perf_counter()
+        # read before the rows so a write during the export makes the snapshot look older, not newer
+        source_modified = bigquery_client.get_table(self._table_id).modified
+        table = bigquery_client.list_rows(self._table_id).to_arrow(create_bqstorage_client=True)
+        # kept in the parquet metadata, a snapshot loaded at startup knows how old it is
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"source_modified": source_modified.isoformat().encode()})
+        os.makedirs(os.path.dirname(os.path.abspath(self._parquet_path)), exist_ok=True)
+        # write next to the old snapshot and swap so a reader never sees a partial file
+        tmp_path = f"{self._parquet_path}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self._parquet_path)
+        logging.info(f"snapshot of {self._table_id} with {table.num_rows} rows written in {time.perf_counter() - start:.3f}s")
+        self.load()
+
+    def load(self):
+        """Loads the parquet snapshot into a new DuckDB database and swaps it in."""
+        import duckdb
+        import pyarrow.parquet as pq
+        metadata = pq.read_schema(self._parquet_path).metadata or {}
+        source_modified = datetime.fromisoformat(metadata[b"source_modified"].decode()) if b"source_modified" in metadata else None
+        connection = duckdb.connect(database=":memory:")
+        # BigQuery timestamps are UTC
+        connection.execute("SET GLOBAL TimeZone = 'UTC'")
+        connection.execute(f"CREATE TABLE {self._local_name} AS SELECT * FROM read_parquet(?)", [self._parquet_path])
+        row_count = connection.execute(f"SELECT COUNT(*) FROM {self._local_name}").fetchone()[0]
+        # the old database is released once the queries still running on its cursors finish
+        with self._lock:
+            self._connection = connection
+            self.loaded_at = time.time()
+            self.row_count = row_count
+            self.source_modified = source_modified
+
+    def is_current(self, table_modified) -> bool:
+        """False when the BigQuery table was modified after the snapshot or the snapshot age is unknown.
+
+        Args:
+            table_modified: last modified time of the BigQuery table, None when unknown
+        """
+        source_modified = self.source_modified
+        if source_modified is None:
+            return False
+        return table_modified is None or table_modified <= source_modified
+
+    def start_refresh(self):
+        """Starts a daemon thread taking a new snapshot every refresh_interval seconds."""
+        def refresh():
+            while not self._stop.wait(self._refresh_interval):
+                try:
+                    self.snapshot()
+                except Exception:
+                    logging.exception(str(traceback.format_exc()))
+        threading.Thread(target=refresh, name="mirror-refresh", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _is_mirrored(self, table) -> bool:
+        parts = [part for part in (table.catalog, table.db, table.name) if part]
+        return ".".join(parts) == self._table_id or (len(parts) == 1 and parts[0] == self._local_name)
+
+    def transpile(self, sql: str) -> str:
+        """Transpiles a BigQuery query on the mirrored table to DuckDB.
+
+        Raises:
+            MirrorUnavailable: the query references another table, can not be parsed,
+                or is not a read-only query
+        """
+        import sqlglot
+        from sqlglot import exp
+        try:
+            statements = sqlglot.parse(sql, read="bigquery")
+        except sqlglot.errors.ParseError as e:
+            raise MirrorUnavailable(f"Can not parse query: {e}")
+        if len(statements) != 1 or not isinstance(statements[0], exp.Query):
+            raise MirrorUnavailable("Only single SELECT queries are served by the mirror")
+        tree = statements[0]
+        cte_names = {cte.alias for cte in tree.find_all(exp.CTE)}
+
+        def replace_table(node):
+            if isinstance(node, exp.Table):
+                if not node.db and node.name in cte_names:
+                    return node
+                if not self._is_mirrored(node):
+                    raise MirrorUnavailable(f"Table {node.sql(dialect='bigquery')} is not mirrored")
+                local_table = exp.to_table(self._local_name)
+                return local_table.as_(node.alias) if node.alias else local_table
+            return node
+
+        try:
+            return tree.transform(replace_table).sql(dialect="duckdb")
+        except sqlglot.errors.SqlglotError as e:
+            raise MirrorUnavailable(f"Can not transpile query: {e}")
+
+    def execute(self, sql: str, max_rows: int = 200):
+        """Runs a BigQuery query on the mirror.
+
+        Returns:
+            (columns, rows, total_rows) with at most max_rows rows.
+
+        Raises:
+            MirrorUnavailable: the mirror is not loaded or can not serve the query
+        """
+        if self._connection is None:
+            raise MirrorUnavailable("Mirror is not loaded")
+        local_sql = self.transpile(sql)
+        with self._lock:
+            # a cursor is a separate connection to the same database, safe to use from this thread
+            cursor = self._connection.cursor()
+        try:
+            # the query runs once: the first max_rows rows are converted to python, the
+            # batches after them are only counted
+            reader = cursor.execute(local_sql).fetch_record_batch(max(max_rows, 1))
+            columns = list(reader.schema.names)
+            rows = []
+            total_rows = 0
+            for batch in reader:
+                total_rows += batch.num_rows
+                if len(rows) < max_rows:
+                    data = batch.to_pydict()
+                    rows.extend(zip(*(data[column] for column in columns)))
+            rows = rows[:max_rows]
+        except Exception as e:
+            # the dialects do not match 100%, BigQuery will answer instead
+            raise MirrorUnavailable(f"Mirror execution failed: {e}")
+        finally:
+            cursor.close()
+        return columns, rows, total_rows
+
+    def distinct_values(self, column: str, max_values: int = 5000):
+        """Distinct non-null values of a column as strings, None for an unknown column or more than max_values values."""
+        if self._connection is None:
+            return None
+        with self._lock:
+            cursor = self._connection.cursor()
+        try:
+            columns = {row[0] for row in cursor.execute(f"DESCRIBE {self._local_name}").fetchall()}
+            if column not in columns:
+                return None
+            rows = cursor.execute(
+                f'SELECT DISTINCT CAST("{column}" AS VARCHAR) FROM {self._local_name} WHERE "{column}" IS NOT NULL LIMIT {max_values + 1}'
+            ).fetchall()
+        finally:
+            cursor.close()
+        return [row[0] for row in rows] if len(rows) <= max_values else None
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "row_count": self.row_count,
+            "loaded_at": self.loaded_at,
+            "source_modified": self.source_modified.isoformat() if self.source_modified else None,
+        }
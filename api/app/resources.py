@@ -0,0 +1,139 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from concurrency import run_blocking
+
+# lazily built clients and connections: nothing is created at import time, a resource is
+# built on first use or by the startup hook which builds all of them concurrently, so a
+# cold start does not pay for Secret Manager, the genai client, the embeddings and the
+# Cloud SQL engine one after another. Every init is timed for the startup report.
+
+
+class LazyResource:
+    """Proxy building its object on first use, attribute access goes to the object.
+
+    Args:
+        name (str): name in the startup report
+        factory: callable building the object, may use other lazy resources
+        required (bool): the instance is not ready until the resource is built
+    """
+    def __init__(self, name: str, factory, required: bool = True):
+        self._name = name
+        self._factory = factory
+        self._required = required
+        self._object = None
+        self._lock = threading.Lock()
+        self.init_seconds = None
+        self.error = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def required(self) -> bool:
+        return self._required
+
+    @property
+    def ready(self) -> bool:
+        return self._object is not None
+
+    def get(self):
+        """Returns the object, building it first if needed."""
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    start = time.perf_counter()
+                    try:
+                        self._object = self._factory()
+                        self.error = None
+                    except Exception as e:
+                        # not cached, the next use tries again
+                        self.error = f"{type(e).__name__}: {e}"
+                        raise
+                    finally:
+                        self.init_seconds = time.perf_counter() - start
+        return self._object
+
+    def override(self, obj):
+        """Replaces the object without building it, used by the offline benchmarks."""
+        with self._lock:
+            self._object = obj
+            self.init_seconds = 0.0
+            self.error = None
+
+    def __getattr__(self, attribute):
+        return getattr(self.get(), attribute)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+
+class ResourceRegistry:
+    """Lazy resources and timed startup steps of the instance."""
+    def __init__(self):
+        self._resources = []
+        self._steps = {}
+        self.started = False
+
+    def lazy(self, name: str, factory, required: bool = True) -> LazyResource:
+        resource = LazyResource(name, factory, required)
+        self._resources.append(resource)
+        return resource
+
+    def _safe_get(self, resource: LazyResource):
+        try:
+            resource.get()
+        except Exception:
+            logging.exception(str(traceback.format_exc()))
+
+    async def initialize(self):
+        """Builds every resource concurrently on the blocking executor.
+
+        A resource shared by others (e.g. the secret) is built once, the others wait on it.
+        """
+        await asyncio.gather(*(run_blocking(self._safe_get, resource) for resource in self._resources))
+
+    async def step(self, name: str, coroutine):
+        """Awaits a startup step (warm up, refresh threads) and records its duration, errors are logged."""
+        start = time.perf_counter()
+        try:
+            await coroutine
+            self._steps[name] = {"seconds": time.perf_counter() - start, "error": None}
+        except Exception as e:
+            logging.exception(str(traceback.format_exc()))
+            self._steps[name] = {"seconds": time.perf_counter() - start, "error": f"{type(e).__name__}: {e}"}
+
+    def record(self, name: str, seconds: float):
+        self._steps[name] = {"seconds": seconds, "error": None}
+
+    @property
+    def ready(self) -> bool:
+        return self.started and all(resource.ready for resource in self._resources if resource.required)
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "started": self.started,
+            "resources": {
+                resource.name: {
+                    "ready": resource.ready,
+                    "required": resource.required,
+                    "seconds": resource.init_seconds,
+                    "error": resource.error,
+                }
+                for resource in self._resources
+            },
+            "steps": dict(self._steps),
+        }
+
+    def log_report(self):
+        # one line with the cost of every dependency, to compare cold starts
+        logging.info(json.dumps({"event": "startup_report", **self.report()}))
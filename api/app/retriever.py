@@ -0,0 +1,379 @@
+import json
+import uuid
+import time
+import logging
+import argparse
+import threading
+
+import sqlalchemy
+
+from caches.lru import TTLCache
+from concurrency import run_blocking
+from telemetry import span
+
+# long-lived retriever over the PGVector tables created by langchain_postgres
+# (langchain_pg_collection / langchain_pg_embedding). It is built once at startup, the
+# collection id is cached and the search is a single SQL statement using the indexes
+# created by `python retriever.py create-index`: the HNSW index for the vector search, a
+# full-text GIN index for exact keywords (e.g. "SCA", "skimming") and a btree index on the
+# document and page for the filters. The vector and keyword rankings are merged with
+# reciprocal rank fusion.
+COLLECTION_TABLE = "langchain_pg_collection"
+EMBEDDING_TABLE = "langchain_pg_embedding"
+# pgvector can only index `vector` up to 2000 dimensions, bigger embeddings
+# (gemini-embedding-001 is 3072) are indexed as halfvec
+MAX_VECTOR_INDEX_DIM = 2000
+# the documents are in English, the same configuration is used by the index and the queries
+TEXT_SEARCH_CONFIG = "english"
+# standard constant of reciprocal rank fusion, dampens the weight of the top ranks
+RRF_K = 60
+
+
+class VectorRetriever:
+    """Similarity search on a PGVector collection with cached collection metadata.
+
+    Args:
+        engine: sqlalchemy engine of the vector database
+        embeddings: langchain embeddings used to embed the question
+        collection_name (str): name of the PGVector collection
+        embedding_dim (int): dimension of the stored embeddings
+        ef_search (int): hnsw.ef_search used for every query, higher is more accurate but slower
+        async_engine: coroutine function returning the async engine used by asearch, optional
+        hybrid (bool): fuse the vector search with the full-text search
+        candidates (int): number of results of each ranking before the fusion
+    """
+    def __init__(self, engine, embeddings, collection_name: str = "rag_data", embedding_dim: int = 3072, ef_search: int = 40, async_engine=None, hybrid: bool = True, candidates: int = 20):
+        self._engine = engine
+        self._async_engine = async_engine
+        self._hybrid = hybrid
+        self._candidates = candidates
+        self._documents = TTLCache(max_size=1, ttl=300)
+        self._embeddings = embeddings
+        self._collection_name = collection_name
+        self._embedding_dim = embedding_dim
+        self._ef_search = ef_search
+        self._collection_id = None
+        self._lock = threading.Lock()
+        self._version = TTLCache(max_size=1, ttl=60)
+
+    @property
+    def vector_type(self) -> str:
+        if self._embedding_dim <= MAX_VECTOR_INDEX_DIM:
+            return f"vector({self._embedding_dim})"
+        return f"halfvec({self._embedding_dim})"
+
+    @property
+    def index_name(self) -> str:
+        return f"ix_{self._collection_name}_embedding_hnsw"
+
+    @property
+    def text_index_name(self) -> str:
+        return f"ix_{self._collection_name}_document_fts"
+
+    @property
+    def metadata_index_name(self) -> str:
+        return f"ix_{self._collection_name}_doc_page"
+
+    def collection_id(self) -> str:
+        """Returns the uuid of the collection, only looked up once per process."""
+        if self._collection_id is None:
+            with self._lock:
+                if self._collection_id is None:
+                    select_collection = sqlalchemy.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name")
+                    with self._engine.connect() as db_conn:
+                        row = db_conn.execute(select_collection, {"name": self._collection_name}).fetchone()
+                    if row is None:
+                        raise ValueError(f"Collection {self._collection_name} not found")
+                    # validated as uuid so it can be inlined in the query and match the partial index
+                    self._collection_id = str(uuid.UUID(str(row[0])))
+        return self._collection_id
+
+    def collection_version(self) -> str:
+        """Version of the documents of the collection, bumped by the ingestion pipeline on every page replacement.
+
+        Cached for 60 seconds.
+        """
+        version = self._version.get("version")
+        if version is None:
+            select_version = sqlalchemy.text(f"SELECT cmetadata->>'version' FROM {COLLECTION_TABLE} WHERE uuid = :collection_id")
+            with self._engine.connect() as db_conn:
+                # collections written before the pipeline kept a version are version 0
+                version = db_conn.execute(select_version, {"collection_id": self.collection_id()}).scalar() or "0"
+            self._version.put("version", version)
+        return version
+
+    def documents(self) -> list:
+        """Names of the documents of the collection, cached for 5 minutes."""
+        documents = self._documents.get("documents")
+        if documents is None:
+            select_documents = sqlalchemy.text(f"SELECT DISTINCT cmetadata->>'doc' FROM {EMBEDDING_TABLE} WHERE collection_id = :collection_id")
+            with self._engine.connect() as db_conn:
+                documents = sorted(row[0] for row in db_conn.execute(select_documents, {"collection_id": self.collection_id()}) if row[0])
+            self._documents.put("documents", documents)
+        return documents
+
+    def resolve_documents(self, document_name: str, documents: list) -> list:
+        """Document names matching the name given by the model, exact match first then case-insensitive substring."""
+        if document_name in documents:
+            return [document_name]
+        needle = document_name.lower().strip()
+        return [document for document in documents if needle in document.lower() or document.lower() in needle]
+
+    def _filters(self, documents: list = None, page_from: int = None, page_to: int = None):
+        # same expressions as the metadata index so the planner can use it
+        conditions = []
+        params = {}
+        if documents is not None:
+            conditions.append("cmetadata->>'doc' = ANY(:documents)")
+            params["documents"] = documents
+        if page_from is not None:
+            conditions.append("(cmetadata->>'page')::int >= :page_from")
+            params["page_from"] = int(page_from)
+        if page_to is not None:
+            conditions.append("(cmetadata->>'page')::int <= :page_to")
+            params["page_to"] = int(page_to)
+        return conditions, params
+
+    def _hybrid_query(self, collection_id: str, conditions: list):
+        """Vector and full-text rankings fused with reciprocal rank fusion.
+
+        Without filters the vector ranking walks the HNSW index. With filters the matching
+        rows are selected first through the metadata index and ranked exactly, so a filter
+        never empties the ANN result and the cost is bounded by the filtered rows.
+        """
+        distance = f"embedding::{self.vector_type} <=> CAST(CAST(:embedding AS TEXT) AS {self.vector_type})"
+        text_vector = f"to_tsvector('{TEXT_SEARCH_CONFIG}', document)"
+        # any term of the question matches (OR), a question rarely has all its words in one
+        # chunk; ts_rank_cd still ranks the chunks with more of the terms first
+        text_query = f"CAST(replace(CAST(plainto_tsquery('{TEXT_SEARCH_CONFIG}', :question) AS TEXT), '&', '|') AS tsquery)"
+        if conditions:
+            source = "filtered"
+            prefix = f"""
+            filtered AS MATERIALIZED (
+                SELECT id, embedding, document FROM {EMBEDDING_TABLE}
+                WHERE collection_id = '{collection_id}' AND {" AND ".join(conditions)}
+            ),"""
+            scope = "TRUE"
+        else:
+            source = EMBEDDING_TABLE
+            prefix = ""
+            scope = f"collection_id = '{collection_id}'"
+        return sqlalchemy.text(f"""
+            WITH {prefix}
+            vector_rank AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+                FROM (SELECT id, {distance} AS distance FROM {source} WHERE {scope} ORDER BY distance LIMIT :candidates) AS nearest
+            ),
+            text_rank AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+                FROM (
+                    SELECT id, ts_rank_cd({text_vector}, {text_query}) AS score FROM {source}
+                    WHERE {scope} AND {text_vector} @@ {text_query}
+                    ORDER BY score DESC LIMIT :candidates
+                ) AS matches
+            )
+            SELECT e.document, e.cmetadata,
+                COALESCE(1.0 / ({RRF_K} + v.rank), 0) + COALESCE(1.0 / ({RRF_K} + t.rank), 0) AS score
+            FROM vector_rank v
+            FULL OUTER JOIN text_rank t ON t.id = v.id
+            JOIN {EMBEDDING_TABLE} e ON e.id = COALESCE(v.id, t.id)
+            ORDER BY score DESC
+            LIMIT :k""")
+
+    def _search_query(self, collection_id: str):
+        return sqlalchemy.text(f"""
+            SELECT document, cmetadata
+            FROM {EMBEDDING_TABLE}
+            WHERE collection_id = '{collection_id}'
+            ORDER BY embedding::{self.vector_type} <=> CAST(CAST(:embedding AS TEXT) AS {self.vector_type})
+            LIMIT :k""")
+
+    def search_by_vector(self, embedding: list, k: int = 4) -> list:
+        """Returns the k nearest chunks of the embedding as list of (page_content, metadata)."""
+        query = self._search_query(self.collection_id())
+        with self._engine.begin() as db_conn:
+            db_conn.execute(sqlalchemy.text(f"SET LOCAL hnsw.ef_search = {int(self._ef_search)}"))
+            rows = db_conn.execute(query, {"embedding": _vector_literal(embedding), "k": k}).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def _hybrid_statement(self, collection_id: str, question: str, embedding: list, k: int, documents: list, page_from: int, page_to: int):
+        conditions, params = self._filters(documents, page_from, page_to)
+        params.update({"embedding": _vector_literal(embedding), "question": question, "k": k, "candidates": max(self._candidates, k)})
+        return self._hybrid_query(collection_id, conditions), params
+
+    def search(self, question: str, k: int = 4, document_name: str = None, page_from: int = None, page_to: int = None) -> list:
+        """Embeds the question and returns the k best chunks.
+
+        Args:
+            question (str): question used for both the vector and the keyword search
+            k (int): number of chunks
+            document_name (str): only search this document
+            page_from (int): only search from this page
+            page_to (int): only search up to this page
+
+        Returns:
+            A list of dictionaries with keys page_content, document_name and document_page.
+        """
+        documents = self.resolve_documents(document_name, self.documents()) if document_name else None
+        if documents == []:
+            return []
+        with span("rag.embedding"):
+            embedding = self._embeddings.embed_query(question)
+        with span("rag.vector_search", hybrid=self._hybrid):
+            if not self._hybrid and documents is None and page_from is None and page_to is None:
+                return _to_documents(self.search_by_vector(embedding, k=k))
+            query, params = self._hybrid_statement(self.collection_id(), question, embedding, k, documents, page_from, page_to)
+            with self._engine.begin() as db_conn:
+                db_conn.execute(sqlalchemy.text(f"SET LOCAL hnsw.ef_search = {int(self._ef_search)}"))
+                rows = db_conn.execute(query, params).fetchall()
+        return _to_documents([(row[0], row[1]) for row in rows])
+
+    async def _acollection_id(self, engine) -> str:
+        if self._collection_id is None:
+            select_collection = sqlalchemy.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name")
+            async with engine.connect() as db_conn:
+                row = (await db_conn.execute(select_collection, {"name": self._collection_name})).fetchone()
+            if row is None:
+                raise ValueError(f"Collection {self._collection_name} not found")
+            self._collection_id = str(uuid.UUID(str(row[0])))
+        return self._collection_id
+
+    async def asearch(self, question: str, k: int = 4, document_name: str = None, page_from: int = None, page_to: int = None) -> list:
+        """Same as search, on the async engine when there is one (no executor thread is held
+        while waiting on the pool) and on the executor otherwise."""
+        if self._async_engine is None:
+            return await run_blocking(self.search, question, k, document_name, page_from, page_to)
+        engine = await self._async_engine()
+        collection_id = await self._acollection_id(engine)
+        documents = None
+        if document_name:
+            documents = self._documents.get("documents")
+            if documents is None:
+                async with engine.connect() as db_conn:
+                    result = await db_conn.execute(
+                        sqlalchemy.text(f"SELECT DISTINCT cmetadata->>'doc' FROM {EMBEDDING_TABLE} WHERE collection_id = :collection_id"),
+                        {"collection_id": collection_id}
+                    )
+                    documents = sorted(row[0] for row in result.fetchall() if row[0])
+                self._documents.put("documents", documents)
+            documents = self.resolve_documents(document_name, documents)
+            if not documents:
+                return []
+        # the embedding call is blocking (cached most of the time)
+        with span("rag.embedding"):
+            embedding = await run_blocking(self._embeddings.embed_query, question)
+        if not self._hybrid and documents is None and page_from is None and page_to is None:
+            query, params = self._search_query(collection_id), {"embedding": _vector_literal(embedding), "k": k}
+        else:
+            query, params = self._hybrid_statement(collection_id, question, embedding, k, documents, page_from, page_to)
+        with span("rag.vector_search", hybrid=self._hybrid):
+            async with engine.begin() as db_conn:
+                await db_conn.execute(sqlalchemy.text(f"SET LOCAL hnsw.ef_search = {int(self._ef_search)}"))
+                rows = (await db_conn.execute(query, params)).fetchall()
+        return _to_documents([(row[0], row[1]) for row in rows])
+
+    def warm_up(self, connections: int = 2):
+        """Primes the connection pool, caches the collection id and loads the index pages.
+
+        Args:
+            connections (int): number of pooled connections to open
+        """
+        start = time.perf_counter()
+        self.collection_id()
+        # open the connections at the same time so the pool really keeps several of them
+        db_conns = [self._engine.connect() for _ in range(connections)]
+        try:
+            for db_conn in db_conns:
+                db_conn.execute(sqlalchemy.text("SELECT 1"))
+        finally:
+            for db_conn in db_conns:
+                db_conn.close()
+        with self._engine.connect() as db_conn:
+            try:
+                db_conn.execute(sqlalchemy.text("SELECT pg_prewarm(CAST(:index_name AS regclass))"), {"index_name": self.index_name})
+            except sqlalchemy.exc.DBAPIError:
+                # pg_prewarm is not installed or the index does not exist yet
+                db_conn.rollback()
+        # one search with a dummy unit vector walks the index without an embedding call
+        self.search_by_vector([1.0] + [0.0] * (self._embedding_dim - 1), k=1)
+        logging.info(f"vector retriever warmed up in {time.perf_counter() - start:.3f}s")
+
+    def create_index(self, m: int = 16, ef_construction: int = 64, maintenance_work_mem: str = "512MB", recreate: bool = False):
+        """Creates the HNSW, full-text and metadata indexes of the collection and analyzes the table.
+
+        Args:
+            m (int): max number of connections per layer of the HNSW graph
+            ef_construction (int): size of the candidate list while building the graph
+            maintenance_work_mem (str): memory used by the build, the build is much faster when the graph fits
+            recreate (bool): drop the index first, needed to change m or ef_construction
+        """
+        ops = "halfvec_cosine_ops" if self.vector_type.startswith("halfvec") else "vector_cosine_ops"
+        with self._engine.connect() as db_conn:
+            db_conn.execute(sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS vector"))
+            db_conn.execute(sqlalchemy.text(f"SET maintenance_work_mem = '{maintenance_work_mem}'"))
+            if recreate:
+                db_conn.execute(sqlalchemy.text(f"DROP INDEX IF EXISTS {self.index_name}"))
+            db_conn.execute(sqlalchemy.text(f"""
+                CREATE INDEX IF NOT EXISTS {self.index_name}
+                ON {EMBEDDING_TABLE}
+                USING hnsw ((embedding::{self.vector_type}) {ops})
+                WITH (m = {int(m)}, ef_construction = {int(ef_construction)})
+                WHERE collection_id = '{self.collection_id()}'"""))
+            if recreate:
+                db_conn.execute(sqlalchemy.text(f"DROP INDEX IF EXISTS {self.text_index_name}"))
+                db_conn.execute(sqlalchemy.text(f"DROP INDEX IF EXISTS {self.metadata_index_name}"))
+            # keyword search and metadata filters, same expressions as the search query
+            db_conn.execute(sqlalchemy.text(f"""
+                CREATE INDEX IF NOT EXISTS {self.text_index_name}
+                ON {EMBEDDING_TABLE}
+                USING gin (to_tsvector('{TEXT_SEARCH_CONFIG}', document))
+                WHERE collection_id = '{self.collection_id()}'"""))
+            db_conn.execute(sqlalchemy.text(f"""
+                CREATE INDEX IF NOT EXISTS {self.metadata_index_name}
+                ON {EMBEDDING_TABLE} ((cmetadata->>'doc'), ((cmetadata->>'page')::int))
+                WHERE collection_id = '{self.collection_id()}'"""))
+            db_conn.execute(sqlalchemy.text(f"ANALYZE {EMBEDDING_TABLE}"))
+            db_conn.commit()
+
+
+def _to_documents(rows: list) -> list:
+    final_res = []
+    for page_content, metadata in rows:
+        # asyncpg returns jsonb as text when the statement has no column types
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        final_res.append({
+            "page_content": page_content,
+            "document_name": metadata['doc'],
+            "document_page": metadata['page'],
+        })
+    return final_res
+
+
+def _vector_literal(embedding: list) -> str:
+    return "[" + ",".join(str(float(value)) for value in embedding) + "]"
+
+
+if __name__ == "__main__":
+    # index management command, e.g.
+    #   python retriever.py create-index --m 16 --ef-construction 64
+    #   python retriever.py warm-up
+    parser = argparse.ArgumentParser(description="Manage the ANN index of the RAG collection")
+    parser.add_argument("command", choices=["create-index", "warm-up"])
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=64)
+    parser.add_argument("--maintenance-work-mem", default="512MB")
+    parser.add_argument("--recreate", action="store_true")
+    args = parser.parse_args()
+
+    from main import vector_retriever
+    if args.command == "create-index":
+        vector_retriever.create_index(
+            m=args.m,
+            ef_construction=args.ef_construction,
+            maintenance_work_mem=args.maintenance_work_mem,
+            recreate=args.recreate
+        )
+        print(f"index {vector_retriever.index_name} is ready")
+    else:
+        vector_retriever.warm_up()
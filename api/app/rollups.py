@@ -0,0 +1,326 @@
+import time
+import logging
+import argparse
+import threading
+import traceback
+
+# pre-aggregated rollups (summary cubes) of fraud_data and the rewrite of generated queries
+# onto them. A cube keeps COUNT(*), SUM(amt), SUM(is_fraud), MIN(amt) and MAX(amt) per
+# combination of its dimensions, so an aggregate query on those dimensions gives the same
+# answer from a table that is orders of magnitude smaller.
+FRAUD_TABLE = "sandbox-project-471504.mekari_challenge_tabular_data.fraud_data"
+TIME_COLUMN = "trans_date_trans_time"
+MONTH_DIMENSION = "trans_month"
+
+# cube name -> dimensions, the first cube containing every dimension of a query is used
+# so the cubes are listed from the smallest to the largest
+DEFAULT_CUBES = {
+    "fraud_rollup_category_state_gender": ["category", "state", "gender", MONTH_DIMENSION, "is_fraud"],
+    "fraud_rollup_merchant": ["merchant", "category", MONTH_DIMENSION, "is_fraud"],
+}
+
+MEASURES = {
+    "txn_count": "COUNT(*)",
+    "sum_amt": "SUM(amt)",
+    "fraud_count": "SUM(is_fraud)",
+    "min_amt": "MIN(amt)",
+    "max_amt": "MAX(amt)",
+}
+
+
+class NotRewritable(Exception):
+    """The query can not be answered from a rollup."""
+
+
+class RollupRewriter:
+    """Rewrites BigQuery aggregate queries on the base table into queries on a cube.
+
+    Args:
+        base_table (str): fully qualified table the cubes are built from
+        cubes (dict): cube name -> list of dimensions
+    """
+    def __init__(self, base_table: str = FRAUD_TABLE, cubes: dict = None):
+        self._base_table = base_table
+        self._cubes = cubes if cubes is not None else DEFAULT_CUBES
+        project, dataset, _ = base_table.split(".")
+        self._dataset = f"{project}.{dataset}"
+
+    @property
+    def cubes(self) -> dict:
+        return self._cubes
+
+    def cube_table(self, cube: str) -> str:
+        return f"{self._dataset}.{cube}"
+
+    def build_sql(self, cube: str) -> str:
+        """CREATE OR REPLACE statement of the cube."""
+        dimensions = []
+        for dimension in self._cubes[cube]:
+            if dimension == MONTH_DIMENSION:
+                dimensions.append(f"TIMESTAMP_TRUNC({TIME_COLUMN}, MONTH) AS {MONTH_DIMENSION}")
+            else:
+                dimensions.append(dimension)
+        measures = [f"{expression} AS {name}" for name, expression in MEASURES.items()]
+        return (
+            f"CREATE OR REPLACE TABLE `{self.cube_table(cube)}` AS "
+            f"SELECT {', '.join(dimensions + measures)} "
+            f"FROM `{self._base_table}` "
+            f"GROUP BY {', '.join(str(i + 1) for i in range(len(dimensions)))}"
+        )
+
+    def rewrite(self, sql: str) -> tuple:
+        """Rewrites the query onto the smallest cube able to answer it.
+
+        Returns:
+            (rewritten_sql, cube_name)
+
+        Raises:
+            NotRewritable: the query is not a single-table aggregate on cube dimensions
+        """
+        import sqlglot
+        from sqlglot import exp
+        try:
+            tree = sqlglot.parse_one(sql, read="bigquery")
+        except sqlglot.errors.ParseError as e:
+            raise NotRewritable(f"Can not parse query: {e}")
+        if not isinstance(tree, exp.Select):
+            raise NotRewritable("Only a plain SELECT can be rewritten")
+        for node_type in (exp.Join, exp.Subquery, exp.With, exp.Union, exp.Window, exp.Unnest):
+            if tree.find(node_type) is not None:
+                raise NotRewritable(f"{node_type.__name__} is not supported")
+        tables = list(tree.find_all(exp.Table))
+        if len(tables) != 1 or ".".join(part for part in (tables[0].catalog, tables[0].db, tables[0].name) if part) != self._base_table:
+            raise NotRewritable("Query does not read the base table only")
+        if tree.find(exp.AggFunc) is None:
+            raise NotRewritable("Query is not an aggregate")
+
+        all_dimensions = {dimension for dimensions in self._cubes.values() for dimension in dimensions}
+        aliases = {projection.alias for projection in tree.expressions if isinstance(projection, exp.Alias)}
+        used_dimensions = set()
+        rewritten = _QueryRewriter(all_dimensions, used_dimensions, aliases)
+
+        new_tree = tree.copy()
+        # keep the output column names: anonymous expressions are named f0_, f1_, ... by BigQuery
+        anonymous = 0
+        projections = []
+        for projection in new_tree.expressions:
+            if isinstance(projection, exp.Alias):
+                projections.append(exp.alias_(rewritten.rewrite(projection.this), projection.alias))
+            elif isinstance(projection, exp.Column):
+                projections.append(exp.alias_(rewritten.rewrite(projection), projection.name))
+            elif isinstance(projection, exp.Star):
+                raise NotRewritable("SELECT * can not be rewritten")
+            else:
+                projections.append(exp.alias_(rewritten.rewrite(projection), f"f{anonymous}_"))
+                anonymous += 1
+        new_tree.set("expressions", projections)
+        for key in ("where", "group", "having", "order", "qualify"):
+            clause = new_tree.args.get(key)
+            if clause is not None:
+                new_tree.set(key, rewritten.rewrite(clause))
+
+        cube = self._pick_cube(used_dimensions)
+        for table in new_tree.find_all(exp.Table):
+            table.replace(exp.to_table(f"`{self.cube_table(cube)}`", dialect="bigquery"))
+        return new_tree.sql(dialect="bigquery"), cube
+
+    def _pick_cube(self, used_dimensions: set) -> str:
+        for cube, dimensions in self._cubes.items():
+            if used_dimensions <= set(dimensions):
+                return cube
+        raise NotRewritable(f"No cube contains {sorted(used_dimensions)}")
+
+
+class _QueryRewriter:
+    """Rewrites the expressions of a query, column references outside aggregates must be dimensions."""
+    def __init__(self, dimensions: set, used_dimensions: set, aliases: set):
+        self._dimensions = dimensions
+        self._used_dimensions = used_dimensions
+        self._aliases = aliases
+
+    def rewrite(self, node):
+        from sqlglot import exp
+        if isinstance(node, exp.AggFunc):
+            return self._aggregate(node)
+        if isinstance(node, exp.TimestampTrunc) and _is_column(node.this, TIME_COLUMN):
+            # the month dimension is truncated in UTC, another zone gives other month boundaries
+            if not _is_utc(node.args.get("zone")):
+                raise NotRewritable(f"TIMESTAMP_TRUNC in time zone {node.args['zone'].sql(dialect='bigquery')} does not match the UTC cube")
+            unit = node.unit.name.upper() if node.unit is not None else ""
+            self._used_dimensions.add(MONTH_DIMENSION)
+            if unit == "MONTH":
+                return exp.column(MONTH_DIMENSION)
+            if unit in ("QUARTER", "YEAR"):
+                return exp.TimestampTrunc(this=exp.column(MONTH_DIMENSION), unit=exp.var(unit))
+            raise NotRewritable(f"TIMESTAMP_TRUNC to {unit} is finer than the cube")
+        if isinstance(node, exp.Extract) and isinstance(node.expression, exp.AtTimeZone) and _is_column(node.expression.this, TIME_COLUMN):
+            if not _is_utc(node.expression.args.get("zone")):
+                raise NotRewritable(f"EXTRACT in time zone {node.expression.args['zone'].sql(dialect='bigquery')} does not match the UTC cube")
+            node = exp.Extract(this=node.this.copy(), expression=node.expression.this.copy())
+        if isinstance(node, exp.Extract) and _is_column(node.expression, TIME_COLUMN):
+            unit = node.this.name.upper()
+            if unit not in ("MONTH", "QUARTER", "YEAR"):
+                raise NotRewritable(f"EXTRACT({unit}) is finer than the cube")
+            self._used_dimensions.add(MONTH_DIMENSION)
+            return exp.Extract(this=exp.var(unit), expression=exp.column(MONTH_DIMENSION))
+        if isinstance(node, exp.Column):
+            if not node.table and node.name in self._aliases and node.name not in self._dimensions:
+                # reference to an output column in GROUP BY / HAVING / ORDER BY
+                return node.copy()
+            if node.name not in self._dimensions or node.name == MONTH_DIMENSION:
+                raise NotRewritable(f"Column {node.name} is not a cube dimension")
+            self._used_dimensions.add(node.name)
+            return exp.column(node.name)
+        new_node = node.copy()
+        for key, value in node.args.items():
+            if isinstance(value, exp.Expression):
+                new_node.set(key, self.rewrite(value))
+            elif isinstance(value, list):
+                new_node.set(key, [self.rewrite(item) if isinstance(item, exp.Expression) else item for item in value])
+        return new_node
+
+    def _aggregate(self, node):
+        from sqlglot import exp
+        argument = node.this
+        if isinstance(node, exp.Count):
+            if argument is None or isinstance(argument, exp.Star) or (isinstance(argument, exp.Literal) and not argument.is_string):
+                return _sum("txn_count")
+            if isinstance(argument, exp.Distinct):
+                # distinct values of a dimension are the same in the cube
+                return exp.Count(this=exp.Distinct(expressions=[self.rewrite(item) for item in argument.expressions]))
+            if isinstance(argument, exp.Column):
+                column = self.rewrite(argument)
+                return exp.Sum(this=exp.If(this=exp.Not(this=exp.Is(this=column, expression=exp.Null())), true=exp.column("txn_count"), false=exp.Literal.number(0)))
+        if isinstance(node, exp.CountIf) and not isinstance(argument, exp.Distinct):
+            return exp.Sum(this=exp.If(this=self.rewrite(argument), true=exp.column("txn_count"), false=exp.Literal.number(0)))
+        if isinstance(node, exp.Sum):
+            if _is_column(argument, "amt"):
+                return _sum("sum_amt")
+            if _is_column(argument, "is_fraud"):
+                return _sum("fraud_count")
+        if isinstance(node, exp.Avg):
+            if _is_column(argument, "amt"):
+                return exp.Paren(this=exp.Div(this=_sum("sum_amt"), expression=_sum("txn_count")))
+            if _is_column(argument, "is_fraud"):
+                return exp.Paren(this=exp.Div(this=_sum("fraud_count"), expression=_sum("txn_count")))
+        if isinstance(node, (exp.Min, exp.Max)):
+            if _is_column(argument, "amt"):
+                measure = "min_amt" if isinstance(node, exp.Min) else "max_amt"
+                return type(node)(this=exp.column(measure))
+            if isinstance(argument, exp.Column):
+                return type(node)(this=self.rewrite(argument))
+        raise NotRewritable(f"Aggregate {node.sql(dialect='bigquery')} is not supported")
+
+
+def _is_column(node, name: str) -> bool:
+    from sqlglot import exp
+    return isinstance(node, exp.Column) and node.name == name
+
+
+def _is_utc(zone) -> bool:
+    from sqlglot import exp
+    if zone is None:
+        return True
+    return isinstance(zone, exp.Literal) and zone.is_string and zone.this.upper() in ("UTC", "ETC/UTC", "Z", "+00", "+00:00")
+
+
+def _sum(column: str):
+    from sqlglot import exp
+    return exp.Sum(this=exp.column(column))
+
+
+class RollupManager:
+    """Builds and refreshes the cubes and routes queries to them while they are fresh.
+
+    Args:
+        rewriter (RollupRewriter): rewriter with the cube definitions
+        table_modified: callable returning the last modified time of a table (or None)
+    """
+    def __init__(self, rewriter: RollupRewriter, table_modified):
+        self._rewriter = rewriter
+        self._table_modified = table_modified
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.rewrites = 0
+        self.not_rewritable = 0
+        self.stale = 0
+
+    def is_fresh(self, cube: str) -> bool:
+        base_modified = self._table_modified(self._rewriter._base_table)
+        cube_modified = self._table_modified(self._rewriter.cube_table(cube))
+        return base_modified is not None and cube_modified is not None and cube_modified >= base_modified
+
+    def refresh(self, bigquery_client=None, only_stale: bool = False):
+        """Rebuilds the cubes in BigQuery."""
+        if bigquery_client is None:
+            from warehouse import get_bigquery_client
+            bigquery_client = get_bigquery_client()
+        for cube in self._rewriter.cubes:
+            if only_stale and self.is_fresh(cube):
+                continue
+            start = time.perf_counter()
+            bigquery_client.query(self._rewriter.build_sql(cube)).result()
+            logging.info(f"rollup {cube} built in {time.perf_counter() - start:.3f}s")
+
+    def start_refresh(self, interval: float):
+        """Starts a daemon thread rebuilding the stale cubes every interval seconds."""
+        def refresh():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh(only_stale=True)
+                except Exception:
+                    logging.exception(str(traceback.format_exc()))
+        threading.Thread(target=refresh, name="rollup-refresh", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def try_rewrite(self, sql: str):
+        """Returns the query rewritten onto a fresh cube, or None when the base table must be used."""
+        try:
+            rewritten_sql, cube = self._rewriter.rewrite(sql)
+        except NotRewritable as e:
+            with self._lock:
+                self.not_rewritable += 1
+            logging.debug(f"query not rewritten: {e}")
+            return None
+        if not self.is_fresh(cube):
+            with self._lock:
+                self.stale += 1
+            return None
+        with self._lock:
+            self.rewrites += 1
+        logging.info(f"query rewritten onto rollup {cube}")
+        return rewritten_sql
+
+    def distinct_values(self, column: str, bigquery_client=None, max_values: int = 5000):
+        """Distinct values of a cube dimension read from the smallest cube, None for another column."""
+        cube = next((cube for cube, dimensions in self._rewriter.cubes.items() if column in dimensions and column != MONTH_DIMENSION), None)
+        if cube is None:
+            return None
+        if bigquery_client is None:
+            from warehouse import get_bigquery_client
+            bigquery_client = get_bigquery_client()
+        sql = f"SELECT DISTINCT CAST({column} AS STRING) AS value FROM `{self._rewriter.cube_table(cube)}` WHERE {column} IS NOT NULL LIMIT {max_values + 1}"
+        values = [row["value"] for row in bigquery_client.query(sql).result()]
+        return values if len(values) <= max_values else None
+
+    def stats(self) -> dict:
+        return {"rewrites": self.rewrites, "not_rewritable": self.not_rewritable, "stale": self.stale}
+
+
+if __name__ == "__main__":
+    # python rollups.py refresh [--only-stale]
+    parser = argparse.ArgumentParser(description="Build the fraud_data rollups")
+    parser.add_argument("command", choices=["refresh", "show"])
+    parser.add_argument("--only-stale", action="store_true")
+    args = parser.parse_args()
+
+    from warehouse import QueryResultCache
+    rewriter = RollupRewriter()
+    manager = RollupManager(rewriter, QueryResultCache().table_modified)
+    if args.command == "refresh":
+        manager.refresh(only_stale=args.only_stale)
+    else:
+        for cube in rewriter.cubes:
+            print(rewriter.build_sql(cube))
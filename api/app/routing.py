@@ -0,0 +1,263 @@
+import re
+import json
+import logging
+import threading
+
+from caches.lru import TTLCache
+
+# per-request choice of the model tier: a cheap local classifier (keywords and shape of
+# the question, plus the history for follow-ups) sends greetings and single lookups to
+# the fastest tier and multi-intent analytical questions to the strongest one. An answer
+# is only retried on the next tier when it failed or looks unreliable, and only when the
+# latency and token budget of the request leave room for it. The token usage of every
+# attempt is recorded per model and per session.
+
+# approximate Vertex AI list prices in USD per 1M tokens (input, output), prompts <= 200k tokens
+DEFAULT_PRICES = {
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+# cached prompt tokens are billed at a fraction of the input price
+CACHED_INPUT_RATE = 0.1
+# seconds of a whole answer before anything was observed, replaced by the measured average
+DEFAULT_LATENCIES = {
+    "gemini-2.5-flash-lite": 3.0,
+    "gemini-2.5-flash": 6.0,
+    "gemini-2.5-pro": 15.0,
+}
+
+
+def _terms(*terms, prefix: bool = False) -> re.Pattern:
+    # whole words, or the start of a word with prefix ("analy" matches analysis and analyze)
+    end = "" if prefix else r"\b"
+    return re.compile(r"\b(" + "|".join(re.escape(term) for term in terms) + r")" + end, re.IGNORECASE)
+
+
+_GREETING = re.compile(
+    r"^\s*(hi|hello|hey|halo|hai|thanks|thank you|terima kasih|makasih|ok|oke|okay|good (morning|afternoon|evening)|selamat (pagi|siang|sore|malam))\b",
+    re.IGNORECASE
+)
+_DATA_TERMS = _terms(
+    "total", "jumlah", "berapa", "how many", "how much", "count", "average", "rata-rata", "sum", "transaction", "transactions",
+    "transaksi", "amount", "nilai", "merchant", "merchants", "category", "categories", "kategori", "rate", "rates", "top",
+    "tertinggi", "terbanyak", "per", "monthly", "bulanan"
+)
+_DOC_TERMS = _terms(
+    "report", "laporan", "document", "dokumen", "according", "menurut", "method", "metode", "definition", "definisi",
+    "sca", "strong customer authentication", "skimming", "phishing", "eba", "ecb", "page", "halaman"
+)
+_REASONING_TERMS = _terms(
+    "why", "mengapa", "kenapa", "compare", "comparison", "bandingkan", "perbandingan", "versus", "vs", "trend", "tren",
+    "correlat", "korelasi", "explain", "jelaskan", "analy", "analisis", "impact", "dampak", "affect", "pengaruh", "influence",
+    "recommend", "rekomendasi", "strateg", "pattern", "pola", "predict", "prediksi", "relationship", "hubungan", "cause", "penyebab",
+    prefix=True
+)
+_FOLLOW_UP = _terms(
+    "it", "that", "those", "these", "this", "them", "itu", "tersebut", "tadi", "sebelumnya", "previous", "above", "same", "again", "lagi"
+)
+# answers the model itself is not confident about, "no data was found" is a valid answer
+_HEDGES = _terms(
+    "i'm not sure", "i am not sure", "i don't know", "i do not know", "i cannot determine", "i can't determine", "i was unable",
+    "i am unable", "i'm unable", "an error occurred", "saya tidak yakin", "saya tidak tahu", "tidak dapat menentukan",
+    "tidak dapat menjawab", "terjadi kesalahan"
+)
+
+
+def usage_cost(model: str, usage: dict, prices: dict = DEFAULT_PRICES) -> float:
+    """Approximate cost in USD of the token counts of a request, 0 for a model without a price."""
+    input_price, output_price = prices.get(model, (0.0, 0.0))
+    cached = usage.get("cached", 0)
+    fresh = max(usage.get("prompt", 0) - cached, 0)
+    output = usage.get("output", 0) + usage.get("thoughts", 0)
+    return (fresh * input_price + cached * input_price * CACHED_INPUT_RATE + output * output_price) / 1e6
+
+
+class Route:
+    """Model tier chosen for a request.
+
+    Args:
+        tier (int): index in the tiers of the router, 0 is the fastest
+        model (str): model of the tier
+        reasons (list): why the tier was chosen
+        latency_budget (float): seconds available for the answer, None for no limit
+        token_budget (int): max output tokens of a model turn, None for the model default
+    """
+    def __init__(self, tier: int, model: str, reasons: list, latency_budget: float = None, token_budget: int = None):
+        self.tier = tier
+        self.model = model
+        self.reasons = reasons
+        self.latency_budget = latency_budget
+        self.token_budget = token_budget
+        self.escalations = 0
+
+
+class ModelRouter:
+    """Routes the questions to a model tier and escalates unreliable answers.
+
+    Args:
+        tiers (list): models from the fastest to the strongest
+        max_escalations (int): max retries on a stronger tier for one request
+        default_latency_budget (float): seconds when the request has no budget, None for no limit
+        min_avg_logprobs (float): answers with a lower average log probability are escalated, None disables the check
+        prices (dict): model -> (input, output) USD per 1M tokens
+        session_ttl (float): seconds after which the usage of an idle session is forgotten
+    """
+    def __init__(self, tiers: list, max_escalations: int = 1, default_latency_budget: float = None, min_avg_logprobs: float = None,
+                 prices: dict = DEFAULT_PRICES, session_ttl: float = 24 * 3600):
+        self.tiers = list(tiers)
+        self._max_escalations = max_escalations
+        self._default_latency_budget = default_latency_budget
+        self._min_avg_logprobs = min_avg_logprobs
+        self._prices = prices
+        self._latencies = {model: DEFAULT_LATENCIES.get(model, 6.0) for model in self.tiers}
+        self._session_usage = TTLCache(max_size=10000, ttl=session_ttl)
+        self._lock = threading.Lock()
+        self.routed = [0] * len(self.tiers)
+        self.escalations = {}
+        self.models = {model: {"requests": 0, "failed": 0, "prompt": 0, "cached": 0, "output": 0, "thoughts": 0, "cost_usd": 0.0} for model in self.tiers}
+
+    def classify(self, question: str, history_turns: int = 0) -> tuple:
+        """Complexity tier of a question from its wording.
+
+        Args:
+            question (str): question from the user
+            history_turns (int): number of turns already in the conversation
+
+        Returns:
+            (tier, reasons), tier 0 is a greeting or a single lookup, 1 a combination
+            question and 2 a multi-intent analytical question
+        """
+        text = question.strip()
+        words = len(text.split())
+        if words <= 6 and _GREETING.match(text):
+            return 0, ["small talk"]
+        score = 0
+        reasons = []
+        if _DATA_TERMS.search(text) and _DOC_TERMS.search(text):
+            score += 2
+            reasons.append("data and documents")
+        reasoning = {match.lower() for match in _REASONING_TERMS.findall(text)}
+        if reasoning:
+            score += min(2 * len(reasoning), 4)
+            reasons.append(f"analytical: {', '.join(sorted(reasoning))}")
+        if words > 25:
+            score += 1 if words <= 50 else 2
+            reasons.append(f"{words} words")
+        if text.count("?") > 1:
+            score += 1
+            reasons.append("several questions")
+        if history_turns and _FOLLOW_UP.search(text):
+            score += 1
+            reasons.append("follow-up")
+        tier = 0 if score <= 1 else 1 if score <= 3 else 2
+        return tier, reasons or ["single lookup"]
+
+    def expected_latency(self, model: str) -> float:
+        return self._latencies.get(model, 0.0)
+
+    def route(self, question: str, history_turns: int = 0, latency_budget: float = None, token_budget: int = None) -> Route:
+        """Model tier of a request, the classified tier is lowered until it fits the latency budget."""
+        tier, reasons = self.classify(question, history_turns)
+        tier = min(tier, len(self.tiers) - 1)
+        latency_budget = latency_budget or self._default_latency_budget
+        if latency_budget:
+            while tier > 0 and self.expected_latency(self.tiers[tier]) > latency_budget:
+                tier -= 1
+                reasons = reasons + ["latency budget"]
+        with self._lock:
+            self.routed[tier] += 1
+        return Route(tier, self.tiers[tier], reasons, latency_budget, token_budget)
+
+    def assess(self, answer: str = None, error: Exception = None, tool_errors: int = 0, avg_logprobs: float = None) -> str:
+        """Reason to retry an answer on a stronger tier, None when it can be returned."""
+        if error is not None:
+            return "error"
+        if not answer or not answer.strip():
+            return "empty answer"
+        if tool_errors:
+            return "tool errors"
+        if _HEDGES.search(answer):
+            return "hedged answer"
+        if self._min_avg_logprobs is not None and avg_logprobs is not None and avg_logprobs < self._min_avg_logprobs:
+            return "low log probability"
+        return None
+
+    def escalate(self, route: Route, reason: str, elapsed: float, tokens_used: int = 0) -> str:
+        """Moves the route to the next tier and returns its model, None when the answer has to be kept.
+
+        Args:
+            route (Route): route of the request, updated in place
+            reason (str): reason from assess
+            elapsed (float): seconds already spent on the request
+            tokens_used (int): output tokens already spent on the request
+        """
+        if route.tier + 1 >= len(self.tiers) or route.escalations >= self._max_escalations:
+            return None
+        model = self.tiers[route.tier + 1]
+        if route.latency_budget and elapsed + self.expected_latency(model) > route.latency_budget:
+            return None
+        if route.token_budget and tokens_used >= route.token_budget:
+            return None
+        logging.info(json.dumps({"event": "model_escalation", "from": route.model, "to": model, "reason": reason, "elapsed": round(elapsed, 3)}))
+        with self._lock:
+            self.escalations[reason] = self.escalations.get(reason, 0) + 1
+        route.tier += 1
+        route.model = model
+        route.escalations += 1
+        route.reasons = route.reasons + [f"escalated: {reason}"]
+        return model
+
+    def record(self, session_id: str, model: str, usage: dict, seconds: float, failed: bool = False):
+        """Adds the token counts of one attempt to the model and session totals.
+
+        Args:
+            session_id (str): chat session
+            model (str): model of the attempt
+            usage (dict): token counts by kind (prompt, cached, output, thoughts)
+            seconds (float): duration of the attempt, feeds the expected latency of the model
+            failed (bool): the attempt was escalated or raised
+        """
+        cost = usage_cost(model, usage, self._prices)
+        with self._lock:
+            totals = self.models.setdefault(model, {"requests": 0, "failed": 0, "prompt": 0, "cached": 0, "output": 0, "thoughts": 0, "cost_usd": 0.0})
+            totals["requests"] += 1
+            totals["failed"] += int(failed)
+            for kind in ("prompt", "cached", "output", "thoughts"):
+                totals[kind] += usage.get(kind, 0)
+            totals["cost_usd"] += cost
+            # moving average, recent answers weigh more
+            self._latencies[model] = 0.8 * self._latencies.get(model, seconds) + 0.2 * seconds
+            if session_id:
+                session = dict(self._session_usage.get(session_id) or {})
+                entry = dict(session.get(model) or {"requests": 0, "prompt": 0, "cached": 0, "output": 0, "thoughts": 0, "cost_usd": 0.0})
+                entry["requests"] += 1
+                for kind in ("prompt", "cached", "output", "thoughts"):
+                    entry[kind] += usage.get(kind, 0)
+                entry["cost_usd"] += cost
+                session[model] = entry
+                self._session_usage.put(session_id, session)
+        # one log line per attempt, the usage of a session can be summed from the logs
+        logging.info(json.dumps({
+            "event": "model_usage",
+            "session_id": session_id,
+            "model": model,
+            "seconds": round(seconds, 3),
+            "failed": failed,
+            "cost_usd": round(cost, 6),
+            **{kind: usage.get(kind, 0) for kind in ("prompt", "cached", "output", "thoughts")},
+        }))
+
+    def session_usage(self, session_id: str) -> dict:
+        """Token counts and cost of a session by model, empty for an unknown session."""
+        return self._session_usage.get(session_id) or {} if session_id else {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tiers": {model: self.routed[tier] for tier, model in enumerate(self.tiers)},
+                "escalations": dict(self.escalations),
+                "expected_latency": {model: round(seconds, 3) for model, seconds in self._latencies.items()},
+                "models": {model: dict(totals) for model, totals in self.models.items()},
+                "sessions": len(self._session_usage),
+            }
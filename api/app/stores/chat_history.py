@@ -0,0 +1,409 @@
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import sqlalchemy
+
+# chat history is kept as an append-only log of small segment files per session:
+#   <prefix>/<session_id>/history_<session_id>.json       (legacy full snapshot, read only)
+#   <prefix>/<session_id>/segments/<seq>.json             (list of records, written once)
+# a record is either a chat turn, a feedback event that applies to the latest turn or a
+# rolling summary of the older turns, so every message only writes the new records
+# instead of re-uploading the whole history.
+DEFAULT_PREFIX = "gen-ai-memory/chat_history"
+DEFAULT_FEEDBACK = 2 # default feedback, 0 means bad and 1 means good
+MAX_APPEND_ATTEMPTS = 5
+_SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.\-]{1,128}$")
+
+
+class SegmentConflict(Exception):
+    """Another writer already stored a segment with the same seq."""
+
+
+def turn_record(chat: str, role: str, references: list = None) -> dict:
+    """Builds a chat turn record for the segment log.
+
+    Args:
+        chat (str): text of the turn
+        role (str): "user" or "model"
+        references (list): compact references of the tool results used for the turn
+    """
+    record = {"type": "turn", "chat": chat, "role": role, "ts": time.time()}
+    if references:
+        record["references"] = references
+    return record
+
+
+def summary_record(summary: str, covered_turns: int) -> dict:
+    """Builds a summary record, the summary replaces the first covered_turns turns in the prompt."""
+    return {"type": "summary", "summary": summary, "covered_turns": covered_turns}
+
+
+def feedback_record(feedback_good_or_not: int, feedback_text: str) -> dict:
+    """Builds a feedback record, it applies to the latest turn when the log is replayed."""
+    return {"type": "feedback", "feedback_good_or_not": feedback_good_or_not, "feedback_text": feedback_text, "ts": time.time()}
+
+
+class SessionState:
+    """Decoded chat history of a single session.
+
+    Attributes:
+        turns (list): list of dict with keys chat, role, feedback_good_or_not, feedback_text, references
+        next_seq (int): sequence number of the next segment to be written
+        summary (str): rolling summary of the first covered_turns turns
+        covered_turns (int): number of turns folded into the summary
+    """
+    def __init__(self, turns=None, next_seq=0):
+        self.turns = turns if turns is not None else []
+        self.next_seq = next_seq
+        self.summary = ""
+        self.covered_turns = 0
+
+    def apply(self, records: list):
+        for record in records:
+            record_type = record.get("type", "turn")
+            if record_type == "turn":
+                self.turns.append({
+                    "chat": record["chat"],
+                    "role": record["role"],
+                    "feedback_good_or_not": record.get("feedback_good_or_not", DEFAULT_FEEDBACK),
+                    "feedback_text": record.get("feedback_text", ""),
+                    "references": record.get("references", []),
+                })
+            elif record_type == "feedback" and self.turns:
+                self.turns[-1]["feedback_good_or_not"] = record["feedback_good_or_not"]
+                self.turns[-1]["feedback_text"] = record["feedback_text"]
+            elif record_type == "summary" and record["covered_turns"] >= self.covered_turns:
+                # two instances may fold the same turns, the summary covering the most wins
+                self.summary = record["summary"]
+                self.covered_turns = record["covered_turns"]
+
+
+class ChatHistoryStore:
+    """Base class for chat history storage with an in-process LRU cache of decoded sessions.
+
+    Backends only need to implement the raw segment primitives, the replay and caching
+    logic lives here so every backend behaves the same way.
+    """
+    def __init__(self, cache_size: int = 256):
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # striped per-session locks, the cached state of a session is read and updated by one thread at a time
+        self._session_locks = [threading.RLock() for _ in range(64)]
+        self._listeners = []
+
+    # --- backend primitives ---
+    def _read_legacy(self, session_id: str):
+        """Returns the legacy list of turns of the session or None if there is none."""
+        return None
+
+    def _read_segments(self, session_id: str, start_seq: int) -> list:
+        """Returns list of (seq, records) for every segment with seq >= start_seq, sorted by seq."""
+        raise NotImplementedError
+
+    def _write_segment(self, session_id: str, seq: int, records: list):
+        """Writes the segment, raises SegmentConflict when the seq is already taken."""
+        raise NotImplementedError
+
+    def list_sessions(self) -> list:
+        """Returns the ids of every stored session."""
+        raise NotImplementedError
+
+    def read_segments(self, session_id: str) -> list:
+        """Returns the legacy turns and every segment of the session, without caching.
+
+        Returns:
+            list of (seq, records), the legacy snapshot has seq -1.
+        """
+        segments = []
+        legacy = self._read_legacy(session_id)
+        if legacy:
+            segments.append((-1, legacy))
+        return segments + self._read_segments(session_id, 0)
+
+    def add_listener(self, listener):
+        """Registers listener(session_id, seq, records), called after every written segment."""
+        self._listeners.append(listener)
+
+    # --- cache ---
+    def _session_lock(self, session_id: str):
+        return self._session_locks[hash(session_id) % len(self._session_locks)]
+
+    def _cache_get(self, session_id: str):
+        with self._lock:
+            state = self._cache.get(session_id)
+            if state is not None:
+                self._cache.move_to_end(session_id)
+            return state
+
+    def _cache_put(self, session_id: str, state: SessionState):
+        if self._cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[session_id] = state
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _load_state(self, session_id: str) -> SessionState:
+        with self._session_lock(session_id):
+            state = self._cache_get(session_id)
+            if state is None:
+                state = SessionState()
+                legacy = self._read_legacy(session_id)
+                if legacy:
+                    state.apply(legacy)
+            # only segments written after the cached state are downloaded, another instance
+            # may have appended to the same session in the meantime
+            for seq, records in self._read_segments(session_id, state.next_seq):
+                state.apply(records)
+                state.next_seq = seq + 1
+            self._cache_put(session_id, state)
+            return state
+
+    # --- public api ---
+    def exists(self, session_id: str) -> bool:
+        return len(self._load_state(session_id).turns) > 0
+
+    def load(self, session_id: str) -> list:
+        """Loads the chat history of a session.
+
+        Args:
+            session_id (str): session id of the conversation
+
+        Returns:
+            A list of dictionaries with keys chat, role, feedback_good_or_not, feedback_text and references.
+        """
+        with self._session_lock(session_id):
+            return [dict(turn) for turn in self._load_state(session_id).turns]
+
+    def load_memory(self, session_id: str):
+        """Loads the rolling summary and the turns it does not cover.
+
+        Returns:
+            (summary, covered_turns, turns) where turns are the turns after the first covered_turns.
+        """
+        with self._session_lock(session_id):
+            state = self._load_state(session_id)
+            return state.summary, state.covered_turns, [dict(turn) for turn in state.turns[state.covered_turns:]]
+
+    def append(self, session_id: str, records: list):
+        """Appends new records (turns or feedback) to the session log as a single new segment.
+
+        Args:
+            session_id (str): session id of the conversation
+            records (list): list of records built with turn_record / feedback_record
+        """
+        if not records:
+            return
+        with self._session_lock(session_id):
+            for attempt in range(MAX_APPEND_ATTEMPTS):
+                state = self._load_state(session_id)
+                seq = state.next_seq
+                try:
+                    self._write_segment(session_id, seq, records)
+                    break
+                except SegmentConflict:
+                    # another instance wrote this seq first, reload its segment and take the next one
+                    if attempt == MAX_APPEND_ATTEMPTS - 1:
+                        raise
+            state.apply(records)
+            state.next_seq = seq + 1
+            self._cache_put(session_id, state)
+        for listener in self._listeners:
+            listener(session_id, seq, records)
+
+    def append_turns(self, session_id: str, turns: list):
+        """Appends chat turns, turns is a list of (chat, role) or (chat, role, references) tuples."""
+        self.append(session_id, [turn_record(*turn) for turn in turns])
+
+    def set_summary(self, session_id: str, summary: str, covered_turns: int):
+        """Stores a new rolling summary of the first covered_turns turns of the session."""
+        self.append(session_id, [summary_record(summary, covered_turns)])
+
+    def set_feedback(self, session_id: str, feedback_good_or_not: int, feedback_text: str) -> bool:
+        """Stores feedback on the latest answer of the session.
+
+        Returns:
+            False if there is no historical data for the session, True otherwise.
+        """
+        with self._session_lock(session_id):
+            if not self.exists(session_id):
+                return False
+            self.append(session_id, [feedback_record(feedback_good_or_not, feedback_text)])
+        return True
+
+
+class LocalChatHistoryStore(ChatHistoryStore):
+    """Chat history store on the local filesystem, mirrors the GCS layout. Useful for testing without GCP."""
+    def __init__(self, root: str, prefix: str = DEFAULT_PREFIX, cache_size: int = 256):
+        super().__init__(cache_size=cache_size)
+        self._root = root
+        self._prefix = prefix
+
+    def _session_dir(self, session_id: str) -> str:
+        # the session id comes from the client, it must not escape the root directory
+        if not _SESSION_ID_PATTERN.match(session_id) or session_id in (".", ".."):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        return os.path.join(self._root, self._prefix, session_id)
+
+    def list_sessions(self) -> list:
+        session_root = os.path.join(self._root, self._prefix)
+        if not os.path.isdir(session_root):
+            return []
+        return sorted(name for name in os.listdir(session_root) if os.path.isdir(os.path.join(session_root, name)))
+
+    def _read_legacy(self, session_id: str):
+        path = os.path.join(self._session_dir(session_id), f"history_{session_id}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["chat_history"]
+
+    def _read_segments(self, session_id: str, start_seq: int) -> list:
+        segment_dir = os.path.join(self._session_dir(session_id), "segments")
+        if not os.path.isdir(segment_dir):
+            return []
+        segments = []
+        for file_name in os.listdir(segment_dir):
+            seq = _parse_seq(file_name)
+            if seq is None or seq < start_seq:
+                continue
+            with open(os.path.join(segment_dir, file_name)) as f:
+                segments.append((seq, json.load(f)))
+        return sorted(segments, key=lambda segment: segment[0])
+
+    def _write_segment(self, session_id: str, seq: int, records: list):
+        segment_dir = os.path.join(self._session_dir(session_id), "segments")
+        os.makedirs(segment_dir, exist_ok=True)
+        # written to a temporary file then linked into place: readers never see a half
+        # written segment and the link fails when a concurrent writer took the same seq
+        temp_path = os.path.join(segment_dir, f".{_segment_name(seq)}.{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(records, f)
+        try:
+            os.link(temp_path, os.path.join(segment_dir, _segment_name(seq)))
+        except FileExistsError as e:
+            raise SegmentConflict(f"segment {seq} of {session_id} already exists") from e
+        finally:
+            os.remove(temp_path)
+
+
+class GCSChatHistoryStore(ChatHistoryStore):
+    """Chat history store on Google Cloud Storage, one client is shared for the whole process."""
+    def __init__(self, bucket_name: str, prefix: str = DEFAULT_PREFIX, cache_size: int = 256, storage_client=None):
+        super().__init__(cache_size=cache_size)
+        if storage_client is None:
+            from google.cloud import storage
+            storage_client = storage.Client()
+        self._bucket = storage_client.bucket(bucket_name)
+        self._prefix = prefix
+
+    def list_sessions(self) -> list:
+        # the delimiter lists the session "directories" only, not every segment
+        blobs = self._bucket.client.list_blobs(self._bucket, prefix=f"{self._prefix}/", delimiter="/")
+        for _ in blobs.pages:
+            pass
+        return sorted(prefix[len(self._prefix) + 1:].rstrip("/") for prefix in blobs.prefixes)
+
+    def _read_legacy(self, session_id: str):
+        blob = self._bucket.get_blob(f"{self._prefix}/{session_id}/history_{session_id}.json")
+        if blob is None:
+            return None
+        return json.loads(blob.download_as_text())["chat_history"]
+
+    def _read_segments(self, session_id: str, start_seq: int) -> list:
+        segment_prefix = f"{self._prefix}/{session_id}/segments/"
+        segments = []
+        # the names sort by seq, only the segments from start_seq on are listed
+        for blob in self._bucket.client.list_blobs(self._bucket, prefix=segment_prefix, start_offset=f"{segment_prefix}{_segment_name(start_seq)}"):
+            seq = _parse_seq(blob.name[len(segment_prefix):])
+            if seq is None or seq < start_seq:
+                continue
+            segments.append((seq, json.loads(blob.download_as_text())))
+        return sorted(segments, key=lambda segment: segment[0])
+
+    def _write_segment(self, session_id: str, seq: int, records: list):
+        from google.api_core.exceptions import PreconditionFailed
+        blob = self._bucket.blob(f"{self._prefix}/{session_id}/segments/{_segment_name(seq)}")
+        # if_generation_match=0 only creates the blob, a concurrent writer on the same seq fails
+        try:
+            blob.upload_from_string(json.dumps(records), content_type="application/json", if_generation_match=0)
+        except PreconditionFailed as e:
+            raise SegmentConflict(f"segment {seq} of {session_id} already exists") from e
+
+
+class PostgresChatHistoryStore(ChatHistoryStore):
+    """Chat history store on the Cloud SQL postgres instance, one row per segment."""
+    def __init__(self, engine: sqlalchemy.engine.base.Engine, table_name: str = "chat_history_segments", cache_size: int = 256):
+        super().__init__(cache_size=cache_size)
+        self._engine = engine
+        self._table_name = table_name
+        self._create_table()
+
+    def _create_table(self):
+        create_table = sqlalchemy.text(f"""
+            CREATE TABLE IF NOT EXISTS {self._table_name} (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                records JSONB NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (session_id, seq)
+            )""")
+        with self._engine.connect() as db_conn:
+            db_conn.execute(create_table)
+            db_conn.commit()
+
+    def list_sessions(self) -> list:
+        with self._engine.connect() as db_conn:
+            rows = db_conn.execute(sqlalchemy.text(f"SELECT DISTINCT session_id FROM {self._table_name} ORDER BY session_id")).fetchall()
+        return [row[0] for row in rows]
+
+    def _read_segments(self, session_id: str, start_seq: int) -> list:
+        select_segments = sqlalchemy.text(f"""
+            SELECT seq, records FROM {self._table_name}
+            WHERE session_id = :session_id AND seq >= :start_seq
+            ORDER BY seq""")
+        with self._engine.connect() as db_conn:
+            rows = db_conn.execute(select_segments, {"session_id": session_id, "start_seq": start_seq}).fetchall()
+        return [(row[0], row[1] if isinstance(row[1], list) else json.loads(row[1])) for row in rows]
+
+    def _write_segment(self, session_id: str, seq: int, records: list):
+        insert_segment = sqlalchemy.text(f"""
+            INSERT INTO {self._table_name} (session_id, seq, records)
+            VALUES (:session_id, :seq, CAST(:records AS JSONB))""")
+        try:
+            with self._engine.connect() as db_conn:
+                db_conn.execute(insert_segment, {"session_id": session_id, "seq": seq, "records": json.dumps(records)})
+                db_conn.commit()
+        except sqlalchemy.exc.IntegrityError as e:
+            raise SegmentConflict(f"segment {seq} of {session_id} already exists") from e
+
+
+def _segment_name(seq: int) -> str:
+    return f"{seq:08d}.json"
+
+
+def _parse_seq(file_name: str):
+    if not file_name.endswith(".json"):
+        return None
+    try:
+        return int(file_name[:-len(".json")])
+    except ValueError:
+        return None
+
+
+def create_history_store(backend: str, bucket_name: str = None, local_root: str = None, engine=None, cache_size: int = 256) -> ChatHistoryStore:
+    """Creates the chat history store for the given backend ("gcs", "local" or "postgres")."""
+    if backend == "gcs":
+        return GCSChatHistoryStore(bucket_name, cache_size=cache_size)
+    if backend == "local":
+        return LocalChatHistoryStore(local_root, cache_size=cache_size)
+    if backend == "postgres":
+        return PostgresChatHistoryStore(engine, cache_size=cache_size)
+    raise ValueError(f"Unknown chat history backend: {backend}")
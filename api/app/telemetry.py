@@ -0,0 +1,177 @@
+import time
+import asyncio
+import logging
+import traceback
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from opentelemetry import trace, context
+
+# per-stage instrumentation of the chat requests: the history reads and writes, every
+# model turn, tool call, BigQuery job, embedding and vector search is a span and its
+# duration goes to the chat_stage_seconds histogram, so a slow answer can be split by
+# stage. The metrics are served by /metrics for Prometheus (Cloud Run managed
+# Prometheus scrapes it). Spans are exported over OTLP/HTTP when an endpoint is given
+# (e.g. http://localhost:4318 for a local collector), otherwise they are no-ops.
+# The OpenTelemetry SDK and exporter are only imported when the export is enabled.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_SECONDS = Histogram("chat_request_seconds", "Duration of a chat request", ["endpoint", "outcome"], buckets=LATENCY_BUCKETS)
+FIRST_TOKEN_SECONDS = Histogram("chat_first_token_seconds", "Time to the first streamed token of an answer", buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Duration of a stage of a chat request", ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("chat_stage_errors_total", "Stages failing with an exception", ["stage"])
+TOOL_CALLS = Counter("chat_tool_calls_total", "Function calls of the model", ["tool", "status"])
+MODEL_TOKENS = Counter("chat_model_tokens_total", "Tokens of the model turns", ["kind"])
+QUERY_BYTES_SCANNED = Counter("warehouse_bytes_scanned_total", "Bytes processed by the BigQuery jobs")
+QUERY_ROWS = Histogram("warehouse_rows_returned", "Rows returned by a query", ["backend"], buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000))
+RAG_PASSAGES = Histogram("rag_passages_returned", "Passages returned to the model by a document search", buckets=(0, 1, 2, 4, 8, 16))
+
+tracer = trace.get_tracer("fraud-agent-api")
+
+
+def setup_tracing(service_name: str, endpoint: str = None):
+    """Exports the spans to an OTLP/HTTP collector, does nothing without an endpoint.
+
+    Args:
+        service_name (str): service.name of the spans
+        endpoint (str): collector base url, e.g. http://localhost:4318
+    """
+    if not endpoint:
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logging.warning("opentelemetry-sdk or the OTLP exporter is not installed, spans are not exported")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=f"{endpoint.rstrip('/')}/v1/traces")))
+    trace.set_tracer_provider(provider)
+    logging.info(f"spans exported to {endpoint}")
+
+
+def shutdown_tracing():
+    # flushes the spans still batched in the processor
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, "shutdown"):
+        provider.shutdown()
+
+
+@contextmanager
+def span(stage: str, attach: bool = True, **attributes):
+    """Span and duration of one stage, the exceptions are recorded on the span and re-raised.
+
+    Args:
+        stage (str): name of the span and stage label of the metrics, e.g. "history.load"
+        attach (bool): make it the current span so the spans started inside are its children,
+            off for spans around the yields of a generator (the consumer runs in between)
+        attributes: span attributes, None values are skipped
+    """
+    start = time.perf_counter()
+    current = tracer.start_span(stage, attributes={key: value for key, value in attributes.items() if value is not None})
+    token = context.attach(trace.set_span_in_context(current)) if attach else None
+    try:
+        yield current
+    except (Exception, asyncio.CancelledError) as e:
+        STAGE_ERRORS.labels(stage).inc()
+        current.record_exception(e)
+        current.set_status(trace.Status(trace.StatusCode.ERROR, type(e).__name__))
+        raise
+    finally:
+        if token is not None:
+            context.detach(token)
+        current.end()
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def annotate(**attributes):
+    """Adds attributes to the current span."""
+    current = trace.get_current_span()
+    for key, value in attributes.items():
+        if value is not None:
+            current.set_attribute(key, value)
+
+
+def usage_counts(usage_metadata) -> dict:
+    """Token counts of a model response by kind (prompt, cached, output, thoughts), empty without usage."""
+    if usage_metadata is None:
+        return {}
+    return {
+        "prompt": usage_metadata.prompt_token_count or 0,
+        "cached": usage_metadata.cached_content_token_count or 0,
+        "output": usage_metadata.candidates_token_count or 0,
+        "thoughts": usage_metadata.thoughts_token_count or 0,
+    }
+
+
+def record_usage(usage_metadata, target=None) -> dict:
+    """Adds the token counts of a model response to the counters and to the span (current span by default).
+
+    Returns:
+        The token counts by kind, see usage_counts
+    """
+    counts = usage_counts(usage_metadata)
+    current = target or trace.get_current_span()
+    for kind, value in counts.items():
+        if value:
+            MODEL_TOKENS.labels(kind).inc(value)
+            current.set_attribute(f"gen_ai.usage.{kind}_tokens", value)
+    return counts
+
+
+def record_query(backend: str, rows: int, bytes_scanned: int = None):
+    """Rows (and bytes scanned by BigQuery) of an executed query."""
+    QUERY_ROWS.labels(backend).observe(rows)
+    current = trace.get_current_span()
+    current.set_attribute("db.rows_returned", rows)
+    if bytes_scanned:
+        QUERY_BYTES_SCANNED.inc(bytes_scanned)
+        current.set_attribute("db.bytes_scanned", bytes_scanned)
+
+
+class StatsCollector:
+    """Exposes the numbers of the stats() of the app components as gauges.
+
+    The caches, pools and queues already count their hits, misses and sizes, they are
+    read on every scrape instead of being counted twice, e.g.
+        app_stat{component="query",key="results_hits"} 116
+    """
+    def __init__(self):
+        self._sources = {}
+
+    def add(self, component: str, stats):
+        """Registers a callable returning the stats dictionary of a component (or None)."""
+        self._sources[component] = stats
+
+    def collect(self):
+        gauge = GaugeMetricFamily("app_stat", "Numeric values of the stats of the app components", labels=["component", "key"])
+        for component, stats in self._sources.items():
+            try:
+                values = stats()
+            except Exception:
+                logging.warning(str(traceback.format_exc()))
+                continue
+            for key, value in _flatten(values or {}):
+                gauge.add_metric([component, key], float(value))
+        yield gauge
+
+
+def _flatten(values: dict, prefix: str = ""):
+    for key, value in values.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}_")
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def render_metrics():
+    """Body and content type of the /metrics response."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
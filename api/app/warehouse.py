@@ -0,0 +1,235 @@
+import io
+import re
+import csv
+import json
+import time
+import decimal
+import datetime
+import logging
+import threading
+import traceback
+
+from caches.lru import TTLCache
+from telemetry import record_query
+
+# shared BigQuery client and result cache for the queries written by the model.
+# fraud_data only changes when it is reloaded, so a result stays valid until the
+# last modified time of one of the referenced tables changes.
+_client = None
+_client_lock = threading.Lock()
+
+# quoted strings and identifiers are kept as is, everything else is canonicalized
+_TOKEN_PATTERN = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|--[^\n]*|#[^\n]*|/\*.*?\*/)""", re.DOTALL)
+# table references keep their case, project, dataset and table names are case sensitive in BigQuery
+_KEEP_CASE_PATTERN = re.compile(r"(\b(?:from|join)\s+)([a-z_][\w-]*)|\b([a-z_][\w-]*(?:\.[a-z_][\w-]*)+)", re.IGNORECASE)
+_TABLE_PATTERN = re.compile(r"`([\w-]+\.[\w-]+\.[\w-]+)`|`([\w-]+)`\.`([\w-]+)`\.`([\w-]+)`|\b([a-z][\w-]*\.\w+\.\w+)\b", re.IGNORECASE)
+
+
+# function for converting datetime from BQ
+def date_converter(o):
+    """
+    A custom JSON serializer function to handle date and datetime objects.
+    If the object is a date or datetime, it converts it to an ISO 8601 string.
+    Otherwise, it raises a TypeError.
+    """
+    if isinstance(o, (datetime.date, datetime.datetime, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, bytes):
+        return o.hex()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def get_bigquery_client():
+    """Returns the process wide BigQuery client, created on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google.cloud import bigquery
+                _client = bigquery.Client()
+    return _client
+
+
+def canonicalize_sql(sql: str) -> str:
+    """Canonical form of a query used as cache key.
+
+    Comments are removed, whitespace is collapsed, keywords and unquoted column names are
+    lowercased and trailing semicolons are dropped. Quoted strings and identifiers, dotted
+    names and the tables after FROM / JOIN are untouched.
+    """
+    # the code between the quoted tokens is normalized piece by piece, the quoted strings
+    # and identifiers are kept byte for byte ('a - b' and 'a-b' are different values)
+    parts = []
+    code = ""
+    for i, token in enumerate(_TOKEN_PATTERN.split(sql)):
+        if i % 2 == 0:
+            code += token
+        elif token.startswith(("--", "#", "/*")):
+            code += " "
+        else:
+            parts.extend([_normalize_code(code), token])
+            code = ""
+    parts.append(_normalize_code(code))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def _normalize_code(code: str) -> str:
+    # lowercased around the table references, which keep their case
+    pieces = []
+    position = 0
+    for match in _KEEP_CASE_PATTERN.finditer(code):
+        kept = match.group(3) or match.group(1).lower() + match.group(2)
+        pieces.extend([code[position:match.start()].lower(), kept])
+        position = match.end()
+    pieces.append(code[position:].lower())
+    canonical = re.sub(r"\s+", " ", "".join(pieces))
+    # whitespace around punctuation does not change the query
+    return re.sub(r"\s*([(),=<>+*/-])\s*", r"\1", canonical)
+
+
+def referenced_tables(sql: str) -> set:
+    """Fully qualified project.dataset.table names referenced by the query."""
+    tables = set()
+    for match in _TABLE_PATTERN.finditer(_strip_string_literals(sql)):
+        if match.group(1):
+            tables.add(match.group(1))
+        elif match.group(2):
+            tables.add(f"{match.group(2)}.{match.group(3)}.{match.group(4)}")
+        elif match.group(5):
+            tables.add(match.group(5))
+    return tables
+
+
+def _strip_string_literals(sql: str) -> str:
+    return re.sub(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*\"""", "''", sql)
+
+
+class QueryResultCache:
+    """LRU + TTL cache of query results keyed on the canonical SQL.
+
+    Args:
+        max_size (int): max number of cached results
+        ttl (float): time to live of a result in seconds
+        freshness_interval (float): how long the last modified time of a table is trusted
+            before it is fetched again from BigQuery
+    """
+    def __init__(self, max_size: int = 512, ttl: float = 3600, freshness_interval: float = 60):
+        self._results = TTLCache(max_size=max_size, ttl=ttl)
+        self._table_modified = TTLCache(max_size=256, ttl=freshness_interval)
+
+    def table_modified(self, table: str):
+        modified = self._table_modified.get(table)
+        if modified is None:
+            try:
+                modified = get_bigquery_client().get_table(table).modified
+            except Exception:
+                # unknown table or no permission, the query itself will report the error
+                logging.warning(str(traceback.format_exc()))
+                return None
+            self._table_modified.put(table, modified)
+        return modified
+
+    def _versions(self, sql: str) -> dict:
+        return {table: self.table_modified(table) for table in referenced_tables(sql)}
+
+    def get_or_run(self, sql: str, run):
+        """Returns the cached result of the query or runs it with run(sql) and caches the result.
+
+        Results of queries referencing a table with unknown last modified time are not cached.
+        """
+        key = canonicalize_sql(sql)
+        versions = self._versions(sql)
+        cached = self._results.get(key)
+        if cached is not None:
+            result, cached_versions = cached
+            if cached_versions == versions:
+                return result
+            self._results.pop(key)
+        start = time.perf_counter()
+        result = run(sql)
+        logging.info(f"query executed in {time.perf_counter() - start:.3f}s")
+        if versions and None not in versions.values():
+            self._results.put(key, (result, versions))
+        return result
+
+    def clear(self):
+        self._results.clear()
+        self._table_modified.clear()
+
+    def stats(self) -> dict:
+        return {"results": self._results.stats(), "table_modified": self._table_modified.stats()}
+
+
+def execute_query(sql: str, max_rows: int = 200, page_size: int = 1000, result_format: str = "csv") -> str:
+    """Runs the query and returns a bounded, compact result for the model.
+
+    At most max_rows rows are fetched, as an Arrow table when pyarrow is available, so the
+    memory of a request does not depend on the size of the result set.
+
+    Args:
+        sql (str): query to execute
+        max_rows (int): row cap, the total row count is still reported
+        page_size (int): rows per page fetched from BigQuery
+        result_format (str): "csv" or "columnar"
+
+    Returns:
+        The shaped result, see shape_result.
+    """
+    query_job = get_bigquery_client().query(sql)
+    row_iterator = query_job.result(page_size=min(page_size, max_rows) or None, max_results=max_rows)
+    try:
+        table = row_iterator.to_arrow(create_bqstorage_client=False)
+        columns = table.column_names
+        data = table.to_pydict()
+        rows = list(zip(*(data[column] for column in columns))) if columns else []
+    except ImportError:
+        # pyarrow is not installed, fall back to page based iteration
+        columns = [field.name for field in row_iterator.schema]
+        rows = [tuple(row.values()) for page in row_iterator.pages for row in page]
+    total_rows = row_iterator.total_rows if row_iterator.total_rows is not None else len(rows)
+    record_query("bigquery", total_rows, query_job.total_bytes_processed)
+    return shape_result(columns, rows[:max_rows], total_rows, result_format=result_format)
+
+
+def shape_result(columns: list, rows: list, total_rows: int, result_format: str = "csv") -> str:
+    """Serializes a query result compactly with its truncation metadata.
+
+    csv:
+        # total_rows=1234 returned_rows=200 truncated=true
+        col_a,col_b
+        1,x
+    columnar:
+        {"total_rows": 1234, "returned_rows": 200, "truncated": true, "columns": {"col_a": [1], "col_b": ["x"]}}
+    """
+    truncated = total_rows > len(rows)
+    if result_format == "columnar":
+        return json.dumps({
+            "total_rows": total_rows,
+            "returned_rows": len(rows),
+            "truncated": truncated,
+            "columns": {column: [row[i] for row in rows] for i, column in enumerate(columns)},
+        }, separators=(",", ":"), default=date_converter)
+    if result_format != "csv":
+        raise ValueError(f"Unknown result format: {result_format}")
+    output = io.StringIO()
+    output.write(f"# total_rows={total_rows} returned_rows={len(rows)} truncated={str(truncated).lower()}\n")
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+    return output.getvalue()
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(",", ":"), default=date_converter)
+    try:
+        return date_converter(value)
+    except TypeError:
+        return value
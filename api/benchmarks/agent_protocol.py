@@ -0,0 +1,89 @@
+"""Compares the classic and the lean agent protocol on the same questions.
+
+Runs every question against the real model and backends (same credentials as the API)
+and reports the model turns per answer, the tool calls and the end-to-end latency.
+
+    cd api/app && python ../benchmarks/agent_protocol.py --repeats 3 --output protocol.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+QUESTIONS = [
+    "What is the total fraud amount in the gas_transport category?",
+    "Berapa jumlah transaksi fraud per kategori?",
+    "What are the most common credit card fraud methods?",
+    "Menurut laporan EBA, berapa total nilai penipuan pembayaran di EEA pada tahun 2022?",
+    "Based on the report, what is the most common fraud method and what are the total losses from fraud in the shopping_net category in our data?",
+]
+
+
+async def run_question(main, mode: str, question: str) -> dict:
+    from agent import stream_agent
+    chat = main.create_chat([], mode=mode)
+    tool_calls = 0
+    start = time.perf_counter()
+    first_token = None
+    async for event, data in stream_agent(chat, question, main.agent_tools[mode], tool_timeouts=main.tool_timeouts):
+        if event == "tool" and data["status"] == "running":
+            tool_calls += 1
+        elif event == "token" and first_token is None:
+            first_token = time.perf_counter() - start
+        elif event == "done":
+            return {
+                "mode": mode,
+                "question": question,
+                "turns": data["turns"],
+                "tool_calls": tool_calls,
+                "latency": time.perf_counter() - start,
+                "first_token": first_token,
+                "answer": data["ai_answer"],
+            }
+
+
+def summarize(results: list) -> dict:
+    summary = {}
+    for mode in sorted({result["mode"] for result in results}):
+        runs = [result for result in results if result["mode"] == mode]
+        latencies = sorted(result["latency"] for result in runs)
+        summary[mode] = {
+            "runs": len(runs),
+            "turns_avg": statistics.mean(result["turns"] for result in runs),
+            "tool_calls_avg": statistics.mean(result["tool_calls"] for result in runs),
+            "latency_p50": statistics.median(latencies),
+            "latency_p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        }
+    return summary
+
+
+async def main(args):
+    import main as app_main
+    if "lean" in args.modes:
+        app_main.static_context.safe_create()
+    results = []
+    for _ in range(args.repeats):
+        for question in QUESTIONS:
+            # alternate the modes so both see the same warehouse and model conditions
+            for mode in args.modes:
+                result = await run_question(app_main, mode, question)
+                print(f"{mode:8s} turns={result['turns']} tools={result['tool_calls']} latency={result['latency']:.2f}s  {question[:60]}")
+                results.append(result)
+    summary = summarize(results)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["classic", "lean"], choices=["classic", "lean"])
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", default=None, help="json file with every run")
+    asyncio.run(main(parser.parse_args()))
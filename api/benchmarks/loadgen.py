@@ -0,0 +1,118 @@
+"""Load generator for the chat endpoints of the API.
+
+Virtual users each own a session and send their questions one after the other, so the
+history grows like in a real conversation. Works against the app in-process (httpx ASGI
+transport) or against a running server (base url).
+"""
+import math
+import time
+import uuid
+import asyncio
+import statistics
+
+CHAT_PATH = "/chatbot/ai-assistant"
+STREAM_PATH = "/chatbot/ai-assistant/stream"
+
+
+def percentile(values: list, q: float):
+    """Nearest-rank percentile, None without values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+async def send_chat(client, question: str, session_id: str) -> dict:
+    start = time.perf_counter()
+    response = await client.post(CHAT_PATH, json={"session_id": session_id, "user_input": question})
+    latency = time.perf_counter() - start
+    answer = response.json().get("ai_answer") if response.status_code == 200 else None
+    return {
+        "latency": latency,
+        "first_token": None,
+        "ok": response.status_code == 200 and bool(answer),
+        "status": response.status_code,
+    }
+
+
+async def send_stream(client, question: str, session_id: str) -> dict:
+    start = time.perf_counter()
+    first_token = None
+    ok = False
+    event = None
+    async with client.stream("POST", STREAM_PATH, json={"session_id": session_id, "user_input": question}) as response:
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "token" and first_token is None:
+                    first_token = time.perf_counter() - start
+                elif event == "done":
+                    ok = True
+                elif event == "error":
+                    ok = False
+        status = response.status_code
+    return {
+        "latency": time.perf_counter() - start,
+        "first_token": first_token,
+        "ok": ok,
+        "status": status,
+    }
+
+
+class LoadGenerator:
+    """Sends questions with a fixed number of concurrent virtual users.
+
+    Args:
+        client: httpx.AsyncClient bound to the app or to a base url
+        concurrency (int): number of virtual users
+        turns_per_session (int): questions sent in one session before the user starts a new one
+    """
+    def __init__(self, client, concurrency: int = 8, turns_per_session: int = 4):
+        self._client = client
+        self._concurrency = concurrency
+        self._turns_per_session = turns_per_session
+
+    async def run(self, questions: list, requests: int, stream: bool = False) -> dict:
+        """Sends requests questions (cycling through the list) and returns the samples and the wall time."""
+        send = send_stream if stream else send_chat
+        queue = asyncio.Queue()
+        for i in range(requests):
+            queue.put_nowait(questions[i % len(questions)])
+        samples = []
+
+        async def user(user_index):
+            session_id, turns = None, 0
+            while True:
+                try:
+                    question = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if session_id is None or turns >= self._turns_per_session:
+                    session_id, turns = f"bench-{user_index}-{uuid.uuid4().hex[:8]}", 0
+                try:
+                    samples.append(await send(self._client, question, session_id))
+                except Exception as e:
+                    samples.append({"latency": None, "first_token": None, "ok": False, "status": type(e).__name__})
+                turns += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(self._concurrency)))
+        return {"samples": samples, "wall_seconds": time.perf_counter() - start}
+
+
+def summarize(samples: list, wall_seconds: float) -> dict:
+    """Latency percentiles and throughput of a run."""
+    latencies = [sample["latency"] for sample in samples if sample["ok"]]
+    first_tokens = [sample["first_token"] for sample in samples if sample["ok"] and sample["first_token"] is not None]
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if not sample["ok"]),
+        "latency_mean": statistics.mean(latencies) if latencies else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "first_token_p50": percentile(first_tokens, 50),
+        "first_token_p95": percentile(first_tokens, 95),
+        "throughput_rps": len(latencies) / wall_seconds if wall_seconds else None,
+    }
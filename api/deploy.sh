@@ -22,7 +22,12 @@ fi
 IMAGE="${REGION}-docker.pkg.dev/${PROJECT_ID}/${REPOSITORY}/${IMAGE_NAME}"
 
 # Combine environment variables into a single string for the Cloud Run deployment command.
-ENV_VARS="PROJECT_ID=$PROJECT_ID,VERSION_ID=$VERSION_ID,BUCKET_NAME=$BUCKET_NAME,SECRET_ID_DB=$SECRET_ID_DB"
+ENV_VARS="PROJECT_ID=$PROJECT_ID,VERSION_ID=$VERSION_ID,BUCKET_NAME=$BUCKET_NAME,SECRET_ID_DB=$SECRET_ID_DB,STARTUP_MODE=${STARTUP_MODE:-background}"
+
+# The app opens its port before the clients are warm (STARTUP_MODE=background), so the
+# instance only gets traffic once /readyz answers 200. Up to 4 minutes (2s x 120) for the
+# warm ups, the default TCP probe would route requests as soon as the port is open.
+STARTUP_PROBE="httpGet.path=/readyz,httpGet.port=8080,initialDelaySeconds=0,periodSeconds=2,timeoutSeconds=2,failureThreshold=120"
 
 # --- Execution ---
 echo "--- Starting Deployment ---"
@@ -52,6 +57,7 @@ gcloud run deploy "$SERVICE_NAME" \
   --region "$REGION" \
   --set-env-vars "$ENV_VARS" \
   --port 8080 \
+  --startup-probe "$STARTUP_PROBE" \
   --allow-unauthenticated \
   --service-account "$SERVICE_ACCOUNT" \
   --min-instances "$MIN_INSTANCES" \
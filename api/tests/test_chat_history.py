@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+from stores.chat_history import LocalChatHistoryStore, feedback_record, DEFAULT_PREFIX
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalChatHistoryStore(str(tmp_path))
+
+
+def test_replay_applies_turns_feedback_and_summary(store, tmp_path):
+    store.append_turns("s1", [("how many frauds?", "user"), ("42", "model", [{"type": "sql"}])])
+    store.set_feedback("s1", 0, "wrong number")
+    store.append_turns("s1", [("and in 2019?", "user"), ("12", "model")])
+    store.set_summary("s1", "asked about fraud counts", 2)
+
+    # a new store has no cached state, everything comes from the segments on disk
+    replayed = LocalChatHistoryStore(str(tmp_path))
+    turns = replayed.load("s1")
+    assert [(turn["chat"], turn["role"]) for turn in turns] == [
+        ("how many frauds?", "user"), ("42", "model"), ("and in 2019?", "user"), ("12", "model")
+    ]
+    assert turns[1]["feedback_good_or_not"] == 0
+    assert turns[1]["feedback_text"] == "wrong number"
+    assert turns[1]["references"] == [{"type": "sql"}]
+    assert turns[3]["feedback_good_or_not"] == 2
+    summary, covered_turns, recent = replayed.load_memory("s1")
+    assert (summary, covered_turns) == ("asked about fraud counts", 2)
+    assert [turn["chat"] for turn in recent] == ["and in 2019?", "12"]
+
+
+def test_replay_starts_from_the_legacy_snapshot(store, tmp_path):
+    session_dir = tmp_path / DEFAULT_PREFIX / "s1"
+    session_dir.mkdir(parents=True)
+    legacy = [{"chat": "hi", "role": "user", "feedback_good_or_not": 2, "feedback_text": ""},
+              {"chat": "hello", "role": "model", "feedback_good_or_not": 1, "feedback_text": "nice"}]
+    (session_dir / "history_s1.json").write_text(json.dumps({"chat_history": legacy}))
+    store.append_turns("s1", [("thanks", "user")])
+    turns = LocalChatHistoryStore(str(tmp_path)).load("s1")
+    assert [turn["chat"] for turn in turns] == ["hi", "hello", "thanks"]
+    assert turns[1]["feedback_text"] == "nice"
+
+
+def test_cached_store_reads_segments_of_other_writers(store, tmp_path):
+    other = LocalChatHistoryStore(str(tmp_path))
+    store.append_turns("s1", [("q1", "user")])
+    assert len(other.load("s1")) == 1
+    store.append_turns("s1", [("a1", "model")])
+    # other has s1 cached at the first segment, it picks the next one up and writes after it
+    other.append_turns("s1", [("q2", "user")])
+    assert [turn["chat"] for turn in store.load("s1")] == ["q1", "a1", "q2"]
+    assert sorted(os.listdir(tmp_path / DEFAULT_PREFIX / "s1" / "segments")) == ["00000000.json", "00000001.json", "00000002.json"]
+
+
+def test_feedback_without_history(store):
+    assert store.set_feedback("unknown", 1, "") is False
+    store.append("s1", [feedback_record(1, "")])
+    assert store.load("s1") == []
+
+
+def test_session_id_can_not_leave_the_root(store):
+    with pytest.raises(ValueError):
+        store.append_turns("../escape", [("hi", "user")])
@@ -0,0 +1,61 @@
+import pytest
+
+from cost_guard import LocalEstimator, CostGuard, QueryBudgetExceeded
+
+TABLE = "project.dataset.fraud_data"
+COLUMNS = {"category": 100, "amt": 800, "is_fraud": 50, "merchant": 400}
+
+
+@pytest.fixture
+def estimator():
+    return LocalEstimator({TABLE: COLUMNS})
+
+
+def test_estimate_sums_the_referenced_columns(estimator):
+    estimate = estimator.estimate(f"SELECT category, SUM(amt) FROM `{TABLE}` WHERE is_fraud = 1 GROUP BY category")
+    assert estimate.bytes_processed == 100 + 800 + 50
+    assert estimate.tables == [TABLE]
+
+
+def test_estimate_select_star_reads_every_column(estimator):
+    assert estimator.estimate(f"SELECT * FROM `{TABLE}` LIMIT 10").bytes_processed == sum(COLUMNS.values())
+
+
+def test_estimate_count_star_reads_no_column(estimator):
+    assert estimator.estimate(f"SELECT COUNT(*) FROM `{TABLE}`").bytes_processed == 0
+
+
+def test_estimate_ignores_unknown_tables(estimator):
+    estimate = estimator.estimate("SELECT amt FROM `other.dataset.table`")
+    assert estimate.bytes_processed == 0
+    assert estimate.tables == []
+
+
+def test_from_parquet_reads_the_column_sizes(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "fraud_data.parquet")
+    pq.write_table(pa.table({"category": ["travel"] * 100, "amt": [1.5] * 100}), path)
+    estimator = LocalEstimator.from_parquet(path, TABLE)
+    only_amt = estimator.estimate(f"SELECT SUM(amt) FROM `{TABLE}`").bytes_processed
+    everything = estimator.estimate(f"SELECT * FROM `{TABLE}`").bytes_processed
+    assert 0 < only_amt < everything
+
+
+def test_guard_charges_the_session_until_its_budget(estimator):
+    guard = CostGuard(estimator, max_bytes_per_query=1000, max_bytes_per_session=2000)
+    guard.check(f"SELECT SUM(amt) FROM `{TABLE}`", session_id="s1")
+    guard.check(f"SELECT SUM(amt) FROM `{TABLE}`", session_id="s1")
+    assert guard.session_usage("s1") == 1600
+    with pytest.raises(QueryBudgetExceeded, match="session limit"):
+        guard.check(f"SELECT SUM(amt) FROM `{TABLE}`", session_id="s1")
+    # a rejected query is not charged, another session has its own budget
+    assert guard.session_usage("s1") == 1600
+    guard.check(f"SELECT SUM(amt) FROM `{TABLE}`", session_id="s2")
+
+
+def test_guard_rejects_a_query_over_the_query_budget(estimator):
+    guard = CostGuard(estimator, max_bytes_per_query=1000, max_bytes_per_session=10 ** 6)
+    with pytest.raises(QueryBudgetExceeded, match="per-query limit"):
+        guard.check(f"SELECT * FROM `{TABLE}`", session_id="s1")
+    assert guard.stats()["rejected"] == 1
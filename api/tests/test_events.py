@@ -0,0 +1,52 @@
+import pytest
+
+from events import ParquetEventSink, EventLog, record_events, compact
+from stores.chat_history import LocalChatHistoryStore, turn_record, summary_record
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def test_record_events_skips_summaries():
+    records = [turn_record("q", "user"), summary_record("s", 1), {"type": "feedback", "feedback_good_or_not": 0, "feedback_text": "bad", "ts": 1.0}]
+    events = record_events("s1", 3, records)
+    assert [event["event_type"] for event in events] == ["turn", "feedback"]
+    assert all(event["session_id"] == "s1" and event["seq"] == 3 for event in events)
+
+
+def test_sink_partitions_by_source_and_day(tmp_path):
+    sink = ParquetEventSink(str(tmp_path))
+    day = 1700000000.0  # 2023-11-14 UTC
+    events = record_events("s1", 0, [{"type": "turn", "chat": "q", "role": "user", "ts": day}])
+    events += record_events("s1", 1, [{"type": "turn", "chat": "a", "role": "model", "ts": day + 86400}])
+    events += record_events("s0", 0, [{"type": "turn", "chat": "old", "role": "user"}], source="backfill")
+    paths = sink.write(events)
+    assert sorted(path.split(str(tmp_path))[1].rsplit("/", 1)[0] for path in paths) == [
+        "/source=backfill/dt=unknown", "/source=live/dt=2023-11-14", "/source=live/dt=2023-11-15"
+    ]
+    table = pq.read_table(str(tmp_path / "source=live"))
+    assert sorted(table.column("chat").to_pylist()) == ["a", "q"]
+    assert str(table.schema.field("ts").type) == "timestamp[us, tz=UTC]"
+
+
+def test_event_log_writes_the_segments_of_the_store(tmp_path):
+    store = LocalChatHistoryStore(str(tmp_path / "history"))
+    log = EventLog(ParquetEventSink(str(tmp_path / "events")))
+    store.add_listener(log.record)
+    store.append_turns("s1", [("q", "user"), ("a", "model")])
+    store.set_summary("s1", "summary", 2)
+    store.set_feedback("s1", 1, "good")
+    assert log.flush() == 3
+    assert log.stats()["files"] == 1
+    table = pq.read_table(str(tmp_path / "events"))
+    assert sorted(table.column("event_type").to_pylist()) == ["feedback", "turn", "turn"]
+
+
+def test_compact_exports_only_untimestamped_records(tmp_path):
+    store = LocalChatHistoryStore(str(tmp_path / "history"))
+    store.append("s1", [{"type": "turn", "chat": "legacy", "role": "user"}])
+    store.append_turns("s1", [("live", "user")])
+    sink = ParquetEventSink(str(tmp_path / "events"))
+    assert compact(store, sink) == 1
+    assert compact(store, sink, include_timestamped=True) == 2
+    table = pq.read_table(str(tmp_path / "events" / "source=backfill" / "dt=unknown"))
+    assert "legacy" in table.column("chat").to_pylist()
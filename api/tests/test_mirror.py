@@ -0,0 +1,86 @@
+import pytest
+
+from mirror import LocalMirror, MirrorUnavailable, FRAUD_TABLE
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    path = str(tmp_path / "fraud_data.parquet")
+    pq.write_table(pa.table({
+        "category": ["travel", "shopping_net", "travel", "grocery_pos"] * 250,
+        "amt": [float(i) for i in range(1000)],
+        "is_fraud": [i % 10 == 0 for i in range(1000)],
+    }), path)
+    mirror = LocalMirror(path)
+    mirror.load()
+    return mirror
+
+
+def test_transpile_replaces_the_mirrored_table(mirror):
+    sql = mirror.transpile(f"SELECT category, COUNT(*) AS n FROM `{FRAUD_TABLE}` AS t WHERE t.amt > 10 GROUP BY category")
+    assert FRAUD_TABLE not in sql
+    assert "fraud_data AS t" in sql
+
+
+def test_transpile_keeps_cte_references(mirror):
+    sql = mirror.transpile(f"WITH big AS (SELECT * FROM `{FRAUD_TABLE}` WHERE amt > 500) SELECT COUNT(*) FROM big")
+    assert "FROM big" in sql
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM `other-project.dataset.table`",
+    f"DELETE FROM `{FRAUD_TABLE}` WHERE TRUE",
+    f"SELECT 1 FROM `{FRAUD_TABLE}`; SELECT 2 FROM `{FRAUD_TABLE}`",
+    "SELECT FROM WHERE (",
+])
+def test_transpile_rejects_what_the_mirror_can_not_serve(mirror, sql):
+    with pytest.raises(MirrorUnavailable):
+        mirror.transpile(sql)
+
+
+def test_execute_returns_columns_rows_and_total(mirror):
+    columns, rows, total_rows = mirror.execute(
+        f"SELECT category, COUNT(*) AS n, COUNTIF(is_fraud) AS frauds FROM `{FRAUD_TABLE}` GROUP BY category ORDER BY category"
+    )
+    assert columns == ["category", "n", "frauds"]
+    assert rows == [("grocery_pos", 250, 0), ("shopping_net", 250, 0), ("travel", 500, 100)]
+    assert total_rows == 3
+
+
+def test_execute_truncates_the_rows_but_counts_all_of_them(mirror):
+    columns, rows, total_rows = mirror.execute(f"SELECT amt FROM `{FRAUD_TABLE}` ORDER BY amt DESC", max_rows=5)
+    assert rows == [(999.0,), (998.0,), (997.0,), (996.0,), (995.0,)]
+    assert total_rows == 1000
+
+
+def test_execute_without_a_snapshot(tmp_path):
+    with pytest.raises(MirrorUnavailable):
+        LocalMirror(str(tmp_path / "missing.parquet")).execute(f"SELECT 1 FROM `{FRAUD_TABLE}`")
+
+
+def test_snapshot_keeps_the_source_version(tmp_path):
+    import datetime
+    from types import SimpleNamespace
+    modified = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+    data = pa.table({"category": ["travel"], "amt": [1.0]})
+    client = SimpleNamespace(
+        get_table=lambda table_id: SimpleNamespace(modified=modified),
+        list_rows=lambda table_id: SimpleNamespace(to_arrow=lambda create_bqstorage_client=True: data),
+    )
+    path = str(tmp_path / "fraud_data.parquet")
+    LocalMirror(path).snapshot(client)
+    # a new process loading the file knows which version of the table it holds
+    mirror = LocalMirror(path)
+    mirror.load()
+    assert mirror.source_modified == modified
+    assert mirror.is_current(modified)
+    assert mirror.is_current(None)
+    assert not mirror.is_current(modified + datetime.timedelta(seconds=1))
+
+
+def test_snapshot_without_version_is_not_current(mirror):
+    assert mirror.source_modified is None
+    assert not mirror.is_current(None)
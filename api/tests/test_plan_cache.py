@@ -0,0 +1,60 @@
+import pytest
+
+from caches.plan import PlanCache
+
+pytest.importorskip("sqlglot")
+
+TABLE = "sandbox-project-471504.mekari_challenge_tabular_data.fraud_data"
+DOMAINS = {
+    "category": ["travel", "gas_transport", "shopping_net"],
+    "state": ["CA", "NY", "TX"],
+}
+
+
+@pytest.fixture
+def cache():
+    return PlanCache(column_values=DOMAINS.get)
+
+
+def test_string_slots_are_filled_with_values_of_their_column(cache):
+    cache.learn("How many frauds in CA?", f"SELECT COUNT(*) FROM `{TABLE}` WHERE state = 'CA' AND is_fraud = 1")
+    signature, sql = cache.lookup("How many frauds in TX?")
+    assert signature == "how many frauds in {str}"
+    assert "state = 'TX'" in sql
+    # a category or a year is not a state
+    assert cache.lookup("How many frauds in gas_transport?") is None
+    assert cache.lookup("How many frauds in 2020?") is None
+
+
+def test_like_slots_match_part_of_a_value(cache):
+    cache.learn("fraud in shopping", f"SELECT COUNT(*) FROM `{TABLE}` WHERE category LIKE '%shopping%'")
+    assert "LIKE '%travel%'" in cache.lookup("fraud in travel")[1]
+    assert cache.lookup("fraud in groceries") is None
+
+
+def test_number_slots(cache):
+    cache.learn("top 5 merchants", f"SELECT merchant FROM `{TABLE}` ORDER BY amt DESC LIMIT 5")
+    assert cache.lookup("top 7 merchants")[1].endswith("LIMIT 7")
+
+
+@pytest.mark.parametrize("question, sql", [
+    # the year comes from the previous turn
+    ("and in 2019?", f"SELECT COUNT(*) FROM `{TABLE}` WHERE state = 'CA' AND EXTRACT(YEAR FROM trans_date_trans_time) = 2019"),
+    # the rounding is the model's choice, not a value of the question
+    ("total per category", f"SELECT category, ROUND(SUM(amt), 2) FROM `{TABLE}` GROUP BY category"),
+    # no column to take the values from
+    ("fraud in travel", f"SELECT COUNT(*) FROM `{TABLE}` WHERE CONCAT(category, '') = 'travel'"),
+    # the values of the column are unknown
+    ("fraud at fraud_Kirlin", f"SELECT COUNT(*) FROM `{TABLE}` WHERE merchant = 'fraud_Kirlin'"),
+    # a one letter code can not be located in the question
+    ("fraud of women", f"SELECT COUNT(*) FROM `{TABLE}` WHERE gender = 'F'"),
+])
+def test_questions_not_learned(cache, question, sql):
+    assert cache.learn(question, sql) is None
+    assert cache.stats()["learned"] == 0
+
+
+def test_without_known_values_only_number_slots_are_learned():
+    cache = PlanCache()
+    assert cache.learn("How many frauds in CA?", f"SELECT COUNT(*) FROM `{TABLE}` WHERE state = 'CA'") is None
+    assert cache.learn("top 5 merchants", f"SELECT merchant FROM `{TABLE}` ORDER BY amt DESC LIMIT 5") == "top {num} merchants"
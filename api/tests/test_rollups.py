@@ -0,0 +1,99 @@
+import pytest
+
+from rollups import RollupRewriter, NotRewritable, FRAUD_TABLE
+
+sqlglot = pytest.importorskip("sqlglot")
+
+
+@pytest.fixture
+def rewriter():
+    return RollupRewriter()
+
+
+def test_rewrite_picks_the_smallest_cube(rewriter):
+    sql, cube = rewriter.rewrite(f"SELECT category, SUM(amt) AS total FROM `{FRAUD_TABLE}` WHERE state = 'CA' GROUP BY category")
+    assert cube == "fraud_rollup_category_state_gender"
+    assert rewriter.cube_table(cube) in sql
+    assert "SUM(sum_amt) AS total" in sql
+    assert "state = 'CA'" in sql
+
+
+def test_rewrite_uses_the_merchant_cube_for_merchants(rewriter):
+    _, cube = rewriter.rewrite(f"SELECT merchant, COUNT(*) FROM `{FRAUD_TABLE}` GROUP BY merchant")
+    assert cube == "fraud_rollup_merchant"
+
+
+def test_rewrite_keeps_the_output_names(rewriter):
+    sql, _ = rewriter.rewrite(f"SELECT category, COUNT(*), AVG(amt) FROM `{FRAUD_TABLE}` GROUP BY category")
+    assert "SUM(txn_count) AS f0_" in sql
+    assert "(SUM(sum_amt) / SUM(txn_count)) AS f1_" in sql
+    assert "category AS category" in sql
+
+
+def test_rewrite_maps_months_onto_the_month_dimension(rewriter):
+    sql, _ = rewriter.rewrite(
+        f"SELECT TIMESTAMP_TRUNC(trans_date_trans_time, MONTH) AS month, SUM(is_fraud) AS frauds FROM `{FRAUD_TABLE}` GROUP BY month"
+    )
+    assert "trans_month AS month" in sql
+    assert "SUM(fraud_count) AS frauds" in sql
+
+
+@pytest.mark.parametrize("sql", [
+    f"SELECT * FROM `{FRAUD_TABLE}`",
+    f"SELECT category FROM `{FRAUD_TABLE}`",
+    f"SELECT city, COUNT(*) FROM `{FRAUD_TABLE}` GROUP BY city",
+    f"SELECT TIMESTAMP_TRUNC(trans_date_trans_time, DAY) AS day, COUNT(*) FROM `{FRAUD_TABLE}` GROUP BY day",
+    f"SELECT merchant, state, COUNT(*) FROM `{FRAUD_TABLE}` GROUP BY merchant, state",
+    f"SELECT APPROX_QUANTILES(amt, 2) FROM `{FRAUD_TABLE}`",
+    "SELECT category, COUNT(*) FROM `other-project.dataset.table` GROUP BY category",
+    f"SELECT a.category, COUNT(*) FROM `{FRAUD_TABLE}` a JOIN `{FRAUD_TABLE}` b ON a.merchant = b.merchant GROUP BY 1",
+])
+def test_rewrite_rejects_what_no_cube_answers(rewriter, sql):
+    with pytest.raises(NotRewritable):
+        rewriter.rewrite(sql)
+
+
+def test_rewrite_accepts_utc_truncation(rewriter):
+    sql, _ = rewriter.rewrite(
+        f"SELECT TIMESTAMP_TRUNC(trans_date_trans_time, MONTH, 'UTC') AS month, COUNT(*) AS n FROM `{FRAUD_TABLE}` GROUP BY month"
+    )
+    assert "trans_month AS month" in sql
+
+
+@pytest.mark.parametrize("sql", [
+    f"SELECT TIMESTAMP_TRUNC(trans_date_trans_time, MONTH, 'America/New_York') AS month, SUM(amt) FROM `{FRAUD_TABLE}` GROUP BY month",
+    f"SELECT EXTRACT(MONTH FROM trans_date_trans_time AT TIME ZONE 'Asia/Jakarta') AS month, SUM(amt) FROM `{FRAUD_TABLE}` GROUP BY month",
+])
+def test_rewrite_rejects_zoned_months(rewriter, sql):
+    # the cube months are UTC, a month in another zone has other boundaries
+    with pytest.raises(NotRewritable, match="time zone"):
+        rewriter.rewrite(sql)
+
+
+def test_rewritten_query_gives_the_same_answer(rewriter):
+    duckdb = pytest.importorskip("duckdb")
+    connection = duckdb.connect(database=":memory:")
+    connection.execute("CREATE TABLE base (category VARCHAR, state VARCHAR, gender VARCHAR, trans_date_trans_time TIMESTAMP, amt DOUBLE, is_fraud INTEGER)")
+    connection.executemany("INSERT INTO base VALUES (?, ?, ?, ?, ?, ?)", [
+        (["travel", "grocery_pos", "shopping_net"][i % 3], ["CA", "NY"][i % 2], ["F", "M"][i % 2 == 0 and i % 5 == 0],
+         f"2020-{i % 12 + 1:02d}-{i % 28 + 1:02d} 10:00:00", float(i % 97), int(i % 7 == 0))
+        for i in range(600)
+    ])
+    cube = "fraud_rollup_category_state_gender"
+
+    def local(sql):
+        # the BigQuery table names are swapped for the local tables before transpiling
+        sql = sql.replace(f"`{rewriter.cube_table(cube)}`", "cube").replace(f"`{FRAUD_TABLE}`", "base")
+        return sqlglot.transpile(sql, read="bigquery", write="duckdb")[0]
+
+    connection.execute(f"CREATE TABLE cube AS {local(rewriter.build_sql(cube).split(' AS ', 1)[1])}")
+    query = (
+        f"SELECT category, COUNT(*) AS n, SUM(amt) AS total, AVG(amt) AS average, MAX(amt) AS top, SUM(is_fraud) AS frauds "
+        f"FROM `{FRAUD_TABLE}` WHERE gender = 'F' GROUP BY category ORDER BY category"
+    )
+    rewritten, _ = rewriter.rewrite(query)
+    expected = connection.execute(local(query)).fetchall()
+    actual = connection.execute(local(rewritten)).fetchall()
+    assert len(expected) == 3
+    # the averages are computed from the sums, they may differ in the last digits
+    assert [tuple(pytest.approx(value) for value in row) for row in expected] == actual
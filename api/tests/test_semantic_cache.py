@@ -0,0 +1,26 @@
+from caches.semantic import question_terms, is_context_free
+
+KNOWN = ["travel", "shopping_net", "shopping_pos", "CA", "IN", "NY"]
+
+
+def test_questions_about_other_years_or_numbers_differ():
+    assert question_terms("total fraud in 2019") != question_terms("total fraud in 2020")
+    assert question_terms("top 5 merchants") != question_terms("top 10 merchants")
+    assert question_terms("transactions above 1,000") == question_terms("Transactions above 1000")
+
+
+def test_questions_about_other_categories_differ():
+    assert question_terms("fraud rate of shopping_net", KNOWN) != question_terms("fraud rate of shopping_pos", KNOWN)
+    assert question_terms("fraud amount for travel", KNOWN) == question_terms("How much fraud in Travel?", KNOWN)
+    assert question_terms("fraud amount for travel", KNOWN) != question_terms("fraud amount for 'gas_transport'", KNOWN)
+
+
+def test_short_codes_are_matched_as_written():
+    assert question_terms("how many frauds in CA", KNOWN) == frozenset({"ca"})
+    # "in" is a word, not Indiana
+    assert question_terms("how many frauds in total", KNOWN) == frozenset()
+
+
+def test_only_first_questions_are_context_free():
+    assert is_context_free("what about shopping_net?", 0)
+    assert not is_context_free("total fraud in 2019", 2)
@@ -0,0 +1,16 @@
+from warehouse import canonicalize_sql
+
+
+def test_formatting_does_not_change_the_key():
+    assert canonicalize_sql("SELECT  A ,b FROM `p.d.t` /* c */ WHERE y = 1;") == canonicalize_sql("select a,b from `p.d.t` where y=1")
+
+
+def test_literals_keep_their_value():
+    assert canonicalize_sql("SELECT 1 FROM t WHERE a LIKE '%a - b%'") != canonicalize_sql("SELECT 1 FROM t WHERE a LIKE '%a-b%'")
+    assert canonicalize_sql("SELECT 1 FROM t WHERE city = 'New  York'") != canonicalize_sql("SELECT 1 FROM t WHERE city = 'New York'")
+
+
+def test_table_names_keep_their_case():
+    assert canonicalize_sql("SELECT amt FROM p.d.Fraud") != canonicalize_sql("SELECT amt FROM p.d.fraud")
+    assert canonicalize_sql("SELECT amt FROM Fraud") != canonicalize_sql("SELECT amt FROM fraud")
+    assert canonicalize_sql("SELECT AMT FROM p.d.Fraud") == canonicalize_sql("select amt from p.d.Fraud")
@@ -0,0 +1,121 @@
+import os
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# client of the chat API shared by every session of the Streamlit process: one pooled
+# keep-alive session (no new TCP/TLS handshake per question), connect and read timeouts
+# and retries of the requests that never reached the API. The API urls come from the
+# environment when they are set, Secret Manager is only called otherwise.
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT = float(os.environ.get("API_READ_TIMEOUT", "180")) # max silence between two bytes of an answer
+API_RETRIES = int(os.environ.get("API_RETRIES", "3"))
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", "32")) # concurrent requests to the API per process
+
+
+def load_config(project_id: str = None, secret_id: str = None) -> dict:
+    """API urls (API_CHAT, API_CHAT_STREAM, API_FEEDBACK) from the environment or from the secret.
+
+    Args:
+        project_id (str): project of the secret
+        secret_id (str): secret holding the urls as JSON, read only when API_CHAT is not set
+    """
+    if os.environ.get("API_CHAT"):
+        config = {key: os.environ[key] for key in ("API_CHAT", "API_CHAT_STREAM", "API_FEEDBACK") if os.environ.get(key)}
+    else:
+        from google.cloud import secretmanager
+        client = secretmanager.SecretManagerServiceClient()
+        name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
+        response = client.access_secret_version(request={"name": name})
+        config = json.loads(response.payload.data.decode("UTF-8"))
+    # streaming variant of the chat API, defaults to the chat API url + /stream
+    config.setdefault("API_CHAT_STREAM", config["API_CHAT"].rstrip("/") + "/stream")
+    return config
+
+
+class _RejectedRequestRetry(Retry):
+    """Retries a POST only when it was rejected before the API handled it (429).
+
+    A 503 may come from an instance that already started on the question, connection
+    errors are retried for every method by urllib3 as the request was never sent.
+    """
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method == "POST" and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class ChatApiClient:
+    """Pooled HTTP client of the chat and feedback endpoints.
+
+    Connection errors are retried, the request never reached the API. A POST is also
+    retried on 429 (rejected without being handled) and a GET on 429 and 503. Failures
+    after the API received a question are not retried, so it is not answered twice.
+
+    Args:
+        config (dict): API urls from load_config
+        connect_timeout (float): seconds to open a connection
+        read_timeout (float): max seconds without data from the API
+        retries (int): retries of a request that did not reach the API
+        pool_size (int): max kept-alive connections
+    """
+    def __init__(self, config: dict, connect_timeout: float = API_CONNECT_TIMEOUT, read_timeout: float = API_READ_TIMEOUT,
+                 retries: int = API_RETRIES, pool_size: int = API_POOL_SIZE):
+        self._config = config
+        self._timeout = (connect_timeout, read_timeout)
+        retry = _RejectedRequestRetry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=(429, 503),
+            allowed_methods=frozenset({"GET", "POST"}),
+            backoff_factor=0.5,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def stream_chat(self, session_id: str, user_input: str):
+        """Posts the question to the streaming chat API and yields the Server-Sent Events.
+
+        Yields:
+            (event, data) tuples where data is the decoded JSON payload of the event.
+        """
+        payload = {"session_id": session_id, "user_input": user_input}
+        with self._session.post(self._config["API_CHAT_STREAM"], json=payload, stream=True, timeout=self._timeout,
+                                headers={"Accept": "text/event-stream"}) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+            # the events are utf-8, also when a proxy drops the charset of the content type
+            response.encoding = response.encoding or "utf-8"
+            event, data_lines = "message", []
+            for line in response.iter_lines(decode_unicode=True):
+                if line is None:
+                    continue
+                if line == "":
+                    # a blank line ends the event
+                    if data_lines:
+                        yield event, json.loads("\n".join(data_lines))
+                    event, data_lines = "message", []
+                elif line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[len("data:"):].strip())
+
+    def send_feedback(self, session_id: str, feedback_good_or_not: int, feedback_text: str):
+        payload = {
+            "session_id": session_id,
+            "feedback_good_or_not": feedback_good_or_not,
+            "feedback_text": feedback_text
+        }
+        response = self._session.post(self._config["API_FEEDBACK"], json=payload, timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self._session.close()
@@ -1,9 +1,9 @@
 import streamlit as st
 import requests
 import uuid
-import json
-from google.cloud import secretmanager
+import time
 import os
+from api_client import ChatApiClient, load_config
 # --- Page Configuration ---
 # Set the title and icon for the browser tab
 st.set_page_config(page_title="AI Assistant", page_icon="🤖")
@@ -17,20 +17,17 @@ st.caption("A Streamlit chatbot front-end for your internal Q&A database.")
 # Note: We don't need the CORS proxy here because the request is made from the server-side (Streamlit), not a browser.
 PROJECT_ID = os.environ.get("PROJECT_ID")
 SECRET_ID_DB = os.environ.get('SECRET_ID_DB')
-@st.cache_resource
-def access_secret():
-    # secret manager
-    client = secretmanager.SecretManagerServiceClient()
-    # Build the resource name of the secret version.
-    name = f"projects/{PROJECT_ID}/secrets/{SECRET_ID_DB}/versions/latest"
+# only the latest messages are rendered on a rerun, the earlier ones on demand
+HISTORY_RENDER_LIMIT = int(os.environ.get("HISTORY_RENDER_LIMIT", "30"))
+# min seconds between two renders of the streamed answer
+STREAM_RENDER_INTERVAL = float(os.environ.get("STREAM_RENDER_INTERVAL", "0.05"))
 
-    # Access the secret version.
-    response = client.access_secret_version(request={"name": name})
-    payload = response.payload.data.decode("UTF-8")
-    db_secret = json.loads(payload)
-    return db_secret
+@st.cache_resource
+def get_api_client():
+    # one pooled client per process, shared by the sessions of every analyst
+    return ChatApiClient(load_config(PROJECT_ID, SECRET_ID_DB))
 
-db_secret = access_secret()
+api_client = get_api_client()
 
 # --- Session State Initialization ---
 # Streamlit's session_state is used to persist variables across user interactions.
@@ -55,10 +52,20 @@ if "get_feedback" not in st.session_state:
 if "feedback_text" not in st.session_state:
     st.session_state.feedback_text = ""  # Initialize feedback text
 
+# Number of messages rendered, grows when the earlier messages are requested.
+if "render_limit" not in st.session_state:
+    st.session_state.render_limit = HISTORY_RENDER_LIMIT
+
+def show_earlier_messages():
+    st.session_state.render_limit += HISTORY_RENDER_LIMIT
+
 # --- Display Chat History ---
-# Iterate over the messages stored in the session state and display them.
+# Only the latest messages are displayed, a long session does not re-render all of them on every rerun.
 # This is equivalent to the `appendMessage` function that adds divs to the chat window.
-for message in st.session_state.messages:
+hidden_messages = max(len(st.session_state.messages) - st.session_state.render_limit, 0)
+if hidden_messages:
+    st.button(f"Show earlier messages ({hidden_messages} hidden)", on_click=show_earlier_messages)
+for message in st.session_state.messages[hidden_messages:]:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -72,34 +79,48 @@ if prompt := st.chat_input("Type your question here..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # 2. Prepare for the AI's response and show a loading indicator.
+    # 2. Prepare for the AI's response and show the progress of the agent.
     # This is equivalent to `setLoading(true)` and `showTypingIndicator(true)`.
     with st.chat_message("assistant"):
-        with st.spinner("AI is thinking..."):
-            try:
-                # 3. Prepare the payload for the API request.
-                payload = {
-                    "session_id": st.session_state.session_id,
-                    "user_input": prompt
-                }
-                
-                # 4. Send the message to the API.
-                response = requests.post(db_secret["API_CHAT"], json=payload)
-                response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-
-                # 5. Get the AI's answer from the JSON response.
-                data = response.json()
-                ai_answer = data.get("ai_answer", "Sorry, I received an unexpected response format.")
-
-            except requests.exceptions.RequestException as e:
-                # Handle connection errors, timeouts, etc.
-                ai_answer = f"Sorry, I'm having trouble connecting to the server. Please try again later. (Error: {e})"
-            except Exception as e:
-                # Handle other potential errors, like JSON parsing issues.
-                ai_answer = f"An unexpected error occurred. (Error: {e})"
-
-            # 6. Display the AI's response.
-            st.markdown(ai_answer)
+        status = st.status("AI is thinking...")
+        answer_placeholder = st.empty()
+        ai_answer = ""
+        rendered_at = 0.0
+        try:
+            # 3-4. Send the message to the streaming API and render the answer as it arrives,
+            # at most every STREAM_RENDER_INTERVAL seconds so a long answer is not re-sent per chunk.
+            for event, data in api_client.stream_chat(st.session_state.session_id, prompt):
+                if event == "tool":
+                    if data.get("status") == "running":
+                        status.update(label=f"Running {data['name']}...")
+                        status.write(f"`{data['name']}`")
+                elif event == "token":
+                    ai_answer += data["text"]
+                    if time.monotonic() - rendered_at >= STREAM_RENDER_INTERVAL:
+                        answer_placeholder.markdown(ai_answer + "▌")
+                        rendered_at = time.monotonic()
+                elif event == "reset":
+                    # the streamed text was a draft written before a tool call
+                    ai_answer = ""
+                    answer_placeholder.empty()
+                elif event in ("done", "error"):
+                    # 5. Get the AI's final answer from the last event.
+                    ai_answer = data.get("ai_answer", ai_answer)
+            if not ai_answer:
+                ai_answer = "Sorry, I received an unexpected response format."
+            status.update(label="Done", state="complete")
+
+        except requests.exceptions.RequestException as e:
+            # Handle connection errors, timeouts, etc.
+            ai_answer = f"Sorry, I'm having trouble connecting to the server. Please try again later. (Error: {e})"
+            status.update(label="Error", state="error")
+        except Exception as e:
+            # Handle other potential errors, like JSON parsing issues.
+            ai_answer = f"An unexpected error occurred. (Error: {e})"
+            status.update(label="Error", state="error")
+
+        # 6. Display the AI's response.
+        answer_placeholder.markdown(ai_answer)
 
     # 7. Append the AI's response to the chat history for persistence.
     st.session_state.messages.append({"role": "assistant", "content": ai_answer})
@@ -118,12 +139,6 @@ if st.session_state.get_feedback:
                 print("sudah baik")
             elif st.session_state.feedback == 0: # 0 means thumbs down
                 print(f"terdapat feedback: {st.session_state.feedback_text}")
-            payload_feedback = {
-            "session_id": st.session_state.session_id,
-            "feedback_good_or_not": st.session_state.feedback,
-            "feedback_text": st.session_state.feedback_text
-            }
-            response = requests.post(db_secret["API_FEEDBACK"], json=payload_feedback)
-            response.raise_for_status()
+            api_client.send_feedback(st.session_state.session_id, st.session_state.feedback, st.session_state.feedback_text)
             st.session_state.get_feedback = False
             st.success("Feedback submitted!") # Display success message        
@@ -25,6 +25,10 @@ IMAGE="${REGION}-docker.pkg.dev/${PROJECT_ID}/${REPOSITORY}/${IMAGE_NAME}"
 
 # Combine environment variables that will be set on the Cloud Run service.
 ENV_VARS="PROJECT_ID=${PROJECT_ID},VERSION_ID=${VERSION_ID},SECRET_ID_DB=${SECRET_ID_DB}"
+# optional: with API_CHAT set, the API urls are not read from Secret Manager
+if [ -n "${API_CHAT}" ]; then
+  ENV_VARS="${ENV_VARS},API_CHAT=${API_CHAT},API_FEEDBACK=${API_FEEDBACK}"
+fi
 
 
 # --- Google Cloud CLI Operations ---